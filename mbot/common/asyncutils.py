@@ -0,0 +1,68 @@
+"""
+在独立线程中运行一个共享的事件循环，同步代码可以把协程交给它执行并等待结果
+这个事件循环只执行框架内部的IO协程，不执行插件和监听器代码，同步调用方不会与它互相等待
+"""
+import asyncio
+import threading
+import typing
+from typing import Awaitable, Optional
+
+_T = typing.TypeVar('_T')
+
+
+class LoopThread:
+    """后台事件循环线程，首次使用时启动"""
+
+    def __init__(self, name: str = 'AsyncIO'):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self.start()
+        return self._loop
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            started.wait()
+            self._loop = loop
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def run(self, coro: Awaitable[_T], timeout: Optional[float] = None) -> _T:
+        """
+        在后台事件循环中执行协程并等待结果，调用方可以是任意线程，包括正在运行其他事件循环的线程
+        :param timeout: 等待的最长秒数，超时后取消协程
+        """
+        if self.in_loop_thread():
+            raise RuntimeError(f'不能在{self.name}事件循环内同步等待协程，请直接await')
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+
+loop_thread = LoopThread()
+
+
+def run_sync(coro: Awaitable[_T], timeout: Optional[float] = None) -> _T:
+    """在共享的后台事件循环中执行协程并等待结果"""
+    return loop_thread.run(coro, timeout)
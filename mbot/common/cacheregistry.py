@@ -0,0 +1,327 @@
+"""
+缓存注册表：进程内各处的缓存注册到这里，统一查看命中、未命中、淘汰次数、条目数、估算内存占用和加载耗时，并可以按名称清空
+支持cacheout的Cache、dict，以及实现了cache_stats()和clear()的自定义缓存；
+属于某个对象的缓存使用register_attr按弱引用注册，对象被回收后自动移除
+"""
+import contextlib
+import fnmatch
+import itertools
+import logging
+import sys
+import threading
+import time
+import typing
+import weakref
+from typing import Any, Dict, List, Optional
+
+from mbot.common.serializable import Serializable
+
+_LOGGER = logging.getLogger(__name__)
+
+"""估算内存占用时抽样的条目数，用样本的平均大小乘以条目数"""
+APPROX_SAMPLE_SIZE = 32
+"""估算单个对象大小时递归的最大层数"""
+APPROX_MAX_DEPTH = 4
+
+
+class CacheStats(Serializable):
+    """一个缓存的运行统计"""
+
+    def __init__(self, name: str, kind: str, size: int = 0, maxsize: int = 0, ttl: float = 0, hits: int = 0,
+                 misses: int = 0, evictions: int = 0, approx_bytes: int = 0, loads: int = 0, load_errors: int = 0,
+                 load_avg_ms: float = 0, load_max_ms: float = 0, l2_size: Optional[int] = None):
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = hits
+        self.misses = misses
+        self.hit_rate = round(hits / (hits + misses), 4) if hits + misses else 0
+        self.evictions = evictions
+        self.approx_bytes = approx_bytes
+        self.loads = loads
+        self.load_errors = load_errors
+        self.load_avg_ms = load_avg_ms
+        self.load_max_ms = load_max_ms
+        # 持久化到本地的条目数，只有分级缓存有
+        self.l2_size = l2_size
+
+
+class LoadStats:
+    """未命中后加载数据的次数和耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float, success: bool = True):
+        with self._lock:
+            self.loads += 1
+            if not success:
+                self.errors += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    @contextlib.contextmanager
+    def timed(self):
+        start = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.record(time.perf_counter() - start, success)
+
+    def fill(self, stats: CacheStats) -> CacheStats:
+        with self._lock:
+            stats.loads = self.loads
+            stats.load_errors = self.errors
+            stats.load_avg_ms = round(self.total / self.loads * 1000, 3) if self.loads else 0
+            stats.load_max_ms = round(self.max * 1000, 3)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.loads = self.errors = 0
+            self.total = self.max = 0.0
+
+
+def approx_sizeof(obj, depth: int = APPROX_MAX_DEPTH, seen: Optional[set] = None) -> int:
+    """估算对象占用的字节数，递归统计容器和对象属性，同一个对象只算一次"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    try:
+        size = sys.getsizeof(obj)
+    except TypeError:
+        return 0
+    if depth <= 0 or isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_sizeof(k, depth - 1, seen) + approx_sizeof(v, depth - 1, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += approx_sizeof(x, depth - 1, seen)
+    else:
+        attrs = getattr(obj, '__dict__', None)
+        if attrs is not None:
+            size += approx_sizeof(attrs, depth - 1, seen)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                size += approx_sizeof(getattr(obj, name), depth - 1, seen)
+    return size
+
+
+def approx_items_bytes(items: typing.Iterable, count: int) -> int:
+    """抽样估算全部条目的字节数"""
+    if not count:
+        return 0
+    sample = list(itertools.islice(items, APPROX_SAMPLE_SIZE))
+    if not sample:
+        return 0
+    total = sum(approx_sizeof(x) for x in sample)
+    return int(total / len(sample) * count)
+
+
+def _cacheout_stats(name: str, cache) -> CacheStats:
+    items = cache.items()
+    size = len(items)
+    stats = CacheStats(name, 'cacheout', size=size, maxsize=cache.maxsize, ttl=cache.ttl,
+                       approx_bytes=approx_items_bytes(iter(items), size))
+    tracker = getattr(cache, 'stats', None)
+    if tracker is not None and tracker.is_enabled():
+        info = tracker.info()
+        stats.hits = info.hit_count
+        stats.misses = info.miss_count
+        stats.hit_rate = round(info.hit_rate, 4)
+        stats.evictions = info.eviction_count
+    return stats
+
+
+def _dict_stats(name: str, cache: dict) -> CacheStats:
+    size = len(cache)
+    return CacheStats(name, 'dict', size=size, approx_bytes=approx_items_bytes(iter(list(cache.items())), size))
+
+
+def _collect(name: str, cache) -> CacheStats:
+    if hasattr(cache, 'cache_stats'):
+        stats = cache.cache_stats()
+        stats.name = name
+        return stats
+    if isinstance(cache, dict):
+        return _dict_stats(name, cache)
+    if hasattr(cache, 'items') and hasattr(cache, 'maxsize'):
+        return _cacheout_stats(name, cache)
+    return CacheStats(name, type(cache).__name__)
+
+
+class _Source:
+    """注册的缓存，直接持有缓存对象，或者按弱引用持有缓存所属的对象和属性名"""
+    __slots__ = ('_cache', '_owner', '_attr')
+
+    def __init__(self, cache=None, owner=None, attr: Optional[str] = None):
+        self._cache = cache
+        self._owner = weakref.ref(owner) if owner is not None else None
+        self._attr = attr
+
+    def resolve(self):
+        if self._owner is None:
+            return self._cache
+        owner = self._owner()
+        if owner is None:
+            return
+        return getattr(owner, self._attr, None)
+
+    @property
+    def alive(self) -> bool:
+        return self._owner is None or self._owner() is not None
+
+
+class CacheRegistry:
+    """进程内缓存的注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sources: Dict[str, _Source] = dict()
+        self._loads: Dict[str, LoadStats] = dict()
+
+    def _add(self, name: str, source: _Source, unique: bool) -> str:
+        with self._lock:
+            actual = name
+            n = 1
+            while unique and actual in self._sources and self._sources[actual].alive:
+                n += 1
+                actual = f'{name}-{n}'
+            self._sources[actual] = source
+        return actual
+
+    def register(self, name: str, cache) -> str:
+        """
+        注册一个全局缓存，cacheout的缓存会开启命中统计，同名的缓存会被替换
+        :return: 注册的名称
+        """
+        tracker = getattr(cache, 'stats', None)
+        if tracker is not None and hasattr(tracker, 'enable'):
+            tracker.enable()
+        return self._add(name, _Source(cache=cache), unique=False)
+
+    def register_attr(self, name: str, owner, attr: str) -> str:
+        """
+        注册属于某个对象的缓存，只保留对象的弱引用，每次读取时按属性名获取，对象替换缓存后也能统计到
+        :return: 注册的名称，名称已经被占用时自动加上序号
+        """
+        cache = getattr(owner, attr, None)
+        tracker = getattr(cache, 'stats', None)
+        if tracker is not None and hasattr(tracker, 'enable'):
+            tracker.enable()
+        return self._add(name, _Source(owner=owner, attr=attr), unique=True)
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._sources.pop(name, None)
+            self._loads.pop(name, None)
+
+    def load_stats(self, name: str) -> LoadStats:
+        """获取缓存的加载耗时统计，缓存未命中后加载数据的代码用timed_load记录"""
+        stats = self._loads.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._loads.setdefault(name, LoadStats())
+        return stats
+
+    def timed_load(self, name: str):
+        """记录一次加载耗时的上下文管理器"""
+        return self.load_stats(name).timed()
+
+    def _resolve_all(self) -> Dict[str, Any]:
+        result = dict()
+        dead = []
+        with self._lock:
+            sources = list(self._sources.items())
+        for name, source in sources:
+            cache = source.resolve()
+            if cache is None:
+                if not source.alive:
+                    dead.append(name)
+                continue
+            result[name] = cache
+        if dead:
+            with self._lock:
+                for name in dead:
+                    source = self._sources.get(name)
+                    if source is not None and not source.alive:
+                        self._sources.pop(name, None)
+                        self._loads.pop(name, None)
+        return result
+
+    def names(self) -> List[str]:
+        return list(self._resolve_all().keys())
+
+    def get(self, name: str):
+        return self._resolve_all().get(name)
+
+    def _match(self, pattern: Optional[str]) -> Dict[str, Any]:
+        caches = self._resolve_all()
+        if not pattern:
+            return caches
+        return {k: v for k, v in caches.items() if fnmatch.fnmatchcase(k, pattern)}
+
+    def get_stats(self, pattern: Optional[str] = None) -> List[CacheStats]:
+        """
+        获取缓存统计
+        :param pattern: 缓存名称，支持*通配，为空时返回全部
+        """
+        result = []
+        for name, cache in sorted(self._match(pattern).items()):
+            try:
+                stats = _collect(name, cache)
+            except Exception as e:
+                _LOGGER.warning(f'获取缓存统计失败：{name} {e}')
+                continue
+            loads = self._loads.get(name)
+            if loads is not None:
+                loads.fill(stats)
+            result.append(stats)
+        return result
+
+    def purge(self, pattern: str) -> List[str]:
+        """
+        清空缓存
+        :param pattern: 缓存名称，支持*通配
+        :return: 被清空的缓存名称
+        """
+        purged = []
+        for name, cache in sorted(self._match(pattern).items()):
+            try:
+                cache.clear()
+            except Exception as e:
+                _LOGGER.warning(f'清空缓存失败：{name} {e}')
+                continue
+            purged.append(name)
+        if purged:
+            _LOGGER.info(f'已经清空缓存：{", ".join(purged)}')
+        return purged
+
+    def reset_stats(self, pattern: Optional[str] = None):
+        """清零命中和加载统计"""
+        for name, cache in self._match(pattern).items():
+            reset = getattr(cache, 'reset_stats', None)
+            tracker = getattr(cache, 'stats', None)
+            if reset is not None:
+                reset()
+            elif tracker is not None and hasattr(tracker, 'reset'):
+                tracker.reset()
+            loads = self._loads.get(name)
+            if loads is not None:
+                loads.reset()
+
+
+cache_registry = CacheRegistry()
@@ -6,10 +6,12 @@ from typing import Dict, List
 
 from cacheout import Cache
 
+from mbot.common.cacheregistry import cache_registry
 from mbot.common.mediaparserutils import MediaParserUtils
 
 _LOGGER = logging.getLogger(__name__)
 hardlink_cache = Cache(maxsize=50, ttl=60 * 5, default=None)
+cache_registry.register('osutils.hardlink', hardlink_cache)
 
 
 class LinkMode(Enum):
@@ -238,16 +240,17 @@ class OSUtils:
                 if source_ino in ino_cache:
                     tmp = ino_cache[source_ino]
             if not tmp:
-                for root, ds, fs in os.walk(path):
-                    for f in fs:
-                        fp = os.path.join(root, f)
-                        fs = os.stat(fp)
-                        if fs.st_nlink > 1:
-                            ino = fs.st_ino
-                            if ino in ino_cache:
-                                ino_cache[ino].append(fp)
-                            else:
-                                ino_cache[ino] = [fp]
+                with cache_registry.timed_load('osutils.hardlink'):
+                    for root, ds, fs in os.walk(path):
+                        for f in fs:
+                            fp = os.path.join(root, f)
+                            fs = os.stat(fp)
+                            if fs.st_nlink > 1:
+                                ino = fs.st_ino
+                                if ino in ino_cache:
+                                    ino_cache[ino].append(fp)
+                                else:
+                                    ino_cache[ino] = [fp]
                 hardlink_cache.set(path, ino_cache)
                 if source_ino in ino_cache:
                     tmp = ino_cache[source_ino]
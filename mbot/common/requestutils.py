@@ -1,11 +1,28 @@
+import asyncio
 import ssl
+import threading
+import typing
 from http.cookies import SimpleCookie
 
 import aiofiles
 import aiohttp
 import certifi
 import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from tenacity import retry, wait_fixed, stop_after_attempt
+from urllib3.util.retry import Retry
+
+"""连接池默认保持的连接数，同时发出的请求超过这个数量时额外的连接用完即关闭"""
+DEFAULT_POOL_SIZE = 10
+"""默认的(连接超时, 读取超时)秒数"""
+DEFAULT_TIMEOUT = (10, 60)
+"""连接失败和网关错误的默认重试次数，POST只在连接没有建立时重试"""
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+RETRY_STATUS = (502, 503, 504)
+"""异步客户端同时进行的最大请求数"""
+DEFAULT_CONCURRENCY = 8
 
 
 class RequestUtils:
@@ -49,3 +66,114 @@ class RequestUtils:
                 for chunk in r.iter_bytes():
                     if chunk:
                         f.write(chunk)
+
+
+class PooledHttpClient:
+    """
+    保持长连接的HTTP客户端，同一个服务的请求复用连接池中的连接，不再每次重新建立TCP和TLS连接
+    每个线程使用自己的Session，共享同一个连接池，多线程同时使用时不会互相影响会话状态
+    """
+
+    def __init__(self, base_url: str, headers: typing.Optional[dict] = None,
+                 pool_size: typing.Optional[int] = None,
+                 timeout: typing.Union[float, typing.Tuple[float, float], None] = None,
+                 retries: typing.Optional[int] = None, retry_backoff: float = DEFAULT_RETRY_BACKOFF):
+        """
+        :param base_url: 服务地址，请求时拼接接口路径
+        :param headers: 每个请求都带上的请求头
+        :param pool_size: 连接池大小
+        :param timeout: 超时秒数，可以是(连接超时, 读取超时)
+        :param retries: 连接失败和网关错误的重试次数
+        :param retry_backoff: 重试的退避系数
+        """
+        self.base_url = base_url.rstrip('/')
+        self.headers = dict(headers or {})
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        retry_policy = Retry(total=DEFAULT_RETRIES if retries is None else retries, backoff_factor=retry_backoff,
+                             status_forcelist=RETRY_STATUS, raise_on_status=False)
+        pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry_policy)
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method: str, api: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, f'{self.base_url}{api}', **kwargs)
+
+    def get(self, api: str, params=None, **kwargs) -> requests.Response:
+        return self.request('GET', api, params=params, **kwargs)
+
+    def post(self, api: str, data=None, **kwargs) -> requests.Response:
+        return self.request('POST', api, data=data, **kwargs)
+
+    def delete(self, api: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', api, **kwargs)
+
+    def close(self):
+        """关闭连接池中的连接"""
+        self.adapter.close()
+
+
+class AsyncHttpClient:
+    """
+    基于httpx.AsyncClient的异步HTTP客户端，保持长连接并限制同时进行的请求数
+    客户端和并发信号量在第一次请求时于当前事件循环中创建，一个实例只能在同一个事件循环中使用，通常是asyncutils的共享循环
+    """
+
+    def __init__(self, base_url: str, headers: typing.Optional[dict] = None,
+                 concurrency: typing.Optional[int] = None,
+                 timeout: typing.Union[float, typing.Tuple[float, float], None] = None,
+                 retries: typing.Optional[int] = None):
+        """
+        :param base_url: 服务地址，请求时拼接接口路径
+        :param headers: 每个请求都带上的请求头
+        :param concurrency: 同时进行的最大请求数
+        :param timeout: 超时秒数，可以是(连接超时, 读取超时)
+        :param retries: 连接失败的重试次数
+        """
+        self.base_url = base_url.rstrip('/')
+        self.headers = dict(headers or {})
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.retries = DEFAULT_RETRIES if retries is None else retries
+        self._client: typing.Optional[httpx.AsyncClient] = None
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            if isinstance(self.timeout, (tuple, list)):
+                timeout = httpx.Timeout(self.timeout[1], connect=self.timeout[0])
+            else:
+                timeout = httpx.Timeout(self.timeout)
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=timeout,
+                                             limits=limits, transport=httpx.AsyncHTTPTransport(retries=self.retries))
+        return self._client
+
+    async def request(self, method: str, api: str, **kwargs) -> httpx.Response:
+        """连接失败转换为requests的ConnectionError，调用方可以和同步客户端一样按RequestException重试"""
+        client = self._ensure_client()
+        async with self._semaphore:
+            try:
+                return await client.request(method, api, **kwargs)
+            except httpx.TransportError as e:
+                raise requests.ConnectionError(str(e)) from e
+
+    async def get(self, api: str, params=None, **kwargs) -> httpx.Response:
+        return await self.request('GET', api, params=params, **kwargs)
+
+    async def aclose(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
@@ -1,15 +1,22 @@
 import collections
 import functools
+import inspect
+import os
 from concurrent.futures import ThreadPoolExecutor
 
+from mbot.core.cache import l1cache
 from mbot.core.config import Config
 import logging
-from typing import OrderedDict
+from typing import OrderedDict, Optional
 from mbot.core.event.eventbus import EventBus
 from mbot.core.event.eventlistener import EventListener
 from mbot.core.plugins import PluginMeta
+from mbot.core.plugins.usage import usage_tracker
+from mbot.common.cacheregistry import cache_registry
 
 _LOGGER = logging.getLogger(__name__)
+"""分级缓存的持久化文件，存放在配置目录中"""
+CACHE_DB_FILENAME = '.cache.db'
 
 
 class MovieBot:
@@ -20,6 +27,8 @@ class MovieBot:
         self.config = Config()
         # 事件总线，系统内所有的事件会通过这里控制
         self.event_bus = EventBus(self)
+        # 事件发生时按规则让缓存失效
+        l1cache.bind_events(self.event_bus)
         # 所有已经加载的插件信息
         self.plugins: OrderedDict[str, PluginMeta] = collections.OrderedDict()
         self.task_manager = None
@@ -31,23 +40,121 @@ class MovieBot:
     def set_task_manager(self, task_manager):
         self.task_manager = task_manager
 
+    def load_config(self, config_dir: str):
+        """
+        加载配置目录，并在目录中开启分级缓存的持久化存储
+        :param config_dir: 配置目录
+        """
+        try:
+            l1cache.open_l2(os.path.join(config_dir, CACHE_DB_FILENAME))
+        except Exception as e:
+            _LOGGER.warning(f'持久化缓存无法开启，只使用内存缓存：{e}')
+        self.config.load_config(config_dir)
+
+    def get_event_metrics(self, event_type=None, group_by_event: bool = False):
+        """
+        获取事件监听器的运行指标，包含调用次数、错误次数、执行中数量和p50/p95/p99耗时
+        :param event_type: 只返回这个事件类型的指标
+        :param group_by_event: 是否按事件类型汇总
+        :return:
+        """
+        if group_by_event:
+            return self.event_bus.metrics.get_event_metrics()
+        return self.event_bus.metrics.get_listener_metrics(event_type)
+
+    def get_event_metrics_prometheus(self) -> str:
+        """以Prometheus文本格式导出事件监听器的运行指标"""
+        return self.event_bus.metrics.to_prometheus()
+
+    def get_plugin_usage(self, plugin_name: Optional[str] = None):
+        """
+        获取插件的资源使用统计
+        :param plugin_name: 插件名，为空时返回全部插件，按CPU耗时从高到低排列
+        :return:
+        """
+        if plugin_name:
+            return [usage_tracker.get(plugin_name)]
+        return usage_tracker.get_all()
+
+    def get_cache_stats(self, pattern: Optional[str] = None):
+        """
+        获取进程内已注册缓存的统计，包含命中、未命中、淘汰次数、条目数、估算内存占用和加载耗时
+        :param pattern: 缓存名称，支持*通配，例如l1cache.*，为空时返回全部
+        :return:
+        """
+        return cache_registry.get_stats(pattern)
+
+    def purge_cache(self, pattern: str):
+        """
+        清空缓存
+        :param pattern: 缓存名称，支持*通配
+        :return: 被清空的缓存名称
+        """
+        return cache_registry.purge(pattern)
+
+    def reset_cache_stats(self, pattern: Optional[str] = None):
+        """清零缓存的命中和加载统计，调整maxsize、ttl后重新观察"""
+        cache_registry.reset_stats(pattern)
+
+    def set_plugin_memory_sampling(self, sample_every: Optional[int]):
+        """
+        开启或关闭插件内存分配统计，开启后使用tracemalloc，有额外的性能开销
+        :param sample_every: 每隔多少次调用抽样一次，为空时关闭
+        """
+        if sample_every:
+            usage_tracker.enable_memory(sample_every)
+        else:
+            usage_tracker.disable_memory()
+
+    def set_slow_listener_threshold(self, threshold_ms: Optional[float]):
+        """
+        设置慢监听器的日志阈值，监听器单次执行超过这个毫秒数时打印日志
+        :param threshold_ms: 为空时关闭检查
+        """
+        self.event_bus.metrics.slow_threshold_ms = threshold_ms
+
     def on_event(
             self,
             bind_event,
-            order: int = 100
+            order: int = 100,
+            concurrency: Optional[int] = None,
+            queue_size: Optional[int] = None,
+            overflow: Optional[str] = None,
+            coalesce_key=None,
+            batch: bool = False,
+            max_batch: Optional[int] = None,
+            max_wait_ms: Optional[float] = None,
+            isolated: bool = False,
+            when=None
     ):
         """
         程序内部用的事件订阅装饰函数，插件不要直接使用这个方法
         :param bind_event:
         :param order:
+        :param concurrency: 后台投递时同时执行的最大数量
+        :param queue_size: 后台投递队列的最大长度
+        :param overflow: 队列满时的处理策略：drop_oldest（默认）、coalesce、block（发布方最多等待1秒）
+        :param coalesce_key: coalesce策略下的合并键，事件数据的字段名或计算函数
+        :param batch: 是否为批量监听器，批量监听器收到的事件数据是一个列表
+        :param max_batch: 批量监听器单批的最大数量
+        :param max_wait_ms: 批量监听器后台攒批时最多等待的毫秒数
+        :param isolated: 是否在独立的进程池中执行，适合CPU密集的处理；函数需要定义在模块顶层，事件数据需要可以被pickle
+        :param when: 事件数据需要满足的条件，不满足时不调用；可以是判断函数，或者字段到期望值的字典，如{'type': 'Movie'}，
+        字段支持用.访问嵌套数据，期望值可以是单个值、可选值的列表或判断函数
         :return:
         """
         def decorator(func):
-            @functools.wraps(func)
-            def wrap(*args, **kwargs):
-                return func(*args, **kwargs)
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrap(*args, **kwargs):
+                    return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrap(*args, **kwargs):
+                    return func(*args, **kwargs)
 
-            listener = EventListener(wrap, bind_event, order)
+            listener = EventListener(wrap, bind_event, order, concurrency, queue_size, overflow, coalesce_key, batch,
+                                     max_batch, max_wait_ms, isolated, when)
             self.event_bus.add_listener(listener)
             return wrap
 
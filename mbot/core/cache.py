@@ -1,15 +1,624 @@
-from cacheout import CacheManager, LFUCache
-
-l1cache: CacheManager = CacheManager(
-    {
-        'douban_media': {
-            'maxsize': 100,
-            'ttl': 86400
-        },
-        'media_image': {
-            'maxsize': 1024,
-            'ttl': 21600
-        }
-    },
-    cache_class=LFUCache
-)
+"""
+分级缓存
+L1是进程内的cacheout缓存，L2是本地SQLite文件中的持久化缓存，重启后L1未命中时从L2恢复，不需要再次访问豆瓣、媒体服务器；
+每个命名空间单独声明容量、过期时间和淘汰策略；
+get_or_load在数据过期但仍处于陈旧宽限期时先返回旧数据，同时在后台刷新；同一个键并发未命中时只调用一次加载函数
+"""
+import functools
+import inspect
+import logging
+import math
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+from cacheout import Cache, FIFOCache, LFUCache, LIFOCache, LRUCache, MRUCache, RRCache
+
+from mbot.common.cacheregistry import CacheStats, LoadStats, approx_items_bytes, cache_registry
+
+_LOGGER = logging.getLogger(__name__)
+
+"""命名空间没有声明时的默认容量"""
+DEFAULT_MAXSIZE = 256
+"""L2默认保留的条目数是L1容量的倍数"""
+L2_SIZE_FACTOR = 10
+"""L2每写入多少次检查一次容量"""
+L2_TRIM_EVERY = 200
+"""后台刷新陈旧数据的线程数"""
+REVALIDATE_WORKERS = 2
+"""cached装饰器默认的有效秒数"""
+DEFAULT_CACHED_TTL = 60
+
+_MISSING = object()
+
+
+class _CachedNone:
+    """被缓存的None结果，pickle后按名称还原为同一个对象"""
+
+    def __reduce__(self):
+        return '_CACHED_NONE'
+
+    def __repr__(self):
+        return '_CACHED_NONE'
+
+
+_CACHED_NONE = _CachedNone()
+
+
+def _unwrap(value):
+    return None if value is _CACHED_NONE else value
+
+
+def _is_negative(value) -> bool:
+    """是否为没有找到的结果：None或者空容器"""
+    return value is None or (isinstance(value, (list, tuple, dict, set)) and not value)
+
+
+class CachePolicy(str, Enum):
+    LFU = 'lfu'
+    LRU = 'lru'
+    FIFO = 'fifo'
+    LIFO = 'lifo'
+    MRU = 'mru'
+    RR = 'rr'
+
+
+_POLICY_CLASSES: Dict[CachePolicy, typing.Type[Cache]] = {
+    CachePolicy.LFU: LFUCache,
+    CachePolicy.LRU: LRUCache,
+    CachePolicy.FIFO: FIFOCache,
+    CachePolicy.LIFO: LIFOCache,
+    CachePolicy.MRU: MRUCache,
+    CachePolicy.RR: RRCache,
+}
+
+
+class NamespaceConfig:
+    """命名空间的缓存策略"""
+
+    def __init__(self, name: str, maxsize: int = DEFAULT_MAXSIZE, ttl: float = 0,
+                 policy: typing.Union[CachePolicy, str] = CachePolicy.LFU, persistent: bool = True,
+                 stale_ttl: float = 0, l2_maxsize: Optional[int] = None):
+        """
+        :param name: 命名空间
+        :param maxsize: L1容量
+        :param ttl: 数据的有效秒数，为0时不过期
+        :param policy: L1容量满时的淘汰策略
+        :param persistent: 是否写入L2，值需要可以被pickle
+        :param stale_ttl: 过期后仍然可以先返回旧数据、同时后台刷新的秒数
+        :param l2_maxsize: L2保留的条目数，为空时为L1容量的L2_SIZE_FACTOR倍
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl or 0
+        self.policy = CachePolicy(policy)
+        self.persistent = persistent
+        self.stale_ttl = stale_ttl or 0
+        self.l2_maxsize = l2_maxsize or maxsize * L2_SIZE_FACTOR
+
+
+class _Entry:
+    __slots__ = ('value', 'fresh_until')
+
+    def __init__(self, value, fresh_until: float):
+        self.value = value
+        self.fresh_until = fresh_until
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.fresh_until
+
+
+class L2Store:
+    """基于SQLite的持久化缓存，键和值使用pickle序列化"""
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        path = os.path.dirname(filepath)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache_entry (namespace TEXT NOT NULL, key BLOB NOT NULL, '
+                           'value BLOB NOT NULL, expires_at REAL, updated_at REAL NOT NULL, '
+                           'PRIMARY KEY (namespace, key))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entry_updated ON cache_entry (namespace, updated_at)')
+        self._writes: Dict[str, int] = dict()
+
+    @staticmethod
+    def _key(key: Hashable) -> bytes:
+        return pickle.dumps(key, protocol=4)
+
+    def get(self, namespace: str, key: Hashable) -> Optional[Tuple[Any, Optional[float]]]:
+        """:return: (值, 彻底过期的时间戳)，不存在或者已经彻底过期时返回None"""
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM cache_entry WHERE namespace=? AND key=?',
+                                     (namespace, self._key(key))).fetchone()
+        if not row:
+            return
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return
+        try:
+            return pickle.loads(value), expires_at
+        except Exception as e:
+            _LOGGER.warning(f'L2缓存数据无法读取，已经忽略：{namespace}')
+            self.delete(namespace, key)
+            return
+
+    def set(self, namespace: str, key: Hashable, value, expires_at: Optional[float], maxsize: Optional[int] = None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO cache_entry (namespace, key, value, expires_at, updated_at) '
+                               'VALUES (?, ?, ?, ?, ?)', (namespace, self._key(key), data, expires_at, time.time()))
+            writes = self._writes[namespace] = self._writes.get(namespace, 0) + 1
+            if maxsize and writes % L2_TRIM_EVERY == 0:
+                self._trim(namespace, maxsize)
+
+    def _trim(self, namespace: str, maxsize: int):
+        """删除已经过期的条目，超出容量时删除最早写入的条目，调用方持有锁"""
+        self._conn.execute('DELETE FROM cache_entry WHERE namespace=? AND expires_at IS NOT NULL AND expires_at<=?',
+                           (namespace, time.time()))
+        self._conn.execute('DELETE FROM cache_entry WHERE namespace=? AND key IN (SELECT key FROM cache_entry '
+                           'WHERE namespace=? ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+                           (namespace, namespace, maxsize))
+
+    def delete(self, namespace: str, key: Hashable):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache_entry WHERE namespace=? AND key=?', (namespace, self._key(key)))
+
+    def delete_prefix(self, namespace: str, prefix: str) -> int:
+        """删除以prefix开头的字符串键，键是pickle后保存的，需要逐条还原比较"""
+        with self._lock:
+            rows = self._conn.execute('SELECT key FROM cache_entry WHERE namespace=?', (namespace,)).fetchall()
+            keys = []
+            for (raw,) in rows:
+                try:
+                    key = pickle.loads(raw)
+                except Exception as e:
+                    continue
+                if isinstance(key, str) and key.startswith(prefix):
+                    keys.append((namespace, raw))
+            if keys:
+                self._conn.executemany('DELETE FROM cache_entry WHERE namespace=? AND key=?', keys)
+            return len(keys)
+
+    def clear(self, namespace: Optional[str] = None):
+        with self._lock:
+            if namespace:
+                self._conn.execute('DELETE FROM cache_entry WHERE namespace=?', (namespace,))
+            else:
+                self._conn.execute('DELETE FROM cache_entry')
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM cache_entry WHERE namespace=?', (namespace,)).fetchone()[0]
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._conn.execute('DELETE FROM cache_entry WHERE expires_at IS NOT NULL AND expires_at<=?',
+                                      (time.time(),)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TieredCache:
+    """一个命名空间的分级缓存，常用方法与cacheout.Cache保持一致"""
+
+    def __init__(self, config: NamespaceConfig, manager: "TieredCacheManager"):
+        self.config = config
+        self.name = config.name
+        self._manager = manager
+        ttl = config.ttl + config.stale_ttl if config.ttl else 0
+        self.l1: Cache = _POLICY_CLASSES[config.policy](maxsize=config.maxsize, ttl=ttl, enable_stats=True)
+        self._lock = threading.Lock()
+        # 键 -> (加载结果, 执行加载的线程)
+        self._inflight: Dict[Hashable, Tuple[Future, int]] = dict()
+        # L1和L2都算命中，陈旧数据在get_or_load中也算命中
+        self._hits = 0
+        self._misses = 0
+        self._loads = LoadStats()
+
+    @property
+    def l2(self) -> Optional[L2Store]:
+        return self._manager.l2 if self.config.persistent else None
+
+    def _fresh_until(self, now: float, ttl: Optional[float]) -> float:
+        ttl = self.config.ttl if ttl is None else ttl
+        return now + ttl if ttl else math.inf
+
+    def _lookup(self, key: Hashable) -> Optional[_Entry]:
+        """先查L1，未命中时查L2并放回L1，返回的数据可能已经陈旧"""
+        entry = self.l1.get(key)
+        if entry is not None:
+            return entry
+        l2 = self.l2
+        if l2 is None:
+            return
+        try:
+            found = l2.get(self.name, key)
+        except Exception as e:
+            _LOGGER.warning(f'读取L2缓存失败：{self.name}', exc_info=True)
+            return
+        if not found:
+            return
+        value, expires_at = found
+        fresh_until = expires_at - self.config.stale_ttl if expires_at is not None else math.inf
+        entry = _Entry(value, fresh_until)
+        self.l1.set(key, entry, ttl=max(expires_at - time.time(), 0.001) if expires_at is not None else 0)
+        return entry
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, key: Hashable, default=None):
+        """获取没有过期的数据"""
+        entry = self._lookup(key)
+        if entry is None or not entry.is_fresh(time.time()):
+            self._count(False)
+            return default
+        self._count(True)
+        return _unwrap(entry.value)
+
+    def has(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key: Hashable, value, ttl: Optional[float] = None):
+        """
+        写入数据
+        :param ttl: 有效秒数，为空时使用命名空间的设置
+        """
+        now = time.time()
+        fresh_until = self._fresh_until(now, ttl)
+        entry = _Entry(value, fresh_until)
+        expires_at = fresh_until + self.config.stale_ttl if fresh_until != math.inf else None
+        self.l1.set(key, entry, ttl=expires_at - now if expires_at is not None else 0)
+        l2 = self.l2
+        if l2 is not None:
+            try:
+                l2.set(self.name, key, value, expires_at, self.config.l2_maxsize)
+            except Exception as e:
+                _LOGGER.warning(f'写入L2缓存失败：{self.name} {e}')
+
+    def delete(self, key: Hashable):
+        self.l1.delete(key)
+        if self.l2 is not None:
+            self.l2.delete(self.name, key)
+
+    def clear(self):
+        self.l1.clear()
+        if self.l2 is not None:
+            self.l2.clear(self.name)
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        """
+        删除以prefix开头的字符串键，prefix为空时清空整个命名空间
+        :return: 删除的L1条目数
+        """
+        if not prefix:
+            count = self.l1.size()
+            self.clear()
+            return count
+        keys = [k for k in self.l1.keys() if isinstance(k, str) and k.startswith(prefix)]
+        self.l1.delete_many(keys)
+        if self.l2 is not None:
+            try:
+                self.l2.delete_prefix(self.name, prefix)
+            except Exception as e:
+                _LOGGER.warning(f'删除L2缓存失败：{self.name} {e}')
+        return len(keys)
+
+    def size(self) -> int:
+        return self.l1.size()
+
+    def keys(self):
+        return self.l1.keys()
+
+    def _single_flight(self, key: Hashable, fn: Callable[[], Any]):
+        """同一个键同时只执行一次fn，其他调用等待并共享结果；加载过程中同一个线程再次加载这个键时直接执行"""
+        thread_id = threading.get_ident()
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                future = Future()
+                self._inflight[key] = (future, thread_id)
+        if inflight is not None:
+            future, owner = inflight
+            if owner == thread_id:
+                return fn()
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float], negative_ttl: Optional[float]):
+        with self._loads.timed():
+            value = loader()
+        if negative_ttl is not None and _is_negative(value):
+            if negative_ttl > 0:
+                self.set(key, _CACHED_NONE if value is None else value, negative_ttl)
+        elif value is not None:
+            self.set(key, value, ttl)
+        return value
+
+    def _revalidate(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float],
+                    negative_ttl: Optional[float]):
+        with self._lock:
+            if key in self._inflight:
+                return
+
+        def refresh():
+            try:
+                self._single_flight(key, lambda: self._load(key, loader, ttl, negative_ttl))
+            except Exception as e:
+                _LOGGER.warning(f'后台刷新缓存失败，继续使用旧数据：{self.name} {key} {e}')
+
+        self._manager.executor.submit(refresh)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None,
+                    negative_ttl: Optional[float] = None):
+        """
+        获取数据，未命中时调用loader加载并写入缓存；数据已经过期但仍在陈旧宽限期内时，先返回旧数据并在后台刷新
+        :param loader: 没有参数的加载函数，返回None时不缓存
+        :param ttl: 有效秒数，为空时使用命名空间的设置
+        :param negative_ttl: 没有找到的结果（None或空容器）的有效秒数，为0时不缓存，为空时与其他结果一样处理
+        """
+        entry = self._lookup(key)
+        self._count(entry is not None)
+        if entry is not None:
+            if not entry.is_fresh(time.time()):
+                self._revalidate(key, loader, ttl, negative_ttl)
+            return _unwrap(entry.value)
+        return self._single_flight(key, lambda: self._load(key, loader, ttl, negative_ttl))
+
+    def cache_stats(self) -> CacheStats:
+        items = self.l1.items()
+        size = len(items)
+        l2_size = None
+        if self.l2 is not None:
+            try:
+                l2_size = self.l2.count(self.name)
+            except Exception as e:
+                _LOGGER.warning(f'读取L2缓存条目数失败：{self.name} {e}')
+        stats = CacheStats(self.name, 'tiered', size=size, maxsize=self.config.maxsize, ttl=self.config.ttl,
+                           hits=self._hits, misses=self._misses, evictions=self.l1.stats.info().eviction_count,
+                           approx_bytes=approx_items_bytes(((k, e.value) for k, e in items), size),
+                           l2_size=l2_size)
+        return self._loads.fill(stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._hits = self._misses = 0
+        self.l1.stats.reset()
+        self._loads.reset()
+
+
+class TieredCacheManager:
+    """按命名空间管理分级缓存，l1cache['xxx']获取命名空间的缓存"""
+
+    def __init__(self, registry_name: Optional[str] = None):
+        """
+        :param registry_name: 命名空间以"registry_name.命名空间"注册到缓存注册表，为空时不注册
+        """
+        self.registry_name = registry_name
+        self._namespaces: Dict[str, TieredCache] = dict()
+        self._lock = threading.Lock()
+        self.l2: Optional[L2Store] = None
+        self.executor = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS, thread_name_prefix='CacheRevalidate')
+        # 事件类型 -> [(命名空间, 键前缀或者根据事件数据计算键前缀的函数)]
+        self._invalidation_rules: Dict[str, List[Tuple[str, Union[str, Callable]]]] = dict()
+
+    def declare(self, name: str, maxsize: int = DEFAULT_MAXSIZE, ttl: float = 0,
+                policy: typing.Union[CachePolicy, str] = CachePolicy.LFU, persistent: bool = True,
+                stale_ttl: float = 0, l2_maxsize: Optional[int] = None) -> TieredCache:
+        """声明一个命名空间，参数见NamespaceConfig；重复声明时替换策略并清空L1"""
+        config = NamespaceConfig(name, maxsize, ttl, policy, persistent, stale_ttl, l2_maxsize)
+        cache = TieredCache(config, self)
+        with self._lock:
+            self._namespaces[name] = cache
+        self._register(cache)
+        return cache
+
+    def _register(self, cache: TieredCache):
+        if self.registry_name:
+            cache_registry.register(f'{self.registry_name}.{cache.name}', cache)
+
+    def namespace(self, name: str, **options):
+        """
+        以装饰器的方式声明命名空间，被装饰的函数成为这个命名空间的加载函数：
+        函数只接收一个参数作为缓存的键，调用时先查缓存，未命中时才执行函数
+        """
+        cache = self.declare(name, **options)
+
+        def decorator(func: Callable[[Hashable], Any]):
+            def wrapper(key: Hashable):
+                return cache.get_or_load(key, lambda: func(key))
+
+            wrapper.__name__ = getattr(func, '__name__', name)
+            wrapper.__doc__ = func.__doc__
+            wrapper.__wrapped__ = func
+            wrapper.cache = cache
+            return wrapper
+
+        return decorator
+
+    def __getitem__(self, name: str) -> TieredCache:
+        cache = self._namespaces.get(name)
+        if cache is None:
+            created = False
+            # 与cacheout一致，没有声明的命名空间使用默认策略自动创建
+            with self._lock:
+                cache = self._namespaces.get(name)
+                if cache is None:
+                    cache = self._namespaces[name] = TieredCache(NamespaceConfig(name), self)
+                    created = True
+            if created:
+                self._register(cache)
+        return cache
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._namespaces
+
+    def cache_names(self) -> List[str]:
+        return list(self._namespaces.keys())
+
+    def caches(self) -> List[TieredCache]:
+        return list(self._namespaces.values())
+
+    def clear_all(self):
+        for cache in self.caches():
+            cache.clear()
+
+    def invalidate(self, namespace: str, prefix: str = '') -> int:
+        """
+        按键前缀让缓存失效
+        :param prefix: 键前缀，为空时清空整个命名空间
+        :return: 删除的L1条目数
+        """
+        cache = self._namespaces.get(namespace)
+        if cache is None:
+            return 0
+        return cache.invalidate_prefix(prefix)
+
+    def invalidate_on(self, event_type, namespace: str,
+                      prefix: Union[str, Callable[[Any], Union[str, Iterable[str], None]]] = ''):
+        """
+        事件发生时按键前缀让缓存失效
+        :param event_type: 事件类型
+        :param namespace: 命名空间
+        :param prefix: 键前缀，或者接收事件数据、返回一个或多个键前缀的函数，函数返回None时不处理，返回空字符串时清空整个命名空间
+        """
+        event_type = str(event_type)
+        with self._lock:
+            rules = self._invalidation_rules.get(event_type) or []
+            self._invalidation_rules[event_type] = rules + [(namespace, prefix)]
+
+    def bind_events(self, event_bus):
+        """以观察者的方式接入事件总线，事件发布时在所有监听器之前让缓存失效，监听器读到的都是新数据"""
+        event_bus.add_observer(self._on_event)
+
+    def _on_event(self, event_type: str, data):
+        rules = self._invalidation_rules.get(str(event_type))
+        if not rules:
+            return
+        for namespace, prefix in rules:
+            prefixes = prefix(data) if callable(prefix) else prefix
+            if prefixes is None:
+                continue
+            if isinstance(prefixes, str):
+                prefixes = [prefixes]
+            for p in prefixes:
+                count = self.invalidate(namespace, p)
+                _LOGGER.debug(f'事件{event_type}触发缓存失效：{namespace} {p or "*"}，删除{count}条')
+
+    def open_l2(self, filepath: str):
+        """
+        开启L2持久化缓存，通常在确定配置目录后调用
+        :param filepath: SQLite文件路径
+        """
+        if self.l2 is not None:
+            self.l2.close()
+        self.l2 = L2Store(filepath)
+        purged = self.l2.purge_expired()
+        _LOGGER.info(f'持久化缓存已经开启：{filepath}，清理过期数据{purged}条')
+
+    def close_l2(self):
+        l2, self.l2 = self.l2, None
+        if l2 is not None:
+            l2.close()
+
+
+l1cache: TieredCacheManager = TieredCacheManager('l1cache')
+l1cache.declare('douban_media', maxsize=100, ttl=86400, policy=CachePolicy.LFU)
+l1cache.declare('media_image', maxsize=1024, ttl=21600, policy=CachePolicy.LFU)
+
+
+def cache_namespace(name: str, **options):
+    """在全局缓存中以装饰器的方式声明命名空间，参数见TieredCacheManager.namespace"""
+    return l1cache.namespace(name, **options)
+
+
+def cache_key_prefix(func_name: str, *args) -> str:
+    """cached装饰器生成的键的前缀，用于按函数名和前几个参数让缓存失效"""
+    return ''.join(f'{x}:' for x in (func_name,) + args)
+
+
+def _signature_key(func: Callable) -> Callable[..., str]:
+    """
+    按函数签名生成缓存键：函数名:参数1:参数2:...，补齐默认参数，按位置传参和按名称传参得到同一个键
+    方法的self不参与前缀，以@对象标识附加在末尾，对象可以用cache_scope属性指定标识
+    """
+    sig = inspect.signature(func)
+    params = list(sig.parameters)
+    is_method = bool(params) and params[0] in ('self', 'cls')
+
+    def make_key(*args, **kwargs) -> str:
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = list(bound.arguments.values())
+        if not is_method:
+            return cache_key_prefix(func.__name__, *values)
+        owner = values.pop(0)
+        scope = getattr(owner, 'cache_scope', None) or f'{type(owner).__name__}#{id(owner):x}'
+        return f'{cache_key_prefix(func.__name__, *values)}@{scope}'
+
+    return make_key
+
+
+def cached(namespace: str, ttl: float = DEFAULT_CACHED_TTL, negative_ttl: float = 0,
+           key: Optional[Callable[..., Hashable]] = None, maxsize: int = DEFAULT_MAXSIZE, stale_ttl: float = 0,
+           persistent: bool = False, manager: Optional[TieredCacheManager] = None):
+    """
+    缓存函数的返回结果，同样参数的并发调用只执行一次，没有找到的结果（None或空容器）按negative_ttl短暂缓存
+    可以用cache_key_prefix(函数名, 参数...)得到的前缀配合invalidate、invalidate_on主动失效；
+    list结果每次返回浅拷贝，调用方增删元素不会影响缓存，元素本身仍然是共享的，不要修改
+    :param namespace: 命名空间，没有声明过时按参数声明，多个函数可以共用
+    :param ttl: 有效秒数
+    :param negative_ttl: 没有找到的结果的有效秒数，为0时不缓存
+    :param key: 根据调用参数生成缓存键的函数，为空时按函数签名生成
+    :param maxsize: 声明命名空间时的容量
+    :param stale_ttl: 声明命名空间时的陈旧宽限秒数
+    :param persistent: 声明命名空间时是否写入L2
+    :param manager: 缓存管理器，为空时使用l1cache
+    """
+
+    def decorator(func):
+        mgr = manager or l1cache
+        cache = mgr[namespace] if namespace in mgr else mgr.declare(namespace, maxsize=maxsize, ttl=ttl,
+                                                                    persistent=persistent, stale_ttl=stale_ttl)
+        make_key = key or _signature_key(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = cache.get_or_load(make_key(*args, **kwargs), lambda: func(*args, **kwargs), ttl, negative_ttl)
+            return list(result) if isinstance(result, list) else result
+
+        def invalidate(*args, **kwargs):
+            """让指定参数的缓存失效"""
+            cache.delete(make_key(*args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
@@ -1,15 +1,32 @@
 import json
+import logging
+import multiprocessing
 import os.path
+import threading
 import typing
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 
 import yaml
 
+from mbot.core.configstore import ConfigStore, ConfigSnapshot, DELETE
 from mbot.exceptions import UnsupportedOperationException, SiteErrorException
 
+_LOGGER = logging.getLogger(__name__)
+
 """默认配置的文件名称"""
 BASE_CONFIG_FILENAME = 'base_config.yml'
 PLUGINS_CONFIG_FILENAME = 'plugins_config.yml'
+"""解析后的站点配置缓存文件，存放在配置目录中"""
+SITE_CONFIG_CACHE_FILENAME = '.site_config.cache.json'
+"""站点配置缓存的格式版本，格式变化时旧缓存自动失效"""
+SITE_CONFIG_CACHE_VERSION = 2
+"""需要解析的站点配置文件达到这个数量时使用多进程并行解析"""
+SITE_CONFIG_PARALLEL_THRESHOLD = 32
+"""并行解析站点配置的最大进程数"""
+SITE_CONFIG_MAX_WORKERS = 4
+"""优先使用libyaml的C实现解析，结果与纯Python实现一致"""
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 """默认的基础配置文件内容"""
 DEFAULT_BASE = {
     'server': {},
@@ -84,28 +101,111 @@ def load_json_config(config_path: str):
 
 
 class ConfigValues(dict):
-    """封装后的配置文件内容，可以config.xxx 打点调用属性值；同时增加了一些配置文件操作方法"""
+    """
+    封装后的配置文件内容，可以config.xxx 打点调用属性值；同时增加了一些配置文件操作方法
+    频繁读取配置的地方应该使用snapshot()返回的不可变快照，读取不加锁，也不会在读取时包装和修改配置；
+    修改配置（包括打点读取到的子配置）时只把被修改的分支写入新的快照，并通知通过subscribe订阅了发生变化路径的回调
+    """
 
-    def __init__(self, data: dict, config_filepath=None):
+    def __init__(self, data: dict, config_filepath=None, parent: typing.Optional['ConfigValues'] = None,
+                 key=None):
         self._config_filepath = config_filepath
+        # 配置版本号，任意一层被修改或保存时递增，用于让依赖配置的缓存判断是否失效
+        self._version = 0
+        # 打点读取时包装出来的子配置记录上级和自己在上级中的键，子配置的修改同时发布到上级
+        self._parent = parent
+        self._key = key
+        self._lock = threading.RLock()
+        # 配置快照，第一次使用快照、订阅或者保存时创建
+        self._store: typing.Optional[ConfigStore] = None
         super().__init__(data)
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed([((key,), value)])
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed([((key,), DELETE)])
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        super().update(items)
+        if items:
+            self._changed([((k,), v) for k, v in items.items()])
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super().pop(key, *args)
+        value = super().pop(key)
+        self._changed([((key,), DELETE)])
+        return value
+
+    def _bump(self):
+        self._version += 1
+        parent = self._parent
+        if parent is not None and dict.get(parent, self._key) is self:
+            parent._bump()
+
+    def _changed(self, changes: typing.List[typing.Tuple[tuple, Any]]):
+        """
+        递增版本号，并把被修改的键写入快照，快照只重新冻结被修改的分支；已经不在上级中的子配置不再向上发布
+        :param changes: (从当前配置到被修改位置的键, 新值)的列表，新值为DELETE时表示删除
+        """
+        self._version += 1
+        if self._store is not None:
+            self._store.set_paths(changes)
+        parent = self._parent
+        if parent is not None and dict.get(parent, self._key) is self:
+            parent._changed([((self._key,) + keys, value) for keys, value in changes])
+
+    def get_store(self) -> ConfigStore:
+        store = self._store
+        if store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = ConfigStore(self, self._config_filepath)
+                store = self._store
+        return store
+
+    def snapshot(self) -> ConfigSnapshot:
+        """当前配置的不可变快照"""
+        return self.get_store().snapshot
+
+    def subscribe(self, path: str, callback: typing.Callable[[ConfigSnapshot, typing.List[str]], Any]):
+        """
+        订阅配置的变化
+        :param path: 键路径，例如web.port，为空时订阅全部变化
+        :param callback: 接收新快照和发生变化的键路径
+        :return: 取消订阅的函数
+        """
+        return self.get_store().subscribe(path, callback)
+
+    def get_version(self) -> int:
+        return self._version
+
     def __setattr__(self, key, value):
         if str(key).startswith('_'):
             super().__setattr__(key, value)
             return
-        self.update({key: value})
+        self[key] = value
 
     def __getattr__(self, attr) -> Any:
         result = self.get(attr)
-        if result and not isinstance(result, ConfigValues):
-            if isinstance(result, dict):
-                self.update({attr: ConfigValues(result)})
-            else:
-                return result
-            return self.get(attr)
-        else:
-            return result
+        if result and not isinstance(result, ConfigValues) and isinstance(result, dict):
+            # 包装后写回，之后对子配置的修改才能在保存时生效；写回在锁内完成，并发读取拿到的是同一个包装对象
+            with self._lock:
+                result = self.get(attr)
+                if not isinstance(result, ConfigValues) and isinstance(result, dict):
+                    result = ConfigValues(result, parent=self, key=attr)
+                    dict.__setitem__(self, attr, result)
+        return result
 
     def exists(self):
         return os.path.exists(self._config_filepath)
@@ -135,33 +235,39 @@ class ConfigValues(dict):
             return data
         return new_data
 
-    def save(self):
+    def save(self, delay: float = 0):
         """
-        保存配置
+        保存配置，写入临时文件后原子替换；指定delay时一段时间内的多次保存合并为一次写入
+        :param delay: 合并修改的等待秒数，默认为0立即写入
         :return:
         """
-        if not self._config_filepath:
-            return
-        path = os.path.dirname(self._config_filepath)
-        if not os.path.exists(self._config_filepath) and not os.path.exists(path):
-            os.makedirs(path)
-        with open(self._config_filepath, "w",
-                  encoding="utf-8") as f:
-            yaml.dump(self._to_dict(self.copy()), f, default_style=False, encoding='utf-8', allow_unicode=True)
+        store = self.get_store()
+        # 经过ConfigValues的修改已经写入快照；直接修改原始dict的子配置（例如config['web']['port']）无法被跟踪，
+        # 保存时和快照整体对比一次把它们补上，有变化时才递增版本号，快照已经在对比时更新，所以不经过_changed
+        if store.replace(self):
+            self._bump()
+        store.save(delay)
+
+    def flush(self):
+        """立即写入还没有保存的修改"""
+        if self._store is not None:
+            self._store.flush()
 
 
 class SiteConfig(ConfigValues):
-    def __init__(self, config_filepath: str):
+    def __init__(self, config_filepath: str, data: typing.Optional[dict] = None,
+                 ext_data: typing.Optional[typing.Dict[str, typing.Any]] = None):
+        """
+        :param config_filepath: 站点适配文件
+        :param data: 已经解析好的配置内容，例如来自缓存，为空时读取并解析文件
+        :param ext_data: 已经解析好的#!DATA扩展数据
+        """
         self._ext_data: typing.Dict[str, typing.Any] = dict()
+        if data is None:
+            data, ext_data = read_site_file(config_filepath)
+        self._ext_data.update(ext_data or {})
+        super().__init__(data)
         self.config_filepath = config_filepath
-        try:
-            with open(config_filepath, 'r', encoding='utf-8') as file:
-                lines = file.readlines()
-                user_config = yaml.safe_load(''.join(lines))
-                self._parse_ext_data(lines)
-        except Exception as e:
-            raise SiteErrorException(f'站点适配文件错误，请检查文件是否标准yml文件，没有掺杂无效信息：{config_filepath}')
-        super().__init__(user_config)
 
     @staticmethod
     def _parse_ext_data_var(l):
@@ -178,17 +284,23 @@ class SiteConfig(ConfigValues):
     def _line_is_ext_data(l):
         return l.startswith('#!DATA')
 
-    def _parse_ext_data(self, lines: typing.List[str]):
+    @staticmethod
+    def parse_ext_data(lines: typing.List[str]) -> typing.Dict[str, typing.Any]:
+        ext_data = dict()
         if not lines:
-            return
+            return ext_data
         for l in lines:
             l = l.strip()
-            if not self._line_is_ext_data(l):
+            if not SiteConfig._line_is_ext_data(l):
                 continue
-            var = self._parse_ext_data_var(l)
+            var = SiteConfig._parse_ext_data_var(l)
             if not var:
                 continue
-            self._ext_data.update(var)
+            ext_data.update(var)
+        return ext_data
+
+    def _parse_ext_data(self, lines: typing.List[str]):
+        self._ext_data.update(self.parse_ext_data(lines))
 
     def ext_data_to_text(self):
         if not self._ext_data and len(self._ext_data.keys()):
@@ -217,14 +329,105 @@ class SiteConfig(ConfigValues):
         if update_file:
             if not update:
                 lines.insert(0, f'#!DATA {key}={value}\n')
-            with open(self.config_filepath, 'w', encoding='utf-8') as file:
+            # 写入临时文件后替换，中途失败不会留下写了一半的适配文件
+            tmp = f'{self.config_filepath}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as file:
                 file.writelines(lines)
+            os.replace(tmp, self.config_filepath)
         self._ext_data.update({key: value})
 
     def save(self):
         raise UnsupportedOperationException('站点配置文件不支持直接修改')
 
 
+def read_site_file(filepath: str) -> typing.Tuple[dict, typing.Dict[str, typing.Any]]:
+    """读取并解析站点适配文件，返回配置内容和#!DATA扩展数据"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as file:
+            lines = file.readlines()
+        data = yaml.load(''.join(lines), Loader=_YAML_LOADER)
+        if not isinstance(data, dict):
+            raise ValueError('site config is not a mapping')
+        return data, SiteConfig.parse_ext_data(lines)
+    except Exception as e:
+        raise SiteErrorException(f'站点适配文件错误，请检查文件是否标准yml文件，没有掺杂无效信息：{filepath}')
+
+
+def _stat_key(st: os.stat_result) -> typing.Tuple[int, int]:
+    return st.st_mtime_ns, st.st_size
+
+
+def _parse_site_file(item: typing.Tuple[str, typing.Tuple[int, int]]):
+    """在工作进程中解析站点适配文件，解析失败时返回错误信息而不是抛出异常"""
+    filepath, key = item
+    try:
+        data, ext_data = read_site_file(filepath)
+        return filepath, key, data, ext_data, None
+    except SiteErrorException as e:
+        return filepath, key, None, None, str(e)
+
+
+class SiteConfigCache:
+    """
+    解析后的站点配置缓存，按文件路径、修改时间和大小判断是否还有效，以JSON格式存放在配置目录中；
+    缓存文件只当作数据读取，不会像pickle一样在加载时执行代码
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # 文件路径 -> ([修改时间, 大小], 配置内容, 扩展数据)
+        self.entries: typing.Dict[str, tuple] = dict()
+        self.dirty = False
+
+    def load(self):
+        self.entries = dict()
+        self.dirty = False
+        if not os.path.exists(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if isinstance(cached, dict) and cached.get('version') == SITE_CONFIG_CACHE_VERSION:
+                self.entries = cached.get('entries') or dict()
+        except Exception as e:
+            _LOGGER.warning(f'站点配置缓存损坏，将重新解析全部站点配置：{self.filepath}')
+
+    def get(self, filepath: str, key: typing.Tuple[int, int]):
+        entry = self.entries.get(filepath)
+        if not entry or tuple(entry[0]) != tuple(key):
+            return
+        return entry[1], entry[2]
+
+    def put(self, filepath: str, key: typing.Tuple[int, int], data, ext_data):
+        try:
+            # 含有日期、非字符串键等JSON无法原样保存的内容时不缓存，下次启动重新解析
+            if json.loads(json.dumps([data, ext_data], ensure_ascii=False)) != [data, ext_data]:
+                return
+        except (TypeError, ValueError):
+            return
+        self.entries[filepath] = (list(key), data, ext_data)
+        self.dirty = True
+
+    def prune(self, filepaths: typing.Iterable[str]):
+        """移除已经不存在的文件"""
+        filepaths = set(filepaths)
+        for filepath in [x for x in self.entries if x not in filepaths]:
+            del self.entries[filepath]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            tmp = f'{self.filepath}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': SITE_CONFIG_CACHE_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.filepath)
+            self.dirty = False
+        except Exception as e:
+            _LOGGER.warning(f'保存站点配置缓存失败：{self.filepath}', exc_info=True)
+
+
 def merge_dict(a, b):
     """
     合并两个dict，只做一级合并，用于补充配置文件新增的变化
@@ -260,6 +463,9 @@ class Config:
         # 通知模版配置文件对象
         self.notify_templates: typing.Dict[str, ConfigValues] = dict()
         self.sites: typing.Dict[str, SiteConfig] = dict()
+        # 已经加载的站点适配文件 -> ((修改时间, 大小), 站点id)，用于增量刷新
+        self._site_files: typing.Dict[str, typing.Tuple[typing.Tuple[int, int], str]] = dict()
+        self._site_cache: typing.Optional[SiteConfigCache] = None
         self.rules: typing.Dict[str, dict] = dict()
 
     @staticmethod
@@ -314,14 +520,95 @@ class Config:
             self.plugins_config = ConfigValues({}, plugins_config_filepath)
             self.plugins_config.save()
 
-    def load_site_config(self, site_config_dir: str):
-        self.site_config_dir = site_config_dir
+    @staticmethod
+    def _scan_site_files(site_config_dir: str) -> typing.Dict[str, typing.Tuple[int, int]]:
+        files = dict()
         for path, dir_list, file_list in os.walk(site_config_dir):
             for file_name in file_list:
                 if os.path.splitext(file_name)[1] == '.yml':
-                    filepath = os.path.join(site_config_dir, file_name)
-                    site_config = SiteConfig(filepath)
-                    self.sites.update({site_config.get('id'): site_config})
+                    filepath = os.path.join(path, file_name)
+                    try:
+                        files[filepath] = _stat_key(os.stat(filepath))
+                    except FileNotFoundError:
+                        continue
+        return files
+
+    @staticmethod
+    def _parse_site_files(items: typing.List[typing.Tuple[str, typing.Tuple[int, int]]], parallel: bool):
+        workers = min(SITE_CONFIG_MAX_WORKERS, os.cpu_count() or 1)
+        if parallel and len(items) >= SITE_CONFIG_PARALLEL_THRESHOLD and workers > 1:
+            try:
+                # 使用spawn启动干净的工作进程，避免fork时复制其他线程持有的锁和已经打开的连接
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+                        as executor:
+                    return list(executor.map(_parse_site_file, items, chunksize=16))
+            except Exception as e:
+                _LOGGER.warning('多进程解析站点配置失败，改为逐个解析', exc_info=True)
+        return [_parse_site_file(x) for x in items]
+
+    def _apply_site_files(self, files: typing.Dict[str, typing.Tuple[int, int]], parallel: bool) -> typing.List[str]:
+        """
+        按文件的修改时间和大小增量更新站点配置，没有变化的文件直接使用缓存
+        :return: 新增或者发生变化的站点id
+        """
+        cache = self._site_cache
+        changed = []
+        misses = []
+        for filepath, key in files.items():
+            loaded = self._site_files.get(filepath)
+            if loaded and loaded[0] == key:
+                continue
+            cached = cache.get(filepath, key)
+            if cached is None:
+                misses.append((filepath, key))
+                continue
+            changed.append(self._put_site(filepath, key, SiteConfig(filepath, *cached)))
+        error = None
+        for filepath, key, data, ext_data, message in self._parse_site_files(misses, parallel):
+            if message:
+                error = error or message
+                continue
+            cache.put(filepath, key, data, ext_data)
+            changed.append(self._put_site(filepath, key, SiteConfig(filepath, data, ext_data)))
+        for filepath in [x for x in self._site_files if x not in files]:
+            _, site_id = self._site_files.pop(filepath)
+            site = self.sites.get(site_id)
+            if site is not None and site.config_filepath == filepath:
+                del self.sites[site_id]
+                changed.append(site_id)
+        cache.prune(files.keys())
+        cache.save()
+        if error:
+            raise SiteErrorException(error)
+        return changed
+
+    def _put_site(self, filepath: str, key: typing.Tuple[int, int], site_config: SiteConfig) -> str:
+        site_id = site_config.get('id')
+        self.sites.update({site_id: site_config})
+        self._site_files[filepath] = (key, site_id)
+        return site_id
+
+    def load_site_config(self, site_config_dir: str, parallel: bool = True):
+        """
+        加载站点适配文件，解析结果按文件路径、修改时间和大小缓存在配置目录中，文件没有变化时不再重新解析
+        :param site_config_dir: 站点适配文件目录
+        :param parallel: 需要解析的文件较多时是否多进程并行解析
+        """
+        self.site_config_dir = site_config_dir
+        cache_dir = self.config_dir or site_config_dir
+        self._site_cache = SiteConfigCache(os.path.join(cache_dir, SITE_CONFIG_CACHE_FILENAME))
+        self._site_cache.load()
+        self._site_files = dict()
+        self._apply_site_files(self._scan_site_files(site_config_dir), parallel)
+
+    def refresh_site_config(self, parallel: bool = True) -> typing.List[str]:
+        """
+        重新扫描站点适配目录，只解析新增和发生变化的文件，并移除已经删除的站点
+        :return: 新增、变化或者删除的站点id
+        """
+        if not self.site_config_dir or self._site_cache is None:
+            return []
+        return self._apply_site_files(self._scan_site_files(self.site_config_dir), parallel)
 
     def load_rule_config(self, rule_dir: str):
         if not os.path.exists(rule_dir):
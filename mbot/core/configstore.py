@@ -0,0 +1,385 @@
+"""
+配置快照：配置内容冻结成不可变、带版本号的节点树，读取方直接拿当前快照，不需要加锁，也不会在读取时修改配置；
+修改配置时按写时复制生成新快照，没有变化的子树直接复用旧快照中的节点，同时得到发生变化的键路径，
+按键路径通知订阅者；保存配置时合并一段时间内的多次修改，写入临时文件后原子替换
+"""
+import atexit
+import logging
+import os
+import threading
+import typing
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+_LOGGER = logging.getLogger(__name__)
+
+"""保存配置时合并修改的等待秒数"""
+DEFAULT_SAVE_DELAY = 1.0
+"""键路径的分隔符"""
+PATH_SEP = '.'
+
+_MISSING = object()
+"""set_paths中表示删除这个键的值"""
+DELETE = object()
+
+
+def _join(path: str, key) -> str:
+    return f'{path}{PATH_SEP}{key}' if path else str(key)
+
+
+class ConfigNode:
+    """不可变的配置节点，可以node.xxx打点或者node['xxx']读取，子节点在冻结时已经生成"""
+    __slots__ = ('_children', '_path')
+
+    def __init__(self, children: Dict[str, Any], path: str = ''):
+        object.__setattr__(self, '_children', children)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._children.get(name)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'配置快照不能修改：{_join(self._path, key)}')
+
+    def __getitem__(self, key):
+        return self._children[key]
+
+    def get(self, key, default=None):
+        return self._children.get(key, default)
+
+    def keys(self):
+        return self._children.keys()
+
+    def values(self):
+        return self._children.values()
+
+    def items(self):
+        return self._children.items()
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __contains__(self, key):
+        return key in self._children
+
+    def __eq__(self, other):
+        if isinstance(other, ConfigNode):
+            return self._children == other._children
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return False
+
+    def __hash__(self):
+        return id(self)
+
+    def __repr__(self):
+        return f'ConfigNode({self.to_dict()!r})'
+
+    def to_dict(self) -> Dict[str, Any]:
+        """还原成可以修改的dict"""
+        return {k: _thaw(v) for k, v in self._children.items()}
+
+
+def _thaw(value):
+    if isinstance(value, ConfigNode):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_thaw(x) for x in value]
+    return value
+
+
+def _freeze(value, prev=_MISSING, path: str = '', changed: Optional[List[str]] = None):
+    """
+    冻结配置内容，和上一份快照中对应位置的值比较，没有变化时直接复用上一份的节点
+    :param changed: 收集发生变化的键路径，只记录最深一层发生变化的位置
+    """
+    if isinstance(value, dict):
+        if not isinstance(prev, ConfigNode):
+            if changed is not None and prev is not _MISSING:
+                changed.append(path)
+            return ConfigNode({k: _freeze(v, path=_join(path, k)) for k, v in value.items()}, path)
+        prev_children = prev._children
+        children = dict()
+        same = len(prev_children) == len(value)
+        for k, v in value.items():
+            p = prev_children.get(k, _MISSING)
+            if p is _MISSING:
+                same = False
+                if changed is not None:
+                    changed.append(_join(path, k))
+                children[k] = _freeze(v, path=_join(path, k))
+                continue
+            child = _freeze(v, p, _join(path, k), changed)
+            if child is not p:
+                same = False
+            children[k] = child
+        if changed is not None:
+            changed.extend(_join(path, k) for k in prev_children if k not in value)
+        return prev if same else ConfigNode(children, path)
+    if isinstance(value, (list, tuple)):
+        frozen = tuple(_freeze(x, path=path) for x in value)
+    else:
+        frozen = value
+    if prev is not _MISSING and type(prev) is type(frozen) and prev == frozen:
+        return prev
+    if changed is not None and prev is not _MISSING:
+        changed.append(path)
+    return frozen
+
+
+class ConfigSnapshot:
+    """某个版本的完整配置"""
+    __slots__ = ('version', 'root', '_flat')
+
+    def __init__(self, version: int, root: ConfigNode):
+        self.version = version
+        self.root = root
+        self._flat: Optional[Dict[str, Any]] = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.root, name)
+
+    def _build_flat(self) -> Dict[str, Any]:
+        flat = dict()
+        stack: List[Tuple[str, ConfigNode]] = [('', self.root)]
+        while stack:
+            path, node = stack.pop()
+            for k, v in node.items():
+                p = _join(path, k)
+                flat[p] = v
+                if isinstance(v, ConfigNode):
+                    stack.append((p, v))
+        self._flat = flat
+        return flat
+
+    def get(self, path: str, default=None):
+        """按键路径读取，例如web.port，第一次调用时建立路径索引"""
+        flat = self._flat
+        if flat is None:
+            flat = self._build_flat()
+        return flat.get(path, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.root.to_dict()
+
+
+class _Subscription:
+    __slots__ = ('path', 'callback')
+
+    def __init__(self, path: str, callback: typing.Callable[[ConfigSnapshot, List[str]], Any]):
+        self.path = path
+        self.callback = callback
+
+    def match(self, changed: List[str]) -> List[str]:
+        if not self.path:
+            return changed
+        prefix = self.path + PATH_SEP
+        return [p for p in changed if p == self.path or p.startswith(prefix) or prefix.startswith(p + PATH_SEP)]
+
+
+_PENDING_SAVES: "weakref.WeakSet[ConfigStore]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_pending():
+    for store in list(_PENDING_SAVES):
+        try:
+            store.flush()
+        except Exception as e:
+            _LOGGER.error(f'退出时保存配置失败：{store.filepath}', exc_info=True)
+
+
+class ConfigStore:
+    """
+    配置快照的持有者
+    读取方通过snapshot拿到当前快照，不加锁；修改在锁内生成新快照后整体替换，再通知订阅了发生变化路径的回调
+    """
+
+    def __init__(self, data: Optional[dict] = None, filepath: Optional[str] = None,
+                 save_delay: float = DEFAULT_SAVE_DELAY):
+        """
+        :param data: 初始配置
+        :param filepath: 保存配置的yaml文件路径，为空时不保存
+        :param save_delay: 保存时合并修改的等待秒数，不大于0时立即保存
+        """
+        self.filepath = filepath
+        self.save_delay = save_delay
+        self._snapshot = ConfigSnapshot(0, _freeze(dict(data or {})))
+        self._lock = threading.RLock()
+        self._subscriptions: List[_Subscription] = []
+        self._save_lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        # 快照创建时可能已经包含没有写入文件的修改，第一次flush之前都视为未保存
+        self._saved_version = -1
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
+
+    def get(self, path: str, default=None):
+        return self._snapshot.get(path, default)
+
+    def _commit(self, root: ConfigNode, changed: List[str]) -> List[str]:
+        """调用方持有锁"""
+        if not changed:
+            return changed
+        old = self._snapshot
+        self._snapshot = ConfigSnapshot(old.version + 1, root)
+        return changed
+
+    def replace(self, data: dict) -> List[str]:
+        """
+        用完整的配置内容生成新快照
+        :return: 发生变化的键路径
+        """
+        with self._lock:
+            changed: List[str] = []
+            root = _freeze(dict(data or {}), self._snapshot.root, '', changed)
+            self._commit(root, changed)
+            snapshot = self._snapshot
+        self._notify(snapshot, changed)
+        return changed
+
+    def update(self, changes: Dict[str, Any]) -> List[str]:
+        """
+        按键路径修改多个配置项，只复制从根到被修改位置的节点，值为None时删除这个键
+        :param changes: 键路径到新值的字典，例如{'web.port': 1329}
+        :return: 发生变化的键路径
+        """
+        return self.set_paths([(path.split(PATH_SEP), DELETE if value is None else value)
+                               for path, value in changes.items()])
+
+    def set_paths(self, changes: typing.Iterable[Tuple[typing.Sequence[str], Any]]) -> List[str]:
+        """
+        按键列表修改多个配置项，键本身可以包含分隔符，值可以是None，值为DELETE时删除这个键
+        :param changes: (键列表, 新值)的列表
+        :return: 发生变化的键路径
+        """
+        with self._lock:
+            root = self._snapshot.root
+            changed: List[str] = []
+            for keys, value in changes:
+                root = self._assoc(root, list(keys), value, '', changed)
+            self._commit(root, changed)
+            snapshot = self._snapshot
+        self._notify(snapshot, changed)
+        return changed
+
+    def set(self, path: str, value) -> List[str]:
+        return self.update({path: value})
+
+    def delete(self, path: str) -> List[str]:
+        return self.update({path: None})
+
+    def _assoc(self, node: ConfigNode, keys: List[str], value, path: str, changed: List[str]) -> ConfigNode:
+        key = keys[0]
+        child_path = _join(path, key)
+        prev = node.get(key, _MISSING)
+        if len(keys) == 1:
+            if value is DELETE:
+                if prev is _MISSING:
+                    return node
+                children = dict(node._children)
+                del children[key]
+                changed.append(child_path)
+                return ConfigNode(children, path)
+            new = _freeze(value, prev, child_path, changed) if prev is not _MISSING else _freeze(value,
+                                                                                               path=child_path)
+            if prev is _MISSING:
+                changed.append(child_path)
+        else:
+            if value is DELETE and not isinstance(prev, ConfigNode):
+                return node
+            base = prev if isinstance(prev, ConfigNode) else ConfigNode({}, child_path)
+            if not isinstance(prev, ConfigNode) and prev is not _MISSING:
+                changed.append(child_path)
+            new = self._assoc(base, keys[1:], value, child_path, changed)
+        if new is prev:
+            return node
+        children = dict(node._children)
+        children[key] = new
+        return ConfigNode(children, path)
+
+    def subscribe(self, path: str, callback: typing.Callable[[ConfigSnapshot, List[str]], Any]) \
+            -> typing.Callable[[], None]:
+        """
+        订阅一个键路径的变化，这个路径本身、下级或者上级被修改时都会回调
+        :param path: 键路径，为空时订阅全部变化
+        :param callback: 接收新快照和发生变化的键路径
+        :return: 取消订阅的函数
+        """
+        subscription = _Subscription(path or '', callback)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [subscription]
+
+        def unsubscribe():
+            with self._lock:
+                self._subscriptions = [x for x in self._subscriptions if x is not subscription]
+
+        return unsubscribe
+
+    def _notify(self, snapshot: ConfigSnapshot, changed: List[str]):
+        if not changed:
+            return
+        for subscription in self._subscriptions:
+            matched = subscription.match(changed)
+            if not matched:
+                continue
+            try:
+                subscription.callback(snapshot, matched)
+            except Exception as e:
+                _LOGGER.error(f'配置变化回调执行失败：{subscription.path}', exc_info=True)
+
+    def save(self, delay: Optional[float] = None):
+        """
+        保存当前快照，等待时间内的多次保存合并为一次写入；配置文件还不存在时立即写入
+        :param delay: 合并修改的等待秒数，为空时使用save_delay
+        """
+        if not self.filepath:
+            return
+        delay = self.save_delay if delay is None else delay
+        if not delay or delay <= 0 or not os.path.exists(self.filepath):
+            self.flush()
+            return
+        with self._save_lock:
+            if self._save_timer is not None:
+                return
+            timer = threading.Timer(delay, self.flush)
+            timer.daemon = True
+            self._save_timer = timer
+            _PENDING_SAVES.add(self)
+        timer.start()
+
+    def flush(self):
+        """立即把最新的快照写入文件，写入临时文件后原子替换，已经保存过的版本不重复写入"""
+        with self._save_lock:
+            timer, self._save_timer = self._save_timer, None
+            if timer is not None:
+                timer.cancel()
+            _PENDING_SAVES.discard(self)
+            snapshot = self._snapshot
+            if not self.filepath or (snapshot.version == self._saved_version and os.path.exists(self.filepath)):
+                return
+            path = os.path.dirname(self.filepath)
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+            tmp = f'{self.filepath}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                yaml.dump(snapshot.to_dict(), f, default_style=False, encoding='utf-8', allow_unicode=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filepath)
+            self._saved_version = snapshot.version
@@ -0,0 +1,100 @@
+"""
+异步事件投递：在独立线程中运行一个事件循环，协程监听器直接在循环内执行，同步监听器转交线程池执行；
+每个监听器都有独立的并发上限，避免单个监听器在突发事件中占满所有执行资源
+"""
+import asyncio
+import logging
+import threading
+import typing
+import weakref
+from concurrent.futures import Executor, Future
+
+from mbot.core.event.eventlistener import EventListener
+
+_LOGGER = logging.getLogger(__name__)
+
+"""监听器未设置并发上限时的默认值"""
+DEFAULT_LISTENER_CONCURRENCY = 4
+
+
+class AsyncDispatcher:
+    """基于asyncio的事件投递器"""
+
+    def __init__(self, executor: Executor, default_concurrency: int = DEFAULT_LISTENER_CONCURRENCY):
+        """
+        :param executor: 同步监听器转交执行的线程池
+        :param default_concurrency: 监听器没有声明并发上限时使用的默认值
+        """
+        self.executor = executor
+        self.default_concurrency = default_concurrency
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # 信号量只在事件循环线程内创建和使用
+        self._semaphores: "weakref.WeakKeyDictionary[EventListener, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self.start()
+        return self._loop
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name='EventLoop', daemon=True)
+            self._thread.start()
+            started.wait()
+            self._loop = loop
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
+            self._thread = None
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def _semaphore(self, listener: EventListener) -> asyncio.Semaphore:
+        sem = self._semaphores.get(listener)
+        if sem is None:
+            sem = asyncio.Semaphore(listener.concurrency or self.default_concurrency)
+            self._semaphores[listener] = sem
+        return sem
+
+    async def _run(self, listener: EventListener, call: typing.Callable, args: tuple):
+        async with self._semaphore(listener):
+            if listener.is_coroutine:
+                return await call(*args)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call, *args)
+
+    def submit(self, listener: EventListener, call: typing.Callable, *args) -> Future:
+        """
+        投递一次监听器调用到事件循环，立即返回
+        :param listener: 监听器，用来确定并发上限以及是否为协程
+        :param call: 已绑定上下文的调用入口
+        :return: 调用结果的Future
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(listener, call, args), self.loop)
+
+    def run(self, listener: EventListener, call: typing.Callable, *args):
+        """
+        在事件循环中执行一次监听器调用并等待完成；如果已经处在事件循环线程内，只投递不等待，避免死锁
+        """
+        future = self.submit(listener, call, *args)
+        if self.in_loop_thread():
+            return
+        return future.result()
@@ -0,0 +1,80 @@
+"""
+批量监听器的事件攒批：后台投递的事件先按监听器和事件类型攒成一批，
+达到最大数量或者等待超时后，把整批事件数据一次交给监听器
+"""
+import logging
+import threading
+import typing
+from typing import List
+
+_LOGGER = logging.getLogger(__name__)
+
+"""批量监听器默认的单批最大数量"""
+DEFAULT_MAX_BATCH = 100
+"""批量监听器默认的最长等待毫秒数"""
+DEFAULT_MAX_WAIT_MS = 200
+
+
+def chunks(items: List, size: int) -> typing.Iterator[List]:
+    """把列表按固定大小切分"""
+    if not size or size <= 0:
+        yield items
+        return
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class BatchAccumulator:
+    """单个批量监听器在一个事件类型上的攒批器"""
+
+    def __init__(self, event_type: str, sink: typing.Callable[[str, List], typing.Any],
+                 max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS):
+        """
+        :param event_type: 事件类型
+        :param sink: 接收整批事件数据的函数，参数为事件类型和事件数据列表
+        :param max_batch: 单批最大数量，达到后立即交付
+        :param max_wait_ms: 第一条事件进入后最多等待的毫秒数
+        """
+        self.event_type = event_type
+        self.max_batch = max_batch if max_batch and max_batch > 0 else DEFAULT_MAX_BATCH
+        self.max_wait_ms = max_wait_ms if max_wait_ms is not None else DEFAULT_MAX_WAIT_MS
+        self._sink = sink
+        self._pending: List = []
+        self._timer: typing.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def add(self, items: List):
+        """加入一批事件数据，凑满的批次立即交付，剩余的等待下一批或超时"""
+        ready = []
+        with self._lock:
+            self._pending.extend(items)
+            while len(self._pending) >= self.max_batch:
+                ready.append(self._pending[:self.max_batch])
+                self._pending = self._pending[self.max_batch:]
+            if self._pending:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_wait_ms / 1000, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            elif self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for batch in ready:
+            self._deliver(batch)
+
+    def flush(self):
+        """立即交付等待中的事件"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch = self._pending
+            self._pending = []
+        if batch:
+            self._deliver(batch)
+
+    def _deliver(self, batch: List):
+        try:
+            self._sink(self.event_type, batch)
+        except Exception as e:
+            _LOGGER.error(f'批量事件交付失败：{self.event_type}', exc_info=True)
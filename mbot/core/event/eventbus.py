@@ -1,91 +1,609 @@
+import bisect
+import functools
+import itertools
 import logging
+import threading
 import typing
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Tuple
 
+from mbot.core.configstore import ConfigSnapshot, ConfigNode
+from mbot.core.event.batch import BatchAccumulator, chunks, DEFAULT_MAX_BATCH
+from mbot.core.event.asyncdispatcher import AsyncDispatcher, DEFAULT_LISTENER_CONCURRENCY
 from mbot.core.event.eventlistener import EventListener
+from mbot.core.event.isolation import IsolatedExecutor, IsolatedCall
+from mbot.core.event.journal import EventJournal
+from mbot.core.event.matcher import is_pattern, compile_pattern
+from mbot.core.event.listenerqueue import ListenerQueue, QueueStats, DEFAULT_QUEUE_SIZE
+from mbot.core.event.metrics import EventBusMetrics, TimedCall, TimedAsyncCall
 from mbot.core.event.models import EventType, Event
+from mbot.core.health import HealthIndicator, Health
 from mbot.core.plugins import PluginContext
+from mbot.core.plugins.usage import usage_tracker, UsageKind
 
 """监听器绑定事件的快捷属性"""
 BIND_EVENT_NAME = '__bind_event__'
 """监听器设定监听器顺序的快捷属性"""
 ORDER_NAME = '__order__'
+"""监听器未设置顺序时的默认顺序"""
+DEFAULT_ORDER = 100
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class _Dispatch:
+    """编译后的调用单元，持有监听器和已经绑定好插件上下文的调用入口"""
+    __slots__ = ('listener', 'call', 'is_async', 'queue', 'batcher', 'predicate')
+
+    def __init__(self, listener: EventListener, call: typing.Callable, queue: ListenerQueue,
+                 batcher: typing.Optional[BatchAccumulator] = None):
+        self.listener: EventListener = listener
+        self.call: typing.Callable = call
+        self.is_async: bool = listener.is_coroutine
+        # 后台投递时使用的监听器独占队列
+        self.queue: ListenerQueue = queue
+        # 批量监听器后台投递时使用的攒批器
+        self.batcher: typing.Optional[BatchAccumulator] = batcher
+        # 事件数据需要满足的条件，为空时总是调用
+        self.predicate: typing.Optional[typing.Callable[[typing.Any], bool]] = listener.predicate
+
+    def accepts(self, data) -> bool:
+        """事件数据是否满足监听器声明的条件，条件判断出错时视为不满足"""
+        if self.predicate is None:
+            return True
+        try:
+            return self.predicate(data)
+        except Exception as e:
+            _LOGGER.error(f'事件条件判断失败：{self.listener.name}', exc_info=True)
+            return False
+
+
 class EventBus:
-    """事件处理总线"""
+    """
+    事件处理总线
+    监听器可以订阅具体的事件类型，也可以用通配符订阅一类事件；每个具体事件类型第一次发布时，
+    把精确订阅和匹配的通配符订阅合并编译成不可变的、已排序的调用元组（调度表），增删监听器时整体替换调度表；
+    监听器声明的事件数据条件在调用前由总线判断，不满足条件的监听器不会被调用；
+    发布事件时只读取调度表，不加锁，也不再为每个监听器重复构造插件上下文；
+    协程监听器总是在独立的事件循环中执行，开启异步模式后，所有后台投递的事件都经由事件循环按监听器限流执行；
+    后台投递的事件先进入监听器独占的有界队列，慢监听器只会积压自己的队列；
+    开启事件日志后，后台投递的事件先落盘再交给监听器，每个监听器执行完成后确认，重启后重放未确认的事件；
+    标记为隔离执行的监听器在按插件划分的进程池中运行
+    """
 
-    def __init__(self, mbot):
+    def __init__(self, mbot, async_mode: bool = False, listener_concurrency: int = DEFAULT_LISTENER_CONCURRENCY,
+                 queue_size: int = DEFAULT_QUEUE_SIZE):
         self.mbot = mbot
-        self.listeners: Dict[str, list] = dict()
         self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='Event')
+        # 监听器没有声明时使用的默认队列长度
+        self.queue_size: int = queue_size
+        self._queues: Dict[EventListener, ListenerQueue] = dict()
+        self._batchers: Dict[Tuple[EventListener, str], BatchAccumulator] = dict()
+        # 是否把后台投递的同步监听器也交给事件循环调度
+        self.async_mode: bool = async_mode
+        self.async_dispatcher = AsyncDispatcher(self.executor, listener_concurrency)
+        # 按事件类型和监听器统计的运行指标
+        self.metrics = EventBusMetrics()
+        # 隔离执行监听器使用的进程池，首次使用时才会创建工作进程
+        self.isolated_executor = IsolatedExecutor()
+        # 注册信息，按订阅的事件类型（包括通配符）分组，组内按(order, 注册序号)有序存放，只在持有锁时修改
+        self._registry: Dict[str, List[Tuple[int, int, EventListener]]] = dict()
+        # 通配符订阅编译后的正则
+        self._patterns: Dict[str, typing.Pattern] = dict()
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+        # 按具体事件类型编译的调度表，首次发布时生成，整体替换保证发布事件时读到的总是完整的一份
+        self._dispatch_table: Dict[str, Tuple[_Dispatch, ...]] = dict()
+        # 按插件名缓存的插件上下文，插件配置变化或插件重新加载时失效
+        self._contexts: Dict[str, PluginContext] = dict()
+        # 生成插件上下文时使用的插件配置快照，快照被替换后重新生成
+        self._contexts_snapshot = None
+        # 后台事件的持久化日志，为空时不开启
+        self.journal: typing.Optional[EventJournal] = None
+        self._journal_replay = []
+        # 观察者在发布事件时、所有监听器执行之前同步调用，用于缓存失效这类内部处理，不参与调度表和指标统计
+        self._observers: Tuple[typing.Callable[[str, typing.Any], typing.Any], ...] = ()
 
-    def remove_listener(self, event_listener: EventListener):
-        for key in self.listeners:
-            ll: list = self.listeners[key]
-            for l in ll:
-                if l['listener'] == event_listener:
-                    ll.remove(l)
+    @property
+    def listeners(self) -> Dict[str, Tuple[EventListener, ...]]:
+        """按订阅的事件类型（包括通配符）返回已排序的监听器"""
+        return {t: tuple(x[2] for x in registry) for t, registry in list(self._registry.items())}
 
-    def add_listener(self, event_listener: EventListener, show_log=True):
+    def get_listeners(self, event_type) -> Tuple[EventListener, ...]:
+        """获取一个具体事件类型会调用的监听器，包含通配符订阅的监听器"""
+        return tuple(d.listener for d in self._get_table(str(event_type)))
+
+    def _plugins_snapshot(self) -> typing.Optional[ConfigSnapshot]:
+        config = getattr(self.mbot, 'config', None)
+        plugins_config = config.plugins_config if config else None
+        if plugins_config is None:
+            return
+        return plugins_config.snapshot()
+
+    def _isolated_config(self, plugin) -> typing.Optional[dict]:
+        """隔离进程里的监听器需要可以pickle的普通dict"""
+        config = self._get_context(plugin).config
+        return config.to_dict() if isinstance(config, ConfigNode) else config
+
+    def _get_context(self, plugin) -> PluginContext:
+        ctx = self._contexts.get(plugin.name)
+        if ctx is None:
+            # 插件拿到的是不可变的配置节点，读取时不加锁，也不会修改全局配置
+            snapshot = self._plugins_snapshot()
+            ctx = PluginContext(self.mbot, plugin, snapshot.root.get(plugin.name) if snapshot else None)
+            self._contexts[plugin.name] = ctx
+        return ctx
+
+    def set_async_mode(self, enable: bool, listener_concurrency: typing.Optional[int] = None):
         """
-        添加一个监听器，并按order完成排序
-        :param event_listener:
-        :param order:
-        :param show_log:
-        :return:
+        切换异步投递模式
+        :param enable: 开启后后台投递的事件全部经由事件循环执行
+        :param listener_concurrency: 监听器默认的并发上限
         """
+        self.async_mode = enable
+        if listener_concurrency:
+            self.async_dispatcher.default_concurrency = listener_concurrency
+        if enable:
+            self.async_dispatcher.start()
+
+    def _run_background(self, item: tuple) -> Future:
+        listener, call, event_type, data, entry_ids = item
+        if listener.is_coroutine or self.async_mode:
+            future = self.async_dispatcher.submit(listener, call, event_type, data)
+        else:
+            future = self.executor.submit(call, event_type, data)
+        if entry_ids:
+            future.add_done_callback(lambda f: self._ack(listener, entry_ids))
+        return future
+
+    def _ack(self, event_listener: EventListener, entry_ids):
+        journal = self.journal
+        if journal is None:
+            return
+        for entry_id in entry_ids:
+            journal.ack(entry_id, event_listener.name)
+
+    def _on_queue_drop(self, item: tuple):
+        # 被丢弃或者被合并掉的事件不会再执行，也不需要在重启后重放
+        if item[4]:
+            self._ack(item[0], item[4])
+
+    def _get_queue(self, event_listener: EventListener) -> ListenerQueue:
+        queue = self._queues.get(event_listener)
+        if queue is None:
+            queue = ListenerQueue(event_listener.name, self._run_background,
+                                  maxsize=event_listener.queue_size or self.queue_size,
+                                  policy=event_listener.overflow,
+                                  coalesce_key=event_listener.coalesce_key,
+                                  concurrency=event_listener.concurrency or self.async_dispatcher.default_concurrency,
+                                  on_drop=self._on_queue_drop)
+            self._queues[event_listener] = queue
+        return queue
+
+    def _deliver_batch(self, event_listener: EventListener, event_type: str, items: List[tuple]):
+        """交付一批攒好的事件，items中每一项为(事件数据, 事件日志编号)"""
+        payloads = [x[0] for x in items]
+        entry_ids = [x[1] for x in items if x[1]]
+        for d in self._get_table(event_type):
+            if d.listener is event_listener:
+                d.queue.put((event_listener, d.call, event_type, payloads, entry_ids))
+                return
+        _LOGGER.warning(f'监听器已经移除，丢弃{len(payloads)}条待交付的批量事件：{event_listener.name}')
+        self._ack(event_listener, entry_ids)
+
+    def _get_batcher(self, event_listener: EventListener, event_type: str) -> BatchAccumulator:
+        key = (event_listener, event_type)
+        batcher = self._batchers.get(key)
+        if batcher is None:
+            batcher = BatchAccumulator(event_type, functools.partial(self._deliver_batch, event_listener),
+                                       event_listener.max_batch, event_listener.max_wait_ms)
+            self._batchers[key] = batcher
+        return batcher
+
+    def get_queue_stats(self) -> List[QueueStats]:
+        """获取所有监听器队列的积压、丢弃等指标"""
+        return [q.stats() for q in list(self._queues.values())]
+
+    def _compile(self, event_listener: EventListener, event_type: str) -> _Dispatch:
+        queue = self._get_queue(event_listener)
+        plugin = event_listener.plugin
+        if event_listener.isolated:
+            call = IsolatedCall(self.isolated_executor, event_listener,
+                                self._isolated_config(plugin) if plugin else None)
+        else:
+            call = event_listener.call_async if event_listener.is_async else event_listener
+            if plugin:
+                call = functools.partial(call, self._get_context(plugin))
+        if plugin:
+            # 隔离执行的监听器在子进程中运行，这里只能统计到墙钟耗时；监听器的异常在调用入口中捕获，返回False记为错误
+            call = usage_tracker.wrap(plugin.name, UsageKind.Event, call, event_listener.is_coroutine,
+                                      false_is_error=True)
+        metrics = self.metrics.get(event_type, event_listener.name, plugin.name if plugin else None)
+        timed = TimedAsyncCall if event_listener.is_coroutine else TimedCall
+        batcher = self._get_batcher(event_listener, event_type) if event_listener.batch else None
+        return _Dispatch(event_listener, timed(metrics, self.metrics, call, plugin.manifest.title if plugin else None),
+                         queue, batcher)
+
+    def _compile_type(self, event_type: str) -> Tuple[_Dispatch, ...]:
+        """合并一个具体事件类型的精确订阅和匹配的通配符订阅，编译为调度元组"""
+        entries = list(self._registry.get(event_type, ()))
+        for binding, pattern in self._patterns.items():
+            if pattern.match(event_type):
+                entries.extend(self._registry.get(binding, ()))
+        if len(entries) > 1:
+            entries.sort(key=lambda x: (x[0], x[1]))
+        result = []
+        seen = set()
+        for _, _, event_listener in entries:
+            # 同一个监听器同时用精确类型和通配符订阅时只调用一次
+            if event_listener in seen:
+                continue
+            seen.add(event_listener)
+            result.append(self._compile(event_listener, event_type))
+        return tuple(result)
+
+    def _get_table(self, event_type: str) -> Tuple[_Dispatch, ...]:
+        table = self._dispatch_table.get(event_type)
+        if table is not None:
+            return table
+        with self._lock:
+            table = self._dispatch_table.get(event_type)
+            if table is None:
+                table = self._compile_type(event_type)
+                dispatch_table = dict(self._dispatch_table)
+                dispatch_table[event_type] = table
+                self._dispatch_table = dispatch_table
+        return table
+
+    def _rebuild(self, bindings: typing.Optional[typing.Iterable[str]] = None):
+        """
+        重新编译受影响的调度表，并整体替换
+        :param bindings: 发生变化的订阅（具体事件类型或通配符），为空时全部重新编译
+        """
+        if bindings is None:
+            bindings = list(self._registry.keys())
+            event_types = {b for b in bindings if b not in self._patterns}
+            event_types.update(self._dispatch_table.keys())
+            table = dict()
+        else:
+            table = dict(self._dispatch_table)
+            event_types = set()
+            for b in bindings:
+                pattern = self._patterns.get(b)
+                if pattern is None:
+                    event_types.add(b)
+                else:
+                    event_types.update(t for t in table if pattern.match(t))
+        for b in bindings:
+            if not self._registry.get(b):
+                self._registry.pop(b, None)
+                self._patterns.pop(b, None)
+        for t in event_types:
+            table[t] = self._compile_type(t)
+        self._dispatch_table = table
+
+    def invalidate_context(self, plugin_name: typing.Optional[str] = None):
+        """
+        让缓存的插件上下文失效，并重新编译调度表
+        :param plugin_name: 插件名，为空时全部失效
+        """
+        with self._lock:
+            if plugin_name:
+                if plugin_name not in self._contexts:
+                    return
+                self._contexts.pop(plugin_name, None)
+            else:
+                self._contexts.clear()
+            self._rebuild()
+
+    def _check_config_version(self):
+        snapshot = self._plugins_snapshot()
+        if snapshot is None or snapshot is self._contexts_snapshot:
+            return
+        with self._lock:
+            self._contexts_snapshot = snapshot
+            self._contexts.clear()
+            self._rebuild()
+
+    @staticmethod
+    def _event_types(event_listener: EventListener) -> List[str]:
         event_types = event_listener.bind_event
-        if isinstance(event_types, EventType):
-            event_types = [str(event_types)]
-        elif isinstance(event_types, str):
+        if not event_types:
+            return []
+        if isinstance(event_types, (EventType, str)):
             event_types = [event_types]
+        return [str(t) for t in event_types]
+
+    def _flush_batchers(self, event_listener: EventListener):
+        for key in [k for k in list(self._batchers) if k[0] is event_listener]:
+            self._batchers[key].flush()
+
+    def _unregister(self, event_listener: EventListener) -> List[str]:
+        """从订阅表中移除监听器，返回发生变化的订阅，调用方持有锁并负责重新编译"""
+        changed = []
+        for key in self._registry:
+            ll = self._registry[key]
+            new_ll = [x for x in ll if x[2] is not event_listener]
+            if len(new_ll) != len(ll):
+                self._registry[key] = new_ll
+                changed.append(key)
+        # 已经在队列中的事件仍会执行完，只是不再接收新的事件
+        self._queues.pop(event_listener, None)
+        for key in [k for k in self._batchers if k[0] is event_listener]:
+            self._batchers.pop(key)
+        return changed
+
+    def _register(self, event_listener: EventListener) -> List[str]:
+        """把监听器加入订阅表，返回订阅的事件类型，调用方持有锁并负责重新编译"""
+        event_types = self._event_types(event_listener)
         order = event_listener.order
         if order is None:
-            order = 100
+            order = DEFAULT_ORDER
+        seq = next(self._seq)
         for t in event_types:
-            t = str(t)
-            if t in self.listeners:
-                l: list = self.listeners[t]
-            else:
-                l: list = []
-                self.listeners[t] = l
-            l.append({
-                'listener': event_listener,
-                'order': order
-            })
-            l.sort(key=lambda x: x['order'])
-            self.listeners[t] = l
+            bisect.insort(self._registry.setdefault(t, []), (order, seq, event_listener))
+            if is_pattern(t) and t not in self._patterns:
+                self._patterns[t] = compile_pattern(t)
+        return event_types
+
+    def remove_listener(self, event_listener: EventListener):
+        # 先把攒批中的事件交付出去，再移除监听器
+        self._flush_batchers(event_listener)
+        with self._lock:
+            changed = self._unregister(event_listener)
+            if changed:
+                self._rebuild(changed)
+
+    def add_listener(self, event_listener: EventListener, show_log=True):
+        """
+        添加一个监听器，按order插入到有序位置，order相同时先注册的先执行
+        :param event_listener:
+        :param show_log:
+        :return:
+        """
+        with self._lock:
+            event_types = self._register(event_listener)
+            self._rebuild(event_types)
         if show_log:
             _LOGGER.info(
-                f'监听器已经添加: {event_listener.func.__module__}.{event_listener.func.__name__} 绑定事件: {",".join([str(t) for t in event_types]) if event_types else ""} 顺序：{order}')
+                f'监听器已经添加: {event_listener.func.__module__}.{event_listener.func.__name__} 绑定事件: {",".join(event_types)} 顺序：{event_listener.order if event_listener.order is not None else DEFAULT_ORDER}')
+
+    def replace_listeners(self, old_listeners: typing.Iterable[EventListener],
+                          new_listeners: typing.Iterable[EventListener], plugin_name: typing.Optional[str] = None):
+        """
+        用一组新的监听器整体替换旧的监听器，调度表只替换一次，发布中的事件要么全部看到旧监听器，要么全部看到新监听器
+        :param old_listeners: 要移除的监听器
+        :param new_listeners: 要添加的监听器
+        :param plugin_name: 监听器所属的插件，同时让这个插件缓存的上下文失效
+        """
+        old_listeners = list(old_listeners or [])
+        new_listeners = list(new_listeners or [])
+        for x in old_listeners:
+            self._flush_batchers(x)
+        with self._lock:
+            changed = set()
+            for x in old_listeners:
+                changed.update(self._unregister(x))
+            for x in new_listeners:
+                changed.update(self._register(x))
+            if plugin_name and plugin_name in self._contexts:
+                self._contexts.pop(plugin_name, None)
+                self._rebuild()
+            else:
+                self._rebuild(changed)
+        _LOGGER.info(f'监听器已经替换：移除{len(old_listeners)}个，添加{len(new_listeners)}个')
+
+    def add_observer(self, observer: typing.Callable[[str, typing.Any], typing.Any]):
+        """
+        添加一个观察者，每次发布事件时在监听器之前以(事件类型, 事件数据)同步调用，需要快速返回
+        :param observer: 观察者函数
+        """
+        with self._lock:
+            self._observers = self._observers + (observer,)
+
+    def remove_observer(self, observer: typing.Callable[[str, typing.Any], typing.Any]):
+        with self._lock:
+            self._observers = tuple(x for x in self._observers if x != observer)
+
+    def _observe(self, event_type: str, data):
+        for observer in self._observers:
+            try:
+                observer(event_type, data)
+            except Exception as e:
+                _LOGGER.error(f'事件观察者执行失败：{event_type}', exc_info=True)
+
+    def enable_journal(self, path: str, **kwargs):
+        """
+        开启后台事件的持久化日志，并读取上次没有处理完的事件，读取到的事件需要在监听器全部注册后调用replay_journal重放
+        :param path: 日志目录
+        :param kwargs: EventJournal的其他参数
+        """
+        if self.journal is not None:
+            return
+        journal = EventJournal(path, **kwargs)
+        self._journal_replay = journal.open()
+        self.journal = journal
+
+    def replay_journal(self) -> int:
+        """
+        重放上次没有处理完的事件，只交给还没有确认的监听器；已经不存在的监听器直接确认
+        :return: 重放的事件数量
+        """
+        if self.journal is None:
+            return 0
+        self._check_config_version()
+        entries = self._journal_replay
+        self._journal_replay = []
+        for entry in entries:
+            table = tuple(d for d in self._get_table(entry.event_type) if d.listener.name in entry.pending)
+            missing = entry.pending - {d.listener.name for d in table}
+            for name in missing:
+                _LOGGER.warning(f'重放事件{entry.event_type}时没有找到监听器：{name}')
+                self.journal.ack(entry.id, name)
+            self._dispatch_background(table, entry.event_type, entry.data, entry.id)
+        if entries:
+            _LOGGER.info(f'事件日志中的{len(entries)}条事件已经重放')
+        return len(entries)
+
+    def close_journal(self):
+        if self.journal is None:
+            return
+        self.journal.close()
+        self.journal = None
+
+    def _call(self, d: _Dispatch, event_type: str, data):
+        if d.is_async:
+            self.async_dispatcher.run(d.listener, d.call, event_type, data)
+        else:
+            d.call(event_type, data)
+
+    @staticmethod
+    def _filter(table: Tuple[_Dispatch, ...], data) -> Tuple[_Dispatch, ...]:
+        """过滤掉事件数据不满足条件的监听器，没有监听器声明条件时直接返回原调度元组"""
+        for d in table:
+            if d.predicate is not None:
+                return tuple(x for x in table if x.accepts(data))
+        return table
+
+    def _dispatch_background(self, table: Tuple[_Dispatch, ...], event_type: str, data, entry_id=None):
+        entry_ids = (entry_id,) if entry_id else None
+        for d in table:
+            try:
+                if d.batcher is not None:
+                    d.batcher.add([(data, entry_id)])
+                else:
+                    d.queue.put((d.listener, d.call, event_type, data, entry_ids), data)
+            except Exception as e:
+                _LOGGER.error(f'on_event error: {type(d.listener).__name__} event: {event_type}', exc_info=True)
+
+    def _publish_background(self, table: Tuple[_Dispatch, ...], event_type: str, data):
+        table = self._filter(table, data)
+        if not table:
+            return
+        journal = self.journal
+        if journal is not None:
+            on_durable = functools.partial(self._dispatch_background, table, event_type, data)
+            if journal.append(event_type, data, [d.listener.name for d in table], on_durable) is not None:
+                # 落盘之后再交给监听器
+                return
+        self._dispatch_background(table, event_type, data)
 
     def publish_event(self, event: Event, run_in_background: bool = False):
         """
         触发一个事件
         :param event:
+        :param run_in_background: 是否在后台线程池中执行监听器
         :return:
         """
-        listeners: typing.List[EventListener] = self.listeners.get(event.event_type)
-        if not listeners or len(listeners) == 0:
+        self._check_config_version()
+        event_type = event.event_type
+        data = event.data
+        if self._observers:
+            self._observe(event_type, data)
+        table = self._get_table(event_type)
+        if not table:
+            return
+        if run_in_background:
+            self._publish_background(table, event_type, data)
             return
-        for l in listeners:
-            listener = l['listener']
+        for d in self._filter(table, data):
             try:
-                if listener.plugin:
-                    ctx = PluginContext(self.mbot, listener.plugin,
-                                        self.mbot.config.plugins_config.get(listener.plugin.name))
-                    if run_in_background:
-                        self.executor.submit(lambda p: listener(*p), (ctx, event.event_type, event.data))
-                    else:
-                        listener(ctx, event.event_type, event.data)
+                if d.batcher is not None:
+                    self._call(d, event_type, [data])
                 else:
-                    if run_in_background:
-                        self.executor.submit(listener.func, (event.event_type, event.data))
-                    else:
-                        listener(event.event_type, event.data)
+                    self._call(d, event_type, data)
             except Exception as e:
-                _LOGGER.error(f'on_event error: {type(listener).__name__} event: {event.to_json()}', exc_info=True)
+                _LOGGER.error(f'on_event error: {type(d.listener).__name__} event: {event.to_json()}', exc_info=True)
+
+    def publish_to_plugin(self, plugin_name: str, event_type: str, data):
+        """
+        只把事件交给一个插件的监听器同步执行，用于延迟激活的插件在激活后补发触发激活的那一次事件
+        :param plugin_name: 插件名
+        :param event_type: 事件类型
+        :param data: 事件数据
+        """
+        for d in self._get_table(event_type):
+            plugin = d.listener.plugin
+            if not plugin or plugin.name != plugin_name or not d.accepts(data):
+                continue
+            try:
+                self._call(d, event_type, [data] if d.batcher is not None else data)
+            except Exception as e:
+                _LOGGER.error(f'on_event error: {type(d.listener).__name__} event: {event_type}', exc_info=True)
+
+    def publish_batch(self, events: typing.Iterable[Event], run_in_background: bool = False):
+        """
+        批量触发事件；普通监听器仍逐个事件按顺序执行，批量监听器按事件类型一次收到整批事件数据；
+        同步执行时按监听器的order顺序推进，排在批量监听器前面的普通监听器处理完整批事件后，批量监听器才收到这批事件
+        :param events: 事件列表，可以包含不同的事件类型
+        :param run_in_background: 是否在后台执行监听器
+        :return:
+        """
+        self._check_config_version()
+        grouped: Dict[str, List] = dict()
+        for event in events:
+            if self._observers:
+                self._observe(event.event_type, event.data)
+            grouped.setdefault(event.event_type, []).append(event.data)
+        for event_type, payloads in grouped.items():
+            table = self._get_table(event_type)
+            if not table:
+                continue
+            if run_in_background:
+                if self.journal is not None:
+                    # 每个事件单独落盘和确认，批量监听器仍会在攒批器中合并
+                    for data in payloads:
+                        self._publish_background(table, event_type, data)
+                    continue
+                plain = tuple(d for d in table if d.batcher is None)
+                for data in payloads:
+                    self._dispatch_background(self._filter(plain, data), event_type, data)
+                for d in table:
+                    if d.batcher is not None:
+                        d.batcher.add([(data, None) for data in payloads if d.accepts(data)])
+                continue
+            plain = []
+            for d in table:
+                if d.batcher is None:
+                    plain.append(d)
+                    continue
+                # 批量监听器之前的一段普通监听器逐个事件执行完，再把整批事件交给批量监听器
+                self._call_each(plain, event_type, payloads)
+                plain = []
+                try:
+                    accepted = [data for data in payloads if d.accepts(data)] if d.predicate else payloads
+                    for batch in chunks(accepted, d.listener.max_batch or DEFAULT_MAX_BATCH):
+                        self._call(d, event_type, batch)
+                except Exception as e:
+                    _LOGGER.error(f'on_event error: {type(d.listener).__name__} event: {event_type}', exc_info=True)
+            self._call_each(plain, event_type, payloads)
+
+    def _call_each(self, dispatches: List[_Dispatch], event_type: str, payloads: List):
+        """逐个事件同步执行一段普通监听器"""
+        if not dispatches:
+            return
+        for data in payloads:
+            for d in dispatches:
+                if not d.accepts(data):
+                    continue
+                try:
+                    self._call(d, event_type, data)
+                except Exception as e:
+                    _LOGGER.error(f'on_event error: {type(d.listener).__name__} event: {event_type}', exc_info=True)
+
+
+class EventBusHealthIndicator(HealthIndicator):
+    """事件总线健康检查点，详情中包含每个监听器队列的积压和丢弃数量，有队列积压满时视为不可用"""
+
+    def __init__(self, event_bus: EventBus):
+        super().__init__('EventBus', 'EventBus')
+        self.event_bus = event_bus
+
+    def health(self) -> Health:
+        stats = self.event_bus.get_queue_stats()
+        full = [s for s in stats if s.depth >= s.maxsize]
+        builder = Health.down() if full else Health.up()
+        for s in stats:
+            builder.with_detail(s.name, {'depth': s.depth, 'max_depth': s.max_depth, 'dropped': s.dropped,
+                                         'coalesced': s.coalesced})
+        return builder.build()
@@ -1,6 +1,8 @@
+import inspect
 import logging
 import typing
 
+from mbot.core.event.matcher import compile_predicate
 from mbot.core.event.models import EventType
 
 _LOGGER = logging.getLogger(__name__)
@@ -11,19 +13,75 @@ class EventListener:
 
     def __init__(self, func: typing.Callable,
                  bind_event: typing.Optional[typing.Union[typing.List, str, EventType]] = None,
-                 order: typing.Optional[int] = None):
+                 order: typing.Optional[int] = None,
+                 concurrency: typing.Optional[int] = None,
+                 queue_size: typing.Optional[int] = None,
+                 overflow: typing.Optional[str] = None,
+                 coalesce_key: typing.Union[str, typing.Callable, None] = None,
+                 batch: bool = False,
+                 max_batch: typing.Optional[int] = None,
+                 max_wait_ms: typing.Optional[float] = None,
+                 isolated: bool = False,
+                 when=None):
         self.func: typing.Callable = func
         self.bind_event: typing.Optional[typing.Union[typing.List, str, EventType]] = bind_event
         self.order: int = order
+        # 后台投递时，这个监听器同时执行的最大数量，为空使用事件总线的默认值
+        self.concurrency: typing.Optional[int] = concurrency
+        # 后台投递队列的最大长度，为空使用事件总线的默认值
+        self.queue_size: typing.Optional[int] = queue_size
+        # 队列满时的处理策略：block、drop_oldest、coalesce
+        self.overflow: typing.Optional[str] = overflow
+        # coalesce策略下的合并键，事件数据的字段名或计算函数
+        self.coalesce_key: typing.Union[str, typing.Callable, None] = coalesce_key
+        # 是否为批量监听器，批量监听器收到的事件数据是一个列表
+        self.batch: bool = batch
+        # 批量监听器单批的最大数量
+        self.max_batch: typing.Optional[int] = max_batch
+        # 批量监听器后台攒批时最多等待的毫秒数
+        self.max_wait_ms: typing.Optional[float] = max_wait_ms
+        # 是否在独立的进程池中执行，函数和事件数据需要可以被pickle
+        self.isolated: bool = isolated
+        # 事件数据需要满足的条件，不满足时不会调用监听器
+        self.when = when
+        self.predicate: typing.Optional[typing.Callable[[typing.Any], bool]] = compile_predicate(when)
+        # 是否为async def定义的协程监听器
+        self.is_async: bool = inspect.iscoroutinefunction(func)
         self.plugin = None
 
+    @property
+    def is_coroutine(self) -> bool:
+        """是否在事件循环中以协程方式执行；隔离执行的监听器在子进程中运行，对主进程而言是同步调用"""
+        return self.is_async and not self.isolated
+
     def set_plugin(self, plugin):
         self.plugin = plugin
 
-    def __call__(self, *args, **kwargs):
+    @property
+    def name(self) -> str:
+        name = f'{self.func.__module__}.{self.func.__name__}'
+        if self.plugin:
+            return f'{self.plugin.name}:{name}'
+        return name
+
+    def _log_error(self):
+        if self.plugin:
+            _LOGGER.error(f'插件：{self.plugin.manifest.title}接收事件{self.bind_event}处理失败', exc_info=True)
+        _LOGGER.error(f'事件{self.bind_event}处理失败', exc_info=True)
+
+    def __call__(self, *args, **kwargs) -> bool:
+        """执行监听器，异常会被记录到日志，返回是否执行成功"""
         try:
             self.func(*args, **kwargs)
+            return True
+        except Exception as e:
+            self._log_error()
+            return False
+
+    async def call_async(self, *args, **kwargs) -> bool:
+        try:
+            await self.func(*args, **kwargs)
+            return True
         except Exception as e:
-            if self.plugin:
-                _LOGGER.error(f'插件：{self.plugin.manifest.title}接收事件{self.bind_event}处理失败', exc_info=True)
-            _LOGGER.error(f'事件{self.bind_event}处理失败', exc_info=True)
+            self._log_error()
+            return False
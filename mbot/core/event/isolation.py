@@ -0,0 +1,239 @@
+"""
+隔离执行的事件监听器：标记isolated=True的监听器在独立的进程池中执行，CPU密集的插件不会占用主进程的GIL；
+每个插件使用自己的进程池，进程池定期做健康检查，工作进程退出或者空闲时无响应时自动重建
+"""
+import asyncio
+import inspect
+import logging
+import multiprocessing
+import sys
+import threading
+import traceback
+import typing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict
+
+from mbot.core.context import local_var
+
+_LOGGER = logging.getLogger(__name__)
+
+"""主程序自己的监听器使用的进程池名称"""
+CORE_POOL = '__core__'
+"""每个进程池默认的工作进程数"""
+DEFAULT_WORKERS_PER_POOL = 1
+"""默认的健康检查间隔秒数"""
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+"""健康检查等待工作进程响应的秒数"""
+HEALTH_CHECK_TIMEOUT = 10
+
+
+def _init_worker(sys_path: typing.List[str], plugin_meta: typing.Optional[dict]):
+    """
+    工作进程初始化，恢复模块搜索路径，并为插件准备同线程可见的插件元信息，
+    保证以spawn方式启动的工作进程在导入插件模块时，插件代码中的装饰器可以正常执行
+    """
+    for p in sys_path:
+        if p not in sys.path:
+            sys.path.append(p)
+    if plugin_meta:
+        from mbot.core.plugins import PluginManifest, PluginMeta
+        manifest = PluginManifest(plugin_meta.get('manifest') or {})
+        local_var.plugin_manifest = manifest
+        local_var.plugin = PluginMeta(plugin_meta.get('name'), plugin_meta.get('module_name'), manifest,
+                                      plugin_meta.get('plugin_folder'))
+
+
+def _ping():
+    return True
+
+
+def _invoke(func: typing.Callable, with_context: bool, config: typing.Optional[dict], event_type: str, data):
+    """
+    在工作进程中执行监听器
+    :return: (是否成功, 异常堆栈)
+    """
+    try:
+        if with_context:
+            from mbot.core.plugins import PluginContext
+            # 工作进程中没有应用超级对象，插件只能拿到自己的配置
+            ctx = PluginContext(None, getattr(local_var, 'plugin', None), config)
+            result = func(ctx, event_type, data)
+        else:
+            result = func(event_type, data)
+        if inspect.isawaitable(result):
+            asyncio.run(result)
+        return True, None
+    except Exception as e:
+        return False, traceback.format_exc()
+
+
+class IsolatedExecutor:
+    """按插件划分的进程池管理"""
+
+    def __init__(self, workers_per_pool: int = DEFAULT_WORKERS_PER_POOL,
+                 health_check_interval: float = DEFAULT_HEALTH_CHECK_INTERVAL,
+                 mp_context=None):
+        """
+        :param workers_per_pool: 每个插件的进程池中工作进程的数量
+        :param health_check_interval: 健康检查间隔秒数，为0时不做定期检查
+        :param mp_context: multiprocessing上下文，默认使用平台默认的启动方式
+        """
+        self.workers_per_pool = workers_per_pool
+        self.health_check_interval = health_check_interval
+        self.mp_context = mp_context or multiprocessing.get_context()
+        self._pools: Dict[str, ProcessPoolExecutor] = dict()
+        self._plugin_meta: Dict[str, typing.Optional[dict]] = dict()
+        self._restarts: Dict[str, int] = dict()
+        # 每个进程池正在执行的监听器数量，工作进程都在执行时不再排队发送健康检查
+        self._running: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+        self._health_thread: typing.Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    @staticmethod
+    def pool_name(plugin) -> str:
+        return plugin.name if plugin else CORE_POOL
+
+    def _create_pool(self, name: str) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers_per_pool, mp_context=self.mp_context,
+                                   initializer=_init_worker, initargs=(list(sys.path), self._plugin_meta.get(name)))
+
+    def _get_pool(self, plugin) -> ProcessPoolExecutor:
+        name = self.pool_name(plugin)
+        pool = self._pools.get(name)
+        if pool is not None:
+            return pool
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                if plugin:
+                    self._plugin_meta[name] = {
+                        'name': plugin.name,
+                        'module_name': plugin.module_name,
+                        'plugin_folder': plugin.plugin_folder,
+                        'manifest': {k: v for k, v in plugin.manifest.__dict__.items()
+                                     if not k.startswith('_') and k != 'configField'}
+                    }
+                pool = self._create_pool(name)
+                self._pools[name] = pool
+                _LOGGER.info(f'已经为{plugin.manifest.title if plugin else "系统"}创建隔离执行的进程池')
+            self._start_health_check()
+        return pool
+
+    def restart(self, name: str, broken: typing.Optional[ProcessPoolExecutor] = None):
+        """
+        重建一个进程池
+        :param name: 进程池名称
+        :param broken: 发现异常的进程池，已经被别的线程重建过时不再重复重建
+        """
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None or (broken is not None and pool is not broken):
+                return
+            self._pools[name] = self._create_pool(name)
+            self._restarts[name] = self._restarts.get(name, 0) + 1
+        _LOGGER.warning(f'隔离执行的进程池{name}已经重建，累计重建{self._restarts[name]}次')
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, plugin, func: typing.Callable, config: typing.Optional[dict], event_type: str, data) -> tuple:
+        """
+        在插件的进程池中执行一次监听器并等待结果
+        :return: (是否成功, 异常堆栈)
+        """
+        name = self.pool_name(plugin)
+        pool = self._get_pool(plugin)
+        with self._lock:
+            self._running[name] = self._running.get(name, 0) + 1
+        try:
+            return pool.submit(_invoke, func, plugin is not None, config, event_type, data).result()
+        except BrokenProcessPool:
+            self.restart(name, pool)
+            return False, traceback.format_exc()
+        finally:
+            with self._lock:
+                self._running[name] -= 1
+
+    def _start_health_check(self):
+        if not self.health_check_interval or self._health_thread is not None:
+            return
+        self._health_thread = threading.Thread(target=self._health_loop, name='IsolatedHealth', daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self):
+        while not self._closed.wait(self.health_check_interval):
+            self.check_health()
+
+    @staticmethod
+    def _workers_alive(pool: ProcessPoolExecutor) -> bool:
+        processes = getattr(pool, '_processes', None)
+        if not processes:
+            # 工作进程在第一次提交时才启动
+            return True
+        return all(p.is_alive() for p in list(processes.values()))
+
+    def _busy(self, name: str) -> bool:
+        return self._running.get(name, 0) >= self.workers_per_pool
+
+    def check_health(self) -> Dict[str, bool]:
+        """
+        检查每个进程池的工作进程，有进程退出或者空闲时不响应探测的进程池会被重建；
+        工作进程都在执行监听器时探测会排在监听器后面，只检查进程是否存活，长时间运行的CPU任务不会被当作无响应
+        """
+        result = dict()
+        for name, pool in list(self._pools.items()):
+            if not self._workers_alive(pool):
+                result[name] = False
+                self.restart(name, pool)
+                continue
+            if self._busy(name):
+                result[name] = True
+                continue
+            try:
+                result[name] = pool.submit(_ping).result(timeout=HEALTH_CHECK_TIMEOUT)
+            except TimeoutError:
+                # 探测发出后有监听器开始执行，探测排在了它后面
+                result[name] = self._busy(name) and self._workers_alive(pool)
+                if not result[name]:
+                    self.restart(name, pool)
+            except (BrokenProcessPool, RuntimeError):
+                result[name] = False
+                self.restart(name, pool)
+        return result
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: {'workers': self.workers_per_pool, 'running': self._running.get(name, 0),
+                       'restarts': self._restarts.get(name, 0)}
+                for name in list(self._pools.keys())}
+
+    def shutdown(self):
+        self._closed.set()
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class IsolatedCall:
+    """隔离执行监听器在主进程中的调用入口，调用时把事件交给进程池并等待执行完成"""
+    __slots__ = ('executor', 'listener', 'config')
+
+    def __init__(self, executor: IsolatedExecutor, listener, config: typing.Optional[dict] = None):
+        self.executor = executor
+        self.listener = listener
+        self.config = config
+
+    def __call__(self, event_type: str, data) -> bool:
+        listener = self.listener
+        try:
+            success, tb = self.executor.run(listener.plugin, listener.func, self.config, event_type, data)
+        except Exception as e:
+            # 一般是事件数据或者监听器无法序列化传给工作进程
+            success, tb = False, traceback.format_exc()
+        if not success:
+            if listener.plugin:
+                _LOGGER.error(f'插件：{listener.plugin.manifest.title}接收事件{listener.bind_event}在隔离进程中处理失败\n{tb}')
+            else:
+                _LOGGER.error(f'事件{listener.bind_event}在隔离进程中处理失败\n{tb}')
+        return success
@@ -0,0 +1,302 @@
+"""
+后台事件的持久化日志
+后台投递的事件在交给监听器之前先追加写入本地日志，每个监听器执行完成后写入确认记录；
+应用重启后重放没有被全部确认的事件。日志按段滚动，写入线程把一段时间内的记录合并成一次写入和一次fsync，
+只剩少量未确认事件的旧日志段会把这些事件迁移到当前段；日志段中的确认记录可能属于更早的日志段，
+所以全部确认的日志段只能从最旧的开始按顺序删除
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import typing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, List, Set
+
+from mbot.common.serializable import Serializable
+
+_LOGGER = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+"""单个日志段的默认大小上限"""
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+"""默认的合并提交间隔毫秒数"""
+DEFAULT_COMMIT_INTERVAL_MS = 10
+"""旧日志段中未确认的事件不超过这个数量时，迁移后删除旧日志段"""
+DEFAULT_COMPACT_MAX_ENTRIES = 1000
+
+OP_EVENT = 'E'
+OP_ACK = 'A'
+
+
+def _json_default(obj):
+    if isinstance(obj, Serializable):
+        return obj.to_json()
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return str(obj)
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def _encode(record: dict) -> bytes:
+    body = json.dumps(record, ensure_ascii=False, default=_json_default, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % zlib.crc32(body) + body + b'\n'
+
+
+def _decode(line: bytes) -> typing.Optional[dict]:
+    line = line.rstrip(b'\n')
+    if len(line) < 10 or line[8:9] != b' ':
+        return
+    body = line[9:]
+    try:
+        if int(line[:8], 16) != zlib.crc32(body):
+            return
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return
+
+
+class JournalEntry:
+    """一条还有监听器没有确认的事件"""
+    __slots__ = ('id', 'segment', 'event_type', 'data', 'pending')
+
+    def __init__(self, entry_id: int, segment: int, event_type: str, data, pending: Set[str]):
+        self.id = entry_id
+        self.segment = segment
+        self.event_type = event_type
+        self.data = data
+        # 还没有确认的监听器名称
+        self.pending: Set[str] = pending
+
+
+class EventJournal:
+    """本地文件实现的事件日志"""
+
+    def __init__(self, path: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 commit_interval_ms: float = DEFAULT_COMMIT_INTERVAL_MS,
+                 compact_max_entries: int = DEFAULT_COMPACT_MAX_ENTRIES):
+        """
+        :param path: 日志目录
+        :param segment_size: 单个日志段的大小上限，超过后滚动到新的日志段
+        :param commit_interval_ms: 合并提交的间隔，间隔内的写入共用一次fsync
+        :param compact_max_entries: 旧日志段未确认事件不超过这个数量时做迁移压缩
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.commit_interval_ms = commit_interval_ms
+        self.compact_max_entries = compact_max_entries
+        self._entries: Dict[int, JournalEntry] = dict()
+        # 每个日志段中还未全部确认的事件编号
+        self._segments: Dict[int, Set[int]] = dict()
+        self._next_id = 1
+        self._active_segment = 0
+        self._file = None
+        self._file_size = 0
+        self._buffer: List[tuple] = []
+        self._cond = threading.Condition(threading.Lock())
+        self._writer: typing.Optional[threading.Thread] = None
+        self._closed = True
+        # 事件写入成功后的回调在单独的线程中执行，回调阻塞不会拖慢日志写入
+        self._callback_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='JournalDispatch')
+
+    @staticmethod
+    def _segment_filename(segment: int) -> str:
+        return f'{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}'
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, self._segment_filename(segment))
+
+    def _list_segments(self) -> List[int]:
+        result = []
+        for name in os.listdir(self.path):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    result.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        result.sort()
+        return result
+
+    def open(self) -> List[JournalEntry]:
+        """
+        打开日志，恢复未确认的事件并启动写入线程
+        :return: 需要重放的事件，按写入顺序排列
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        segments = self._list_segments()
+        entries: Dict[int, JournalEntry] = dict()
+        max_id = 0
+        for segment in segments:
+            with open(self._segment_path(segment), 'rb') as f:
+                for line in f:
+                    record = _decode(line)
+                    if not record:
+                        # 崩溃时没有写完整的记录
+                        continue
+                    entry_id = record.get('i')
+                    max_id = max(max_id, entry_id)
+                    if record.get('o') == OP_EVENT:
+                        entries[entry_id] = JournalEntry(entry_id, segment, record.get('t'), record.get('d'),
+                                                         set(record.get('l') or []))
+                    elif record.get('o') == OP_ACK and entry_id in entries:
+                        entries[entry_id].pending.discard(record.get('l'))
+        for entry_id in [k for k, v in entries.items() if not v.pending]:
+            del entries[entry_id]
+        self._entries = entries
+        self._segments = {segment: set() for segment in segments}
+        for entry in entries.values():
+            self._segments[entry.segment].add(entry.id)
+        for segment in self._pop_removable():
+            os.remove(self._segment_path(segment))
+        self._next_id = max_id + 1
+        self._active_segment = (segments[-1] if segments else 0) + 1
+        self._open_segment()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='EventJournal', daemon=True)
+        self._writer.start()
+        if entries:
+            _LOGGER.info(f'事件日志中有{len(entries)}条事件没有处理完成，等待重放')
+        return sorted(entries.values(), key=lambda x: x.id)
+
+    def _open_segment(self):
+        self._file = open(self._segment_path(self._active_segment), 'ab')
+        self._file_size = self._file.tell()
+        self._segments.setdefault(self._active_segment, set())
+
+    def append(self, event_type: str, data, listeners: typing.Iterable[str],
+               on_durable: typing.Optional[typing.Callable[[int], typing.Any]] = None) -> typing.Optional[int]:
+        """
+        追加一条事件
+        :param event_type: 事件类型
+        :param data: 事件数据，需要可以序列化为json
+        :param listeners: 需要确认的监听器名称
+        :param on_durable: 事件落盘后的回调，参数为事件编号
+        :return: 事件编号，事件数据无法序列化时返回None，此时不会触发回调
+        """
+        listeners = list(listeners)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('事件日志已经关闭')
+            entry_id = self._next_id
+            try:
+                line = _encode({'o': OP_EVENT, 'i': entry_id, 't': event_type, 'd': data, 'l': listeners})
+            except (TypeError, ValueError) as e:
+                _LOGGER.warning(f'事件数据无法序列化，不写入事件日志：{event_type} {e}')
+                return
+            self._next_id += 1
+            self._entries[entry_id] = JournalEntry(entry_id, self._active_segment, event_type, data, set(listeners))
+            self._segments[self._active_segment].add(entry_id)
+            self._buffer.append((line, entry_id, on_durable))
+            self._cond.notify()
+        return entry_id
+
+    def ack(self, entry_id: int, listener: str):
+        """确认一个监听器已经处理完这条事件"""
+        with self._cond:
+            entry = self._entries.get(entry_id)
+            if not entry or listener not in entry.pending:
+                return
+            entry.pending.discard(listener)
+            self._buffer.append((_encode({'o': OP_ACK, 'i': entry_id, 'l': listener}), None, None))
+            if not entry.pending:
+                del self._entries[entry_id]
+                self._segments.get(entry.segment, set()).discard(entry_id)
+            self._cond.notify()
+
+    def pending_count(self) -> int:
+        return len(self._entries)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._buffer or self._closed)
+                if not self._buffer and self._closed:
+                    return
+            # 等待一个提交间隔，让这段时间内的写入合并成一次fsync
+            if self.commit_interval_ms:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, self.commit_interval_ms / 1000)
+            with self._cond:
+                buffer = self._buffer
+                self._buffer = []
+            try:
+                self._commit(buffer)
+            except Exception as e:
+                _LOGGER.error('事件日志写入失败', exc_info=True)
+            callbacks = [(cb, entry_id) for _, entry_id, cb in buffer if cb]
+            for cb, entry_id in callbacks:
+                self._callback_executor.submit(cb, entry_id)
+            self._maintain()
+
+    def _commit(self, buffer: List[tuple]):
+        data = b''.join(x[0] for x in buffer)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file_size += len(data)
+
+    def _pop_removable(self) -> List[int]:
+        """
+        从最旧的日志段开始取出已经全部确认的日志段，遇到还有未确认事件的日志段为止，调用方持有锁
+        较新日志段中的确认记录可能属于更早的日志段，先删除它会让更早日志段中已确认的事件在重启后再次重放
+        """
+        removable = []
+        for s in sorted(self._segments):
+            if s == self._active_segment or self._segments[s]:
+                break
+            removable.append(s)
+        for s in removable:
+            del self._segments[s]
+        return removable
+
+    def _maintain(self):
+        """滚动日志段，迁移只剩少量未确认事件的旧日志段，并按顺序删除已经全部确认的旧日志段"""
+        moved = []
+        with self._cond:
+            rotate = self._file_size >= self.segment_size
+            if rotate:
+                self._file.close()
+                self._active_segment += 1
+                self._open_segment()
+                for s, ids in self._segments.items():
+                    if s == self._active_segment or not ids or len(ids) > self.compact_max_entries:
+                        continue
+                    for entry_id in sorted(ids):
+                        entry = self._entries[entry_id]
+                        entry.segment = self._active_segment
+                        self._segments[self._active_segment].add(entry_id)
+                        moved.append(_encode({'o': OP_EVENT, 'i': entry.id, 't': entry.event_type, 'd': entry.data,
+                                              'l': sorted(entry.pending)}))
+                    ids.clear()
+            if not moved:
+                removable = self._pop_removable()
+        if moved:
+            # 日志文件只由写入线程操作，迁移的记录在锁外写入，不阻塞追加和确认；写入完成后才能删除旧日志段
+            self._commit([(line,) for line in moved])
+            with self._cond:
+                removable = self._pop_removable()
+        for s in removable:
+            try:
+                os.remove(self._segment_path(s))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """写完缓冲区中的记录后关闭日志"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._callback_executor.shutdown(wait=True)
+        with self._cond:
+            self._file.close()
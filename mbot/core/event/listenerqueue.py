@@ -0,0 +1,194 @@
+"""
+监听器独占的有界事件队列
+后台投递的事件先进入各自监听器的队列，再按监听器的并发上限依次交给执行器；
+慢监听器只会堆积自己的队列，不会占满公共执行器，队列满时按监听器声明的溢出策略处理；
+默认丢弃最早的事件，发布方永远不会因为某个监听器处理慢而等待，阻塞策略需要监听器显式声明
+"""
+import collections
+import itertools
+import logging
+import threading
+import typing
+from concurrent.futures import Future
+from enum import Enum
+
+from mbot.common.serializable import Serializable
+
+_LOGGER = logging.getLogger(__name__)
+
+"""监听器未声明队列长度时的默认长度"""
+DEFAULT_QUEUE_SIZE = 1000
+"""阻塞策略下，队列满时发布方最多等待的秒数，超时后丢弃当前事件"""
+DEFAULT_BLOCK_TIMEOUT = 1
+
+
+class OverflowPolicy(str, Enum):
+    """队列满时的处理策略"""
+    # 阻塞发布方，直到队列有空位或超时，只在监听器显式声明时使用
+    Block = 'block'
+    # 丢弃队列中最早的事件
+    DropOldest = 'drop_oldest'
+    # 相同键的事件只保留最新的一条，没有可合并的事件时丢弃最早的事件
+    Coalesce = 'coalesce'
+
+    @staticmethod
+    def get(value):
+        if isinstance(value, OverflowPolicy):
+            return value
+        if not value:
+            return OverflowPolicy.DropOldest
+        for p in OverflowPolicy:
+            if p.value == str(value).lower():
+                return p
+        raise ValueError(f'不支持的队列溢出策略：{value}')
+
+
+class QueueStats(Serializable):
+    """监听器队列的运行指标"""
+
+    def __init__(self, name: str, maxsize: int, policy: OverflowPolicy, depth: int, max_depth: int,
+                 active: int, processed: int, dropped: int, coalesced: int, blocked: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        # 当前积压数量
+        self.depth = depth
+        # 积压的最高水位
+        self.max_depth = max_depth
+        # 正在执行的数量
+        self.active = active
+        self.processed = processed
+        self.dropped = dropped
+        self.coalesced = coalesced
+        # 发布方因队列满而等待的次数
+        self.blocked = blocked
+
+
+class ListenerQueue:
+    """单个监听器的有界事件队列"""
+
+    def __init__(self, name: str,
+                 runner: typing.Callable[[tuple], Future],
+                 maxsize: int = DEFAULT_QUEUE_SIZE,
+                 policy: typing.Union[OverflowPolicy, str, None] = OverflowPolicy.DropOldest,
+                 coalesce_key: typing.Union[str, typing.Callable, None] = None,
+                 concurrency: int = 1,
+                 block_timeout: float = DEFAULT_BLOCK_TIMEOUT,
+                 on_drop: typing.Optional[typing.Callable[[tuple], typing.Any]] = None):
+        """
+        :param name: 队列名称，一般为监听器名称
+        :param runner: 把队列中的一项交给执行器，返回执行结果的Future
+        :param maxsize: 队列最大长度
+        :param policy: 队列满时的处理策略
+        :param coalesce_key: 合并策略下的合并键，可以是事件数据里的字段名，或者根据事件数据计算键的函数
+        :param concurrency: 同时从队列取出执行的最大数量
+        :param block_timeout: 阻塞策略下的最长等待秒数
+        :param on_drop: 队列中的一项被丢弃或者被合并替换时的回调
+        """
+        self.name = name
+        self.maxsize = maxsize if maxsize and maxsize > 0 else DEFAULT_QUEUE_SIZE
+        self.policy: OverflowPolicy = OverflowPolicy.get(policy)
+        self.coalesce_key = coalesce_key
+        self.concurrency = concurrency if concurrency and concurrency > 0 else 1
+        self.block_timeout = block_timeout
+        self._runner = runner
+        self._on_drop = on_drop
+        self._items: typing.OrderedDict[typing.Hashable, tuple] = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._active = 0
+        self._max_depth = 0
+        self._processed = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._blocked = 0
+
+    def _key(self, data) -> typing.Hashable:
+        if self.policy == OverflowPolicy.Coalesce and self.coalesce_key and data is not None:
+            if callable(self.coalesce_key):
+                key = self.coalesce_key(data)
+            else:
+                key = data.get(self.coalesce_key) if isinstance(data, dict) else None
+            if key is not None:
+                return 'k', key
+        return 's', next(self._seq)
+
+    def _dropped_item(self, item: tuple):
+        if not self._on_drop:
+            return
+        try:
+            self._on_drop(item)
+        except Exception as e:
+            _LOGGER.error(f'监听器队列丢弃回调执行失败：{self.name}', exc_info=True)
+
+    def put(self, item: tuple, data=None) -> bool:
+        """
+        放入一项待执行的调用
+        :param item: 交给runner执行的参数
+        :param data: 事件数据，用于计算合并键
+        :return: 是否成功放入，被丢弃时返回False
+        """
+        try:
+            key = self._key(data)
+        except Exception as e:
+            _LOGGER.error(f'计算事件合并键失败：{self.name}', exc_info=True)
+            key = 's', next(self._seq)
+        start = False
+        dropped = None
+        with self._cond:
+            if key in self._items:
+                # 合并键已存在，用最新的事件替换等待中的旧事件，保持原有的排队位置
+                dropped = self._items[key]
+                self._items[key] = item
+                self._coalesced += 1
+            else:
+                if len(self._items) >= self.maxsize:
+                    if self.policy == OverflowPolicy.Block:
+                        self._blocked += 1
+                        if not self._cond.wait_for(lambda: len(self._items) < self.maxsize, self.block_timeout):
+                            self._dropped += 1
+                            _LOGGER.warning(f'监听器队列已满，等待{self.block_timeout}秒后仍无空位，丢弃事件：{self.name}')
+                            dropped = item
+                    else:
+                        _, dropped = self._items.popitem(last=False)
+                        self._dropped += 1
+                if dropped is not item:
+                    self._items[key] = item
+                    self._max_depth = max(self._max_depth, len(self._items))
+                    if self._active < self.concurrency:
+                        self._active += 1
+                        start = True
+        if dropped is not None:
+            self._dropped_item(dropped)
+        if start:
+            self._pump()
+        return dropped is not item
+
+    def _pump(self, _future: typing.Optional[Future] = None):
+        """依次取出队列中的调用交给runner，前一个完成后再取下一个"""
+        while True:
+            with self._cond:
+                if _future is not None:
+                    self._processed += 1
+                    _future = None
+                if not self._items:
+                    self._active -= 1
+                    return
+                _, item = self._items.popitem(last=False)
+                self._cond.notify()
+            try:
+                future = self._runner(item)
+            except Exception as e:
+                _LOGGER.error(f'监听器队列提交执行失败：{self.name}', exc_info=True)
+                with self._cond:
+                    self._active -= 1
+                return
+            if not future.done():
+                future.add_done_callback(self._pump)
+                return
+            _future = future
+
+    def stats(self) -> QueueStats:
+        with self._cond:
+            return QueueStats(self.name, self.maxsize, self.policy, len(self._items), self._max_depth, self._active,
+                              self._processed, self._dropped, self._coalesced, self._blocked)
@@ -0,0 +1,95 @@
+"""
+事件订阅的匹配规则
+监听器可以用通配符订阅一类事件，例如Emby*、*；也可以声明事件数据需要满足的条件，
+条件在注册时编译成判断函数，由事件总线在调用监听器之前判断，不满足条件的监听器不会被调用
+"""
+import fnmatch
+import re
+import typing
+
+"""通配符订阅使用的特殊字符"""
+WILDCARD_CHARS = ('*', '?', '[')
+
+_MISSING = object()
+
+
+def is_pattern(binding: str) -> bool:
+    """订阅的事件类型是否为通配符"""
+    return any(c in binding for c in WILDCARD_CHARS)
+
+
+def compile_pattern(binding: str) -> typing.Pattern:
+    """把通配符编译为正则，大小写敏感，与事件类型的精确匹配保持一致"""
+    return re.compile(fnmatch.translate(binding))
+
+
+def _getter(path: str) -> typing.Callable[[typing.Any], typing.Any]:
+    keys = path.split('.')
+    if len(keys) == 1:
+        key = keys[0]
+
+        def get(data):
+            if isinstance(data, dict):
+                return data.get(key, _MISSING)
+            return getattr(data, key, _MISSING)
+
+        return get
+
+    def get_path(data):
+        for k in keys:
+            if isinstance(data, dict):
+                data = data.get(k, _MISSING)
+            else:
+                data = getattr(data, k, _MISSING)
+            if data is _MISSING or data is None:
+                return _MISSING
+        return data
+
+    return get_path
+
+
+def _condition(path: str, expected) -> typing.Callable[[typing.Any], bool]:
+    get = _getter(path)
+    if callable(expected):
+        def check(data):
+            value = get(data)
+            return value is not _MISSING and bool(expected(value))
+    elif isinstance(expected, (list, tuple, set, frozenset)):
+        try:
+            values = frozenset(expected)
+        except TypeError:
+            values = tuple(expected)
+
+        def check(data):
+            return get(data) in values
+    else:
+        def check(data):
+            return get(data) == expected
+    return check
+
+
+def compile_predicate(when) -> typing.Optional[typing.Callable[[typing.Any], bool]]:
+    """
+    编译监听器声明的事件数据条件
+    :param when: 为空时不做判断；可以是接收事件数据的函数，
+    或者字段到期望值的字典，字段支持用.访问嵌套的数据，期望值可以是单个值、可选值的列表或者接收字段值的判断函数，
+    字典中的条件需要全部满足
+    :return: 接收事件数据、返回是否匹配的函数，没有条件时返回None
+    """
+    if not when:
+        return
+    if callable(when):
+        return lambda data: bool(when(data))
+    if not isinstance(when, dict):
+        raise ValueError(f'不支持的事件条件：{when}')
+    checks = tuple(_condition(str(k), v) for k, v in when.items())
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_all(data):
+        for check in checks:
+            if not check(data):
+                return False
+        return True
+
+    return check_all
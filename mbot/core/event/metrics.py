@@ -0,0 +1,257 @@
+"""
+事件总线的运行指标：按事件类型和监听器统计调用次数、错误次数、执行中数量以及耗时分布；
+耗时使用固定分桶的直方图记录，可以估算p50/p95/p99，也可以直接导出为Prometheus文本格式
+"""
+import bisect
+import logging
+import threading
+import time
+import typing
+from typing import Dict, List, Tuple
+
+from mbot.common.serializable import Serializable
+
+_LOGGER = logging.getLogger(__name__)
+
+"""耗时直方图的分桶上界，单位毫秒"""
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (
+    1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000
+)
+
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图，最后一个桶存放超过最大上界的数据"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum_ms += other.sum_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def copy(self) -> "LatencyHistogram":
+        h = LatencyHistogram(self.buckets)
+        h.merge(self)
+        return h
+
+    def percentile(self, p: float) -> typing.Optional[float]:
+        """
+        按桶内线性插值估算分位数
+        :param p: 0~100之间的百分位
+        :return: 毫秒，没有数据时返回None
+        """
+        if not self.count:
+            return
+        rank = self.count * p / 100
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if not c:
+                continue
+            if seen + c >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max_ms
+                return round(lower + (upper - lower) * (rank - seen) / c, 3)
+            seen += c
+        return self.max_ms
+
+
+class ListenerMetrics:
+    """单个监听器在某一个事件类型上的指标"""
+
+    def __init__(self, event_type: str, listener: str, plugin: typing.Optional[str] = None):
+        self.event_type = event_type
+        self.listener = listener
+        self.plugin = plugin
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.histogram = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def exit(self, ms: float, success: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if not success:
+                self.errors += 1
+            self.histogram.observe(ms)
+
+    def snapshot(self) -> "ListenerMetricsSnapshot":
+        with self._lock:
+            return ListenerMetricsSnapshot(self.event_type, self.listener, self.plugin, self.calls, self.errors,
+                                           self.in_flight, self.histogram.copy())
+
+
+class ListenerMetricsSnapshot(Serializable):
+    """指标的只读快照，可以直接序列化返回给接口"""
+    hidden_fields = ['histogram']
+
+    def __init__(self, event_type: str, listener: typing.Optional[str], plugin: typing.Optional[str], calls: int,
+                 errors: int, in_flight: int, histogram: LatencyHistogram):
+        self.event_type = event_type
+        self.listener = listener
+        self.plugin = plugin
+        self.calls = calls
+        self.errors = errors
+        self.in_flight = in_flight
+        self.histogram = histogram
+        self.avg_ms = round(histogram.sum_ms / histogram.count, 3) if histogram.count else None
+        self.max_ms = round(histogram.max_ms, 3)
+        self.p50_ms = histogram.percentile(50)
+        self.p95_ms = histogram.percentile(95)
+        self.p99_ms = histogram.percentile(99)
+
+
+def _label(value) -> str:
+    return str(value if value is not None else '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class EventBusMetrics:
+    """事件总线的指标注册表"""
+
+    def __init__(self, slow_threshold_ms: typing.Optional[float] = None):
+        # 监听器单次执行超过这个毫秒数时打印慢执行日志，为空不检查
+        self.slow_threshold_ms: typing.Optional[float] = slow_threshold_ms
+        self._metrics: Dict[Tuple[str, str], ListenerMetrics] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, event_type: str, listener: str, plugin: typing.Optional[str] = None) -> ListenerMetrics:
+        key = (event_type, listener)
+        m = self._metrics.get(key)
+        if m is None:
+            with self._lock:
+                m = self._metrics.get(key)
+                if m is None:
+                    m = ListenerMetrics(event_type, listener, plugin)
+                    self._metrics[key] = m
+        return m
+
+    def check_slow(self, m: ListenerMetrics, ms: float, plugin_title: typing.Optional[str] = None):
+        if self.slow_threshold_ms is None or ms < self.slow_threshold_ms:
+            return
+        if plugin_title:
+            _LOGGER.warning(f'插件：{plugin_title}的监听器{m.listener}处理事件{m.event_type}耗时{round(ms)}毫秒，'
+                            f'超过了{self.slow_threshold_ms}毫秒')
+        else:
+            _LOGGER.warning(f'监听器{m.listener}处理事件{m.event_type}耗时{round(ms)}毫秒，超过了{self.slow_threshold_ms}毫秒')
+
+    def get_listener_metrics(self, event_type: typing.Optional[str] = None) -> List[ListenerMetricsSnapshot]:
+        """
+        获取每个监听器的指标快照
+        :param event_type: 只返回这个事件类型的指标，为空返回全部
+        """
+        items = list(self._metrics.values())
+        if event_type is not None:
+            items = [m for m in items if m.event_type == str(event_type)]
+        return [m.snapshot() for m in items]
+
+    def get_event_metrics(self) -> List[ListenerMetricsSnapshot]:
+        """按事件类型汇总所有监听器的指标"""
+        grouped: Dict[str, List[ListenerMetricsSnapshot]] = dict()
+        for s in self.get_listener_metrics():
+            grouped.setdefault(s.event_type, []).append(s)
+        result = []
+        for event_type, items in grouped.items():
+            h = LatencyHistogram()
+            for s in items:
+                h.merge(s.histogram)
+            result.append(ListenerMetricsSnapshot(event_type, None, None, sum(s.calls for s in items),
+                                                  sum(s.errors for s in items), sum(s.in_flight for s in items), h))
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def to_prometheus(self, prefix: str = 'mbot_event_listener') -> str:
+        """导出为Prometheus文本格式"""
+        snapshots = self.get_listener_metrics()
+        lines = [
+            f'# HELP {prefix}_calls_total Total number of listener invocations.',
+            f'# TYPE {prefix}_calls_total counter',
+        ]
+        labels = [
+            f'event="{_label(s.event_type)}",listener="{_label(s.listener)}",plugin="{_label(s.plugin)}"'
+            for s in snapshots
+        ]
+        for s, label in zip(snapshots, labels):
+            lines.append(f'{prefix}_calls_total{{{label}}} {s.calls}')
+        lines.append(f'# HELP {prefix}_errors_total Total number of failed listener invocations.')
+        lines.append(f'# TYPE {prefix}_errors_total counter')
+        for s, label in zip(snapshots, labels):
+            lines.append(f'{prefix}_errors_total{{{label}}} {s.errors}')
+        lines.append(f'# HELP {prefix}_in_flight Number of listener invocations currently running.')
+        lines.append(f'# TYPE {prefix}_in_flight gauge')
+        for s, label in zip(snapshots, labels):
+            lines.append(f'{prefix}_in_flight{{{label}}} {s.in_flight}')
+        lines.append(f'# HELP {prefix}_latency_seconds Listener invocation latency.')
+        lines.append(f'# TYPE {prefix}_latency_seconds histogram')
+        for s, label in zip(snapshots, labels):
+            h = s.histogram
+            cumulative = 0
+            for bound, c in zip(h.buckets, h.counts):
+                cumulative += c
+                lines.append(f'{prefix}_latency_seconds_bucket{{{label},le="{bound / 1000:g}"}} {cumulative}')
+            lines.append(f'{prefix}_latency_seconds_bucket{{{label},le="+Inf"}} {h.count}')
+            lines.append(f'{prefix}_latency_seconds_sum{{{label}}} {h.sum_ms / 1000:g}')
+            lines.append(f'{prefix}_latency_seconds_count{{{label}}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class TimedCall:
+    """给同步调用入口增加指标记录"""
+    __slots__ = ('metrics', 'registry', 'call', 'plugin_title')
+
+    def __init__(self, metrics: ListenerMetrics, registry: EventBusMetrics, call: typing.Callable,
+                 plugin_title: typing.Optional[str] = None):
+        self.metrics = metrics
+        self.registry = registry
+        self.call = call
+        self.plugin_title = plugin_title
+
+    def __call__(self, *args):
+        m = self.metrics
+        m.enter()
+        start = time.perf_counter()
+        success = False
+        try:
+            success = self.call(*args) is not False
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            m.exit(ms, success)
+            self.registry.check_slow(m, ms, self.plugin_title)
+
+
+class TimedAsyncCall(TimedCall):
+    """给协程调用入口增加指标记录"""
+    __slots__ = ()
+
+    async def __call__(self, *args):
+        m = self.metrics
+        m.enter()
+        start = time.perf_counter()
+        success = False
+        try:
+            success = await self.call(*args) is not False
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            m.exit(ms, success)
+            self.registry.check_slow(m, ms, self.plugin_title)
@@ -51,38 +51,93 @@ class ArgSchema(Serializable):
             self.required = True
 
 
-def parser_to_args(args: t.Dict[str, t.Any], schema: t.OrderedDict[str, ArgSchema]) -> t.Optional[
-    t.OrderedDict[str, t.Any]]:
-    if not args:
-        if schema:
-            raise InvalidParameterException('', "请提供必要的参数")
-        return
-    if not schema:
-        return
-    result: t.Optional[t.OrderedDict[str, t.Any]] = collections.OrderedDict()
-    for name in schema:
-        val = args.get(name)
-        s = schema.get(name)
+def _enum_options(enum_values) -> t.List[t.Any]:
+    if callable(enum_values):
+        enum_values = enum_values()
+    return [x.get('value') for x in enum_values or []]
+
+
+class _ArgRule:
+    """单个参数编译后的校验规则"""
+    __slots__ = ('name', 'schema', 'coerce', 'enum_options', 'enum_set', 'dynamic_enum')
+
+    def __init__(self, name: str, schema: ArgSchema):
+        self.name = name
+        self.schema = schema
+        self.coerce: t.Optional[t.Callable[[t.Any], t.Any]] = None
+        if schema.arg_type == ArgType.String:
+            self.coerce = str
+        elif schema.arg_type == ArgType.Int:
+            self.coerce = int
+        # 固定的可选值在编译时生成集合，可选值由函数提供时每次校验重新获取
+        self.dynamic_enum = schema.arg_type == ArgType.Enum and callable(schema.enum_values)
+        self.enum_options: t.List[t.Any] = []
+        self.enum_set: t.FrozenSet = frozenset()
+        if schema.arg_type == ArgType.Enum and not self.dynamic_enum:
+            self.enum_options = _enum_options(schema.enum_values)
+            self.enum_set = self._to_set(self.enum_options)
+
+    @staticmethod
+    def _to_set(options):
+        try:
+            return frozenset(options)
+        except TypeError:
+            return tuple(options)
+
+    def check_enum(self, val):
+        options, values = self.enum_options, self.enum_set
+        if self.dynamic_enum:
+            options = _enum_options(self.schema.enum_values)
+            values = self._to_set(options)
+        for v in (val if isinstance(val, list) else [val]):
+            if v not in values:
+                raise InvalidParameterException(self.name, f"参数{self.schema.label}的值必须为：{options}")
+
+    def parse(self, val):
+        s = self.schema
         if not val:
             if s.required:
-                raise InvalidParameterException(s.name, f"参数为空:{s.label}")
-            val = s.default_value
-        else:
-            if s.arg_type == ArgType.String:
-                val = str(val)
-            elif s.arg_type == ArgType.Int:
-                val = int(val)
-            elif s.arg_type == ArgType.Enum:
-                if isinstance(val, str):
-                    val = str(val)
-                    if val not in [x.get('value') for x in s.enum_values]:
-                        raise InvalidParameterException(s.name,
-                                                        f"参数{s.label}的值必须为：{[x.get('value') for x in s.enum_values]}")
-                elif isinstance(val, list):
-                    check_val = [x.get('value') for x in s.enum_values]
-                    for v in val:
-                        if v not in check_val:
-                            raise InvalidParameterException(s.name,
-                                                            f"参数{s.label}的值必须为：{[x.get('value') for x in s.enum_values]}")
-        result.update({name: val})
-    return result
+                raise InvalidParameterException(self.name, f"参数为空:{s.label}")
+            return s.default_value
+        if self.coerce is not None:
+            try:
+                return self.coerce(val)
+            except (TypeError, ValueError):
+                raise InvalidParameterException(self.name, f"参数{s.label}的格式不正确：{val}")
+        if s.arg_type == ArgType.Enum and isinstance(val, (str, list)):
+            self.check_enum(val)
+        return val
+
+
+class ArgValidator:
+    """
+    由参数定义编译出的校验器，可选值集合、类型转换和默认值在编译时准备好，
+    校验时只做查表和转换，适合同一个功能指令被频繁调用的场景
+    """
+
+    def __init__(self, schema: t.Optional[t.OrderedDict[str, ArgSchema]]):
+        self.schema = schema
+        self.rules: t.Tuple[_ArgRule, ...] = tuple(_ArgRule(name, s) for name, s in (schema or {}).items())
+
+    def validate(self, args: t.Optional[t.Dict[str, t.Any]]) -> t.Optional[t.OrderedDict[str, t.Any]]:
+        """
+        按参数定义校验并转换参数
+        :param args: 调用方提供的参数
+        :return: 转换后的参数，按参数定义的顺序排列
+        """
+        if not args:
+            if self.rules:
+                raise InvalidParameterException('', "请提供必要的参数")
+            return
+        if not self.rules:
+            return
+        result: t.OrderedDict[str, t.Any] = collections.OrderedDict()
+        for rule in self.rules:
+            result[rule.name] = rule.parse(args.get(rule.name))
+        return result
+
+
+def parser_to_args(args: t.Dict[str, t.Any], schema: t.OrderedDict[str, ArgSchema]) -> t.Optional[
+    t.OrderedDict[str, t.Any]]:
+    """按参数定义校验参数，多次校验同一份参数定义时应该使用编译好的ArgValidator"""
+    return ArgValidator(schema).validate(args)
@@ -3,6 +3,7 @@ import json
 from typing import List, Optional, Dict, Callable, Any, OrderedDict, Union
 
 from mbot.common.serializable import Serializable
+from mbot.core.configstore import ConfigNode
 from mbot.core.context import LocalContext
 import functools
 import inspect
@@ -11,7 +12,10 @@ from enum import Enum
 
 from mbot.core.context import local_var
 from mbot.core.event.eventlistener import EventListener
-from mbot.core.params import ArgSchema, ArgType
+from mbot.exceptions import InvalidParameterException
+from mbot.core.params import ArgSchema, ArgType, ArgValidator
+from mbot.core.plugins.usage import usage_tracker, UsageKind, PluginUsage
+from mbot.core.taskpool import POOL_CPU
 
 _LOGGER = logging.getLogger(__name__)
 # 创建一个同线程可见的对象实例
@@ -38,6 +42,8 @@ class PluginManifest(Serializable):
     logoUrl: str
     githubUrl: str
     helpDocUrl: str
+    # 延迟激活声明，包含插件订阅的事件、提供的功能指令和定时任务，声明后启动时不导入插件代码
+    activation: Optional[Dict] = None
     _filepath: str
 
     @staticmethod
@@ -69,6 +75,7 @@ class PluginManifest(Serializable):
         self.githubUrl = json_manifest.get('githubUrl')
         self.helpDocUrl = json_manifest.get('helpDocUrl')
         self.dependencies = json_manifest.get('dependencies')
+        self.activation = json_manifest.get('activation')
         self._filepath: str = filepath
 
     def save(self):
@@ -81,7 +88,8 @@ class PluginManifest(Serializable):
 class PluginTask:
     def __init__(self, task: Callable, name, desc, cron_expression=None, jitter=None, minutes=None, seconds=None,
                  plugin_name=None, run_at_startup=False,
-                 run_at_startup_in_thread=False):
+                 run_at_startup_in_thread=False, max_instances=1, coalesce=True, misfire_grace_time=None, pool=None,
+                 priority=None, requires=None, spread=False, targets=None, adaptive=False, max_interval=None):
         self.task: Callable = task
         self.name = name
         self.desc = desc
@@ -92,6 +100,16 @@ class PluginTask:
         self.plugin_name = plugin_name
         self.run_at_startup = run_at_startup
         self.run_at_startup_in_thread = run_at_startup_in_thread
+        self.max_instances = max_instances
+        self.coalesce = coalesce
+        self.misfire_grace_time = misfire_grace_time
+        self.pool = pool
+        self.priority = priority
+        self.requires = requires
+        self.spread = spread
+        self.targets = targets
+        self.adaptive = adaptive
+        self.max_interval = max_interval
 
 
 class PluginCommandResponse:
@@ -102,7 +120,7 @@ class PluginCommandResponse:
 
 class PluginCommand:
     def __init__(self, func: Callable, name: str, title: str, desc: Optional[str] = None,
-                 icon: Optional[str] = None, run_in_background: bool = False):
+                 icon: Optional[str] = None, run_in_background: bool = False, plugin_name: Optional[str] = None):
         sig = inspect.signature(func)
         self._params = sig.parameters
         self.func: Callable = func
@@ -111,7 +129,10 @@ class PluginCommand:
         self.desc: Optional[str] = desc
         self.icon: Optional[str] = icon
         self.run_in_background: bool = run_in_background
+        # 所属插件，执行时的资源使用记在这个插件上
+        self.plugin_name: Optional[str] = plugin_name
         self.arg_schema: Optional[OrderedDict[str, ArgSchema]] = self._arg_schema()
+        self._validator: Optional[ArgValidator] = None
 
     def _arg_schema(self) -> Optional[OrderedDict[str, ArgSchema]]:
         if not self._params:
@@ -154,10 +175,63 @@ class PluginCommand:
         return schema
 
     def __call__(self, ctx: "PluginCommandContext", args_data: Optional[Dict] = None) -> PluginCommandResponse:
-        if args_data:
-            return self.func(ctx, **args_data)
-        else:
-            return self.func(ctx)
+        with usage_tracker.track(self.plugin_name, UsageKind.Command):
+            if args_data:
+                return self.func(ctx, **args_data)
+            else:
+                return self.func(ctx)
+
+    @property
+    def validator(self) -> ArgValidator:
+        """由参数定义编译的校验器，参数定义被整体替换后重新编译"""
+        validator = self._validator
+        if validator is None or validator.schema is not self.arg_schema:
+            validator = self._validator = ArgValidator(self.arg_schema)
+        return validator
+
+    def validate(self, args_data: Optional[Dict] = None) -> Optional[OrderedDict[str, Any]]:
+        """按参数定义校验并转换参数，校验失败时抛出InvalidParameterException"""
+        return self.validator.validate(args_data)
+
+    def invoke(self, ctx: "PluginCommandContext", args_data: Optional[Dict] = None) -> PluginCommandResponse:
+        """校验参数后执行功能指令"""
+        return self(ctx, self.validate(args_data))
+
+    def invoke_batch(self, ctx: "PluginCommandContext", payloads: List[Optional[Dict]],
+                     stop_on_error: bool = False) -> List[PluginCommandResponse]:
+        """
+        批量校验并执行功能指令，所有参数先统一校验，再依次执行校验通过的调用
+        :param payloads: 每次调用的参数
+        :param stop_on_error: 遇到校验失败或执行出错时是否停止执行后面的调用，停止后剩余的调用返回失败
+        :return: 与payloads一一对应的执行结果
+        """
+        validate = self.validator.validate
+        parsed = []
+        for args_data in payloads:
+            try:
+                parsed.append((True, validate(args_data)))
+            except InvalidParameterException as e:
+                parsed.append((False, f'{e}'))
+        results: List[PluginCommandResponse] = []
+        stopped = False
+        for ok, value in parsed:
+            if stopped:
+                results.append(PluginCommandResponse(False, '前面的调用失败，没有执行'))
+                continue
+            if not ok:
+                results.append(PluginCommandResponse(False, value))
+                stopped = stop_on_error
+                continue
+            try:
+                result = self(ctx, value)
+            except Exception as e:
+                _LOGGER.error(f'功能指令执行失败：{self.title}', exc_info=True)
+                result = PluginCommandResponse(False, f'{e}')
+            if not isinstance(result, PluginCommandResponse):
+                result = PluginCommandResponse(result is not False, '')
+            results.append(result)
+            stopped = stop_on_error and not result.success
+        return results
 
 
 class PluginMeta:
@@ -178,6 +252,9 @@ class PluginMeta:
         self._config_changed = None
         self._after_setup = None
         self._tasks: List[PluginTask] = []
+        # 是否延迟激活，以及是否已经导入插件代码完成激活
+        self.lazy: bool = False
+        self.activated: bool = False
 
     def get_listener(self):
         return self._listener
@@ -188,10 +265,14 @@ class PluginMeta:
     def get_task(self):
         return self._tasks
 
+    def get_usage(self) -> PluginUsage:
+        """插件的资源使用统计，包括事件监听器、功能指令和定时任务的调用次数、墙钟耗时和CPU耗时"""
+        return usage_tracker.get(self.name)
+
     def command(self, name: str, title: str, desc: Optional[str] = None,
                 icon: Optional[str] = None, run_in_background: bool = False):
         def decorator(func: Callable):
-            action = PluginCommand(func, name, title, desc, icon, run_in_background)
+            action = PluginCommand(func, name, title, desc, icon, run_in_background, self.name)
             self._command.append(action)
             _LOGGER.info(f'插件{self.manifest.title}新增功能指令：{title}')
             return action
@@ -206,10 +287,30 @@ class PluginMeta:
              minutes=None,
              seconds=None,
              run_at_startup=False,
-             run_at_startup_in_thread=False
+             run_at_startup_in_thread=False,
+             max_instances=1,
+             coalesce=True,
+             misfire_grace_time=None,
+             pool=None,
+             priority=None,
+             requires=None,
+             spread=False,
+             targets=None,
+             adaptive=False,
+             max_interval=None
              ):
         """
-
+        注册定时任务
+        :param max_instances: 同时运行的实例上限，上一次运行没有结束、达到上限时跳过本次触发
+        :param coalesce: 错过多次触发时（例如任务运行太久）是否合并成一次执行
+        :param misfire_grace_time: 错过触发时间后仍然允许执行的秒数，为空时不限制
+        :param pool: 执行池名称，为空时使用插件独占的执行池；CPU密集的任务可以使用cpu，任务函数需要定义在模块顶层
+        :param priority: 全局并发预算不足时的排队优先级，数值越小越优先，默认排在系统任务之后
+        :param requires: 启动时需要先执行完成的其他启动任务名称，run_at_startup的任务会在应用启动后于后台按依赖顺序执行
+        :param spread: 是否按任务名把触发时刻稳定地错开，避免和其他同周期任务在同一时刻访问外部服务
+        :param targets: 任务会访问的目标（如emby、qbittorrent），运行前先取得这些目标的速率令牌
+        :param adaptive: 任务返回False（没有发现新内容）时逐步放大运行间隔，返回其他结果时恢复
+        :param max_interval: 自适应调度的最大间隔秒数
         """
 
         def decorator(func: Callable):
@@ -217,9 +318,13 @@ class PluginMeta:
             def wrap(*args, **kwargs):
                 return func(*args, **kwargs)
 
+            # 进程池中执行的任务需要被pickle，直接使用模块顶层的原函数
+            task = func if pool == POOL_CPU else wrap
             self._tasks.append(
-                PluginTask(wrap, name, desc, cron_expression, jitter, minutes, seconds, None, run_at_startup,
-                           run_at_startup_in_thread))
+                PluginTask(task, name, desc, cron_expression, jitter, minutes, seconds, None, run_at_startup,
+                           run_at_startup_in_thread, max_instances, coalesce, misfire_grace_time, pool, priority,
+                           requires, spread, targets, adaptive, max_interval))
+            return func
 
         return decorator
 
@@ -231,13 +336,38 @@ class PluginMeta:
         self._after_setup = func
         return func
 
-    def on_event(self, bind_event: Union[List, str], order: int = 100):
+    def on_event(self, bind_event: Union[List, str], order: int = 100, concurrency: Optional[int] = None,
+                 queue_size: Optional[int] = None, overflow: Optional[str] = None,
+                 coalesce_key: Union[str, Callable, None] = None, batch: bool = False,
+                 max_batch: Optional[int] = None, max_wait_ms: Optional[float] = None, isolated: bool = False,
+                 when: Union[Dict, Callable, None] = None):
+        """
+        订阅事件，支持async def定义的协程函数
+        :param bind_event: 订阅的事件类型，支持通配符，如Emby*、*
+        :param order: 执行顺序，越小越先执行
+        :param concurrency: 后台投递时同时执行的最大数量
+        :param queue_size: 后台投递队列的最大长度
+        :param overflow: 队列满时的处理策略：drop_oldest（默认）、coalesce、block（发布方最多等待1秒）
+        :param coalesce_key: coalesce策略下的合并键，事件数据的字段名（如tmdb_id）或计算函数
+        :param batch: 是否为批量监听器，批量监听器收到的事件数据是一个列表
+        :param max_batch: 批量监听器单批的最大数量
+        :param max_wait_ms: 批量监听器后台攒批时最多等待的毫秒数
+        :param isolated: 是否在独立的进程池中执行，适合CPU密集的处理；函数需要定义在模块顶层，事件数据需要可以被pickle
+        :param when: 事件数据需要满足的条件，不满足时不调用；可以是判断函数，或者字段到期望值的字典，如{'type': 'Movie'}，
+        字段支持用.访问嵌套数据，期望值可以是单个值、可选值的列表或判断函数
+        """
         def decorator(func: Callable):
-            @functools.wraps(func)
-            def wrap(*args, **kwargs):
-                return func(*args, **kwargs)
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrap(*args, **kwargs):
+                    return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrap(*args, **kwargs):
+                    return func(*args, **kwargs)
 
-            listener = EventListener(wrap, bind_event, order)
+            listener = EventListener(wrap, bind_event, order, concurrency, queue_size, overflow, coalesce_key, batch,
+                                     max_batch, max_wait_ms, isolated, when)
             if hasattr(local_var, 'plugin'):
                 listener.set_plugin(local_var.plugin)
             self._listener.append(listener)
@@ -254,10 +384,11 @@ class PluginCommandContext:
 class PluginContext:
     """插件上下文信息，包含一些实现插件执行前后一些关键对象"""
 
-    def __init__(self, mbot, plugin: PluginMeta, config: dict = None):
+    def __init__(self, mbot, plugin: PluginMeta, config: Union[dict, ConfigNode] = None):
         self.mbot = mbot
         self.plugin: PluginMeta = plugin
         if config:
+            # 事件总线传入的是配置快照里的只读节点，用法和dict一致
             self.config = config
         else:
             self.config: dict = dict()
@@ -0,0 +1,360 @@
+"""
+插件安装包的下载和安装
+安装包分块流式下载，中断后用Range请求从已下载的位置续传；下载完成后校验sha256，
+并按sha256缓存在插件目录的.cache中，重新安装或回滚到缓存过的版本时不需要再次下载；
+下载和解压在后台线程中执行，通过InstallProgress查询进度
+"""
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, Future
+from enum import Enum
+from typing import Dict, List, Optional
+
+import httpx
+
+from mbot.common.extractutils import ExtractUtils
+from mbot.common.osutils import OSUtils
+from mbot.common.serializable import Serializable
+from mbot.exceptions import PluginsErrorException
+
+_LOGGER = logging.getLogger(__name__)
+
+"""插件目录中存放安装包缓存的文件夹"""
+CACHE_FOLDER = '.cache'
+"""计算文件摘要时每次读取的字节数"""
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+"""下载中断后续传的次数"""
+DEFAULT_DOWNLOAD_RETRIES = 3
+"""每个插件保留的安装记录数量，用于回滚"""
+INSTALL_HISTORY_SIZE = 5
+"""安装结束后保留进度记录的秒数，过期后不再能查询"""
+PROGRESS_TTL = 3600
+"""支持解压的安装包扩展名"""
+PACKAGE_EXTENSIONS = ('.zip', '.7z', '.gz', '.tar', '.rar')
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class InstallState(str, Enum):
+    Pending = 'pending'
+    Downloading = 'downloading'
+    Verifying = 'verifying'
+    Extracting = 'extracting'
+    Completed = 'completed'
+    Failed = 'failed'
+
+
+class InstallProgress(Serializable):
+    """一次安装的进度"""
+    hidden_fields = ['future']
+
+    def __init__(self, install_id: int, url: Optional[str] = None, sha256: Optional[str] = None):
+        self.install_id = install_id
+        self.url = url
+        self.state = InstallState.Pending
+        self.downloaded = 0
+        # 服务器没有返回长度时为空
+        self.total: Optional[int] = None
+        self.sha256 = sha256
+        self.from_cache = False
+        self.plugin_path: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at = datetime.datetime.now()
+        self.finished_at: Optional[datetime.datetime] = None
+        self.future: Optional[Future] = None
+
+    @property
+    def percent(self) -> Optional[float]:
+        if self.state == InstallState.Completed:
+            return 100.0
+        if not self.total:
+            return
+        return round(min(self.downloaded / self.total, 1) * 100, 1)
+
+    def to_json(self, hidden_fields=None):
+        data = super().to_json(hidden_fields)
+        data['percent'] = self.percent
+        return data
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[str]:
+        """等待后台安装完成，返回插件目录，安装失败时抛出异常"""
+        if self.future is None:
+            return self.plugin_path
+        return self.future.result(timeout)
+
+
+def _file_sha256(filepath: str, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def _package_ext(name: str) -> str:
+    path = urllib.parse.urlparse(name).path if '://' in name else name
+    ext = os.path.splitext(path)[-1].lower()
+    return ext if ext in PACKAGE_EXTENSIONS else '.zip'
+
+
+class PackageCache:
+    """按sha256缓存的插件安装包，同时记录每个插件最近安装过的安装包"""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.partial_folder = os.path.join(folder, 'partial')
+        self.index_filepath = os.path.join(folder, 'index.json')
+        self._lock = threading.Lock()
+
+    def path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.folder, f'{sha256.lower()}{ext}')
+
+    def get(self, sha256: Optional[str]) -> Optional[str]:
+        """按sha256查找缓存的安装包"""
+        if not sha256 or not os.path.exists(self.folder):
+            return
+        sha256 = sha256.lower()
+        for ext in PACKAGE_EXTENSIONS:
+            filepath = os.path.join(self.folder, f'{sha256}{ext}')
+            if os.path.exists(filepath):
+                return filepath
+
+    def put(self, filepath: str, sha256: Optional[str] = None, ext: Optional[str] = None) -> str:
+        """把安装包移动到缓存中，返回缓存的路径"""
+        os.makedirs(self.folder, exist_ok=True)
+        sha256 = sha256 or _file_sha256(filepath).hexdigest()
+        dst = self.path(sha256, ext or _package_ext(filepath))
+        os.replace(filepath, dst)
+        return dst
+
+    def partial_path(self, url: str) -> str:
+        """下载中的文件路径，同一个地址中断后从这里续传"""
+        os.makedirs(self.partial_folder, exist_ok=True)
+        return os.path.join(self.partial_folder, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.part')
+
+    def _read_index(self) -> Dict[str, List[Dict]]:
+        if not os.path.exists(self.index_filepath):
+            return dict()
+        try:
+            with open(self.index_filepath, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            _LOGGER.error(f'读取插件安装记录失败：{self.index_filepath}', exc_info=True)
+            return dict()
+
+    def record(self, plugin_name: str, sha256: str, version: Optional[str] = None):
+        """记录插件安装了哪个安装包，超出保留数量的旧安装包从缓存中删除"""
+        with self._lock:
+            index = self._read_index()
+            history = [x for x in index.get(plugin_name, []) if x.get('sha256') != sha256]
+            history.append({'sha256': sha256, 'version': version, 'installed_at': str(datetime.datetime.now())})
+            expired, history = history[:-INSTALL_HISTORY_SIZE], history[-INSTALL_HISTORY_SIZE:]
+            index[plugin_name] = history
+            in_use = {x.get('sha256') for items in index.values() for x in items}
+            for x in expired:
+                if x.get('sha256') in in_use:
+                    continue
+                filepath = self.get(x.get('sha256'))
+                if filepath:
+                    os.remove(filepath)
+            tmp = self.index_filepath + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.index_filepath)
+
+    def history(self, plugin_name: str) -> List[Dict]:
+        """插件的安装记录，从早到晚排列"""
+        with self._lock:
+            return list(self._read_index().get(plugin_name, []))
+
+
+class PluginInstaller:
+    """插件安装器，下载和解压在后台线程中串行执行"""
+
+    def __init__(self, plugin_folder: str, transport: Optional[httpx.BaseTransport] = None,
+                 retries: int = DEFAULT_DOWNLOAD_RETRIES):
+        """
+        :param plugin_folder: 插件所在目录
+        :param transport: 下载使用的httpx传输层，为空时使用默认的网络连接
+        :param retries: 下载中断后续传的次数
+        """
+        self.plugin_folder = plugin_folder
+        self.cache = PackageCache(os.path.join(plugin_folder, CACHE_FOLDER))
+        self.transport = transport
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PluginInstaller')
+        self._progress: Dict[int, InstallProgress] = dict()
+        self._seq = itertools.count(1)
+
+    def _stream(self, client: httpx.Client, url: str, partial: str, progress: InstallProgress):
+        """从已下载的位置继续下载，返回整个文件的sha256摘要"""
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        with client.stream('GET', url, headers=headers) as r:
+            if r.status_code == 416 and offset:
+                # 已经下载完整，服务器没有更多内容
+                progress.downloaded = progress.total = offset
+                return _file_sha256(partial)
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                # 服务器不支持续传，从头下载
+                offset = 0
+            digest = _file_sha256(partial) if offset else hashlib.sha256()
+            length = r.headers.get('content-length')
+            progress.total = offset + int(length) if length and length.isdigit() else None
+            progress.downloaded = offset
+            with open(partial, 'ab' if offset else 'wb') as f:
+                # 按网络读到的大小写入，连接中断时已经收到的内容都已落盘，可以续传
+                for chunk in r.iter_bytes():
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    digest.update(chunk)
+                    progress.downloaded += len(chunk)
+        if progress.total is not None and progress.downloaded < progress.total:
+            raise httpx.ReadError(f'下载的内容不完整：{progress.downloaded}/{progress.total}')
+        return digest
+
+    def download(self, url: str, sha256: Optional[str] = None,
+                 progress: Optional[InstallProgress] = None) -> str:
+        """
+        下载安装包到缓存，已经缓存过相同sha256的安装包时直接返回
+        :param url: 下载地址
+        :param sha256: 安装包的sha256，为空时不校验
+        :return: 缓存中的安装包路径
+        """
+        progress = progress or InstallProgress(0, url, sha256)
+        cached = self.cache.get(sha256)
+        if cached:
+            progress.from_cache = True
+            progress.downloaded = progress.total = os.path.getsize(cached)
+            return cached
+        progress.state = InstallState.Downloading
+        partial = self.cache.partial_path(url)
+        digest = None
+        with httpx.Client(transport=self.transport, follow_redirects=True, timeout=30) as client:
+            for attempt in range(self.retries + 1):
+                try:
+                    digest = self._stream(client, url, partial, progress)
+                    break
+                except httpx.TransportError as e:
+                    if attempt >= self.retries:
+                        raise PluginsErrorException(f'插件下载失败：{url} {e}')
+                    _LOGGER.warning(f'插件下载中断，从{progress.downloaded}字节处续传：{url}')
+        progress.state = InstallState.Verifying
+        actual = digest.hexdigest()
+        progress.sha256 = actual
+        if sha256 and actual != sha256.lower():
+            os.remove(partial)
+            raise PluginsErrorException(f'插件安装包校验失败：{url} 期望sha256为{sha256}，实际为{actual}')
+        return self.cache.put(partial, actual, _package_ext(url))
+
+    def extract(self, package_path: str) -> str:
+        """解压安装包并替换插件目录，返回插件目录"""
+        ex_path = os.path.join(self.cache.folder, 'extract', str(round(datetime.datetime.now().timestamp() * 1000)))
+        try:
+            # 解压工具按扩展名判断格式
+            ExtractUtils.extract_file(package_path, ex_path)
+            manifest_path = OSUtils.find_file(ex_path, MANIFEST_FILENAME)
+            if not manifest_path:
+                raise PluginsErrorException(f'插件安装包中没有插件描述文件：{package_path}')
+            parent_path = os.path.split(manifest_path)[0]
+            if os.path.abspath(parent_path) == os.path.abspath(ex_path):
+                raise PluginsErrorException(f'插件安装包中需要包含插件文件夹：{package_path}')
+            dst = os.path.join(self.plugin_folder, os.path.split(parent_path)[-1])
+            backup = None
+            if os.path.exists(dst):
+                backup = f'{ex_path}.old'
+                os.replace(dst, backup)
+            shutil.move(parent_path, dst)
+            if backup:
+                shutil.rmtree(backup, ignore_errors=True)
+            return dst
+        finally:
+            shutil.rmtree(ex_path, ignore_errors=True)
+
+    def _record(self, plugin_path: str, sha256: str):
+        manifest_path = os.path.join(plugin_path, MANIFEST_FILENAME)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.cache.record(manifest.get('name'), sha256, manifest.get('version'))
+        except Exception as e:
+            _LOGGER.error(f'记录插件安装包失败：{plugin_path}', exc_info=True)
+
+    def _install(self, progress: InstallProgress, package_path: Optional[str] = None) -> str:
+        try:
+            if not package_path:
+                package_path = self.download(progress.url, progress.sha256, progress)
+            elif not progress.sha256:
+                progress.sha256 = os.path.splitext(os.path.basename(package_path))[0]
+            progress.state = InstallState.Extracting
+            progress.plugin_path = self.extract(package_path)
+            self._record(progress.plugin_path, progress.sha256)
+            progress.state = InstallState.Completed
+            _LOGGER.info(f'插件安装完毕，已经解压到：{progress.plugin_path}')
+            return progress.plugin_path
+        except Exception as e:
+            progress.state = InstallState.Failed
+            progress.error = str(e)
+            _LOGGER.error(f'插件安装失败：{progress.url or package_path}', exc_info=True)
+            raise
+        finally:
+            progress.finished_at = datetime.datetime.now()
+
+    def _evict_progress(self):
+        """移除已经结束超过PROGRESS_TTL的进度记录，进度记录不会无限增长"""
+        expired_at = datetime.datetime.now() - datetime.timedelta(seconds=PROGRESS_TTL)
+        for install_id, progress in list(self._progress.items()):
+            if progress.finished_at and progress.finished_at < expired_at:
+                self._progress.pop(install_id, None)
+
+    def _submit(self, progress: InstallProgress, package_path: Optional[str] = None) -> InstallProgress:
+        self._evict_progress()
+        self._progress[progress.install_id] = progress
+        progress.future = self.executor.submit(self._install, progress, package_path)
+        return progress
+
+    def install(self, url: str, sha256: Optional[str] = None) -> InstallProgress:
+        """在后台下载并安装插件，立即返回安装进度"""
+        _LOGGER.info(f'开始下载插件：{url}')
+        return self._submit(InstallProgress(next(self._seq), url, sha256))
+
+    def install_file(self, filepath: str) -> InstallProgress:
+        """在后台安装本地的安装包，安装包会被移动到缓存中"""
+        sha256 = _file_sha256(filepath).hexdigest()
+        package_path = self.cache.put(filepath, sha256)
+        return self._submit(InstallProgress(next(self._seq), sha256=sha256), package_path)
+
+    def rollback(self, plugin_name: str, sha256: Optional[str] = None) -> InstallProgress:
+        """
+        用缓存的安装包重新安装插件
+        :param sha256: 要安装的安装包，为空时安装上一次安装的版本
+        """
+        history = self.cache.history(plugin_name)
+        if sha256:
+            target = next((x for x in history if x.get('sha256') == sha256.lower()), None)
+        else:
+            target = history[-2] if len(history) >= 2 else None
+        package_path = self.cache.get(target.get('sha256')) if target else None
+        if not package_path:
+            raise PluginsErrorException(f'没有可以回滚的插件安装包：{plugin_name}')
+        _LOGGER.info(f'开始回滚插件{plugin_name}到版本：{target.get("version")}')
+        return self._submit(InstallProgress(next(self._seq), sha256=target.get('sha256')), package_path)
+
+    def get_progress(self, install_id: Optional[int] = None) -> List[InstallProgress]:
+        """
+        获取安装进度，安装结束超过PROGRESS_TTL秒的记录不再返回
+        :param install_id: 为空时返回全部安装记录
+        """
+        self._evict_progress()
+        if install_id:
+            progress = self._progress.get(install_id)
+            return [progress] if progress else []
+        return list(self._progress.values())
@@ -0,0 +1,70 @@
+"""
+插件的延迟激活：插件描述文件中声明了activation时，启动阶段不导入插件代码，
+只按声明注册轻量的占位事件监听、功能指令和定时任务，第一次被触发时才导入插件并注册真正的扩展点
+
+描述文件示例：
+"activation": {
+    "events": ["EmbyPlay*"],
+    "commands": [{"name": "sync", "title": "同步", "args": [{"name": "days", "type": "Int", "label": "天数"}]}],
+    "tasks": [{"name": "sync_task", "desc": "定时同步", "minutes": 30}]
+}
+"""
+import collections
+import logging
+import typing
+from typing import Dict, List, Optional
+
+from mbot.core.params import ArgSchema, ArgType
+from mbot.core.plugins import PluginCommand, PluginCommandResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+"""占位定时任务可以从描述文件中读取的参数"""
+TASK_OPTIONS = ('cron_expression', 'jitter', 'minutes', 'seconds', 'run_at_startup', 'max_instances', 'coalesce',
+                'misfire_grace_time', 'pool', 'priority', 'requires', 'spread', 'targets', 'adaptive', 'max_interval')
+
+
+def is_lazy(activation: Optional[Dict]) -> bool:
+    """描述文件是否声明了延迟激活"""
+    if not activation or not isinstance(activation, dict):
+        return False
+    return bool(activation.get('events') or activation.get('commands') or activation.get('tasks'))
+
+
+def _arg_schema(args: Optional[List[Dict]]) -> typing.OrderedDict[str, ArgSchema]:
+    schema: typing.OrderedDict[str, ArgSchema] = collections.OrderedDict()
+    for arg in args or []:
+        name = arg.get('name')
+        if not name:
+            continue
+        arg_type = ArgType.__members__.get(arg.get('type') or 'String', ArgType.String)
+        s = ArgSchema(arg_type, arg.get('label') or name, arg.get('help') or arg.get('label') or name, name,
+                      enum_values=arg.get('enumValues'), default_value=arg.get('default'),
+                      required=arg.get('required'))
+        schema.update({name: s})
+    return schema
+
+
+class LazyPluginCommand(PluginCommand):
+    """延迟激活插件的占位功能指令，调用时先激活插件，再交给插件中同名的功能指令执行"""
+
+    def __init__(self, activator: typing.Callable[[str], typing.Any], plugin_name: str, spec: Dict):
+        super().__init__(self._placeholder, spec.get('name'), spec.get('title') or spec.get('name'), spec.get('desc'),
+                         spec.get('icon'), bool(spec.get('runInBackground')))
+        self.activator = activator
+        self.plugin_name = plugin_name
+        # 激活前使用描述文件中声明的参数
+        self.arg_schema = _arg_schema(spec.get('args'))
+
+    @staticmethod
+    def _placeholder(ctx):
+        pass
+
+    def __call__(self, ctx, args_data: Optional[Dict] = None) -> PluginCommandResponse:
+        plugin = self.activator(self.plugin_name)
+        if plugin:
+            for command in plugin.get_command():
+                if command.name == self.name and not isinstance(command, LazyPluginCommand):
+                    return command(ctx, args_data)
+        _LOGGER.error(f'插件{self.plugin_name}激活后没有找到功能指令：{self.name}')
+        return PluginCommandResponse(False, f'插件没有提供功能指令：{self.title}')
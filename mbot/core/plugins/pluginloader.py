@@ -1,27 +1,40 @@
 """
 系统插件的加载器核心实现，所有的系统内置插件、外部自定义插件，均有此加载为可执行的实例
 系统内提供了多种插件扩展点，当前支持的有：事件监听、定时任务，持续扩充中
+加载时先读取全部插件的描述文件，按描述文件中声明的插件依赖分批，同一批内没有依赖关系的插件并行导入，
+并记录每个插件读取描述文件、导入代码、注册扩展点以及after_setup的耗时；
+描述文件中声明了activation的插件延迟激活，启动时只注册占位的扩展点，第一次被触发时才导入插件代码；
+单个插件可以在不重启进程的情况下重新加载，重新导入这个插件的模块后一次性替换它的监听器、定时任务和功能指令；
+插件安装包由PluginInstaller在后台流式下载、校验并按sha256缓存
 """
-import datetime
 import importlib
 import json
 import logging
 import os.path
 import shutil
 import sys
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import List, Dict, Optional, Tuple, Set
 
-import httpx
-
-from mbot.common.extractutils import ExtractUtils
-from mbot.common.osutils import OSUtils
+from mbot.common.serializable import Serializable
 from mbot.core import MovieBot
+from mbot.core.configstore import ConfigNode, ConfigSnapshot
 from mbot.core.context import local_var
+from mbot.core.event.eventlistener import EventListener
 from mbot.core.plugins import PluginManifest, PluginMeta
+from mbot.core.plugins.installer import PluginInstaller, InstallProgress, CACHE_FOLDER, MANIFEST_FILENAME
+from mbot.core.plugins.lazy import LazyPluginCommand, is_lazy, TASK_OPTIONS
+from mbot.core.plugins.watcher import PluginWatcher, DEFAULT_POLL_INTERVAL, DEFAULT_DEBOUNCE
 from mbot.exceptions import MovieBotException, PluginsErrorException
 
-MANIFEST_FILENAME = 'manifest.json'
-SKIP_FOLDER = ['__pycache__']
+SKIP_FOLDER = ['__pycache__', CACHE_FOLDER]
+"""并行加载插件时默认的线程数"""
+DEFAULT_LOAD_WORKERS = 8
+"""加载完成后日志中列出的最慢插件数量"""
+SLOWEST_PLUGINS_IN_LOG = 5
 
 
 class ManifestErrorException(MovieBotException):
@@ -32,21 +45,65 @@ class ManifestErrorException(MovieBotException):
 _LOGGER = logging.getLogger(__name__)
 
 
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+class PluginLoadProfile(Serializable):
+    """单个插件的加载耗时"""
+
+    def __init__(self, name: str, plugin_path: str):
+        self.name = name
+        self.title = None
+        self.plugin_path = plugin_path
+        # 按依赖关系划分的加载批次，从0开始
+        self.wave = 0
+        self.manifest_ms = 0.0
+        self.import_ms = 0.0
+        self.register_ms = 0.0
+        self.after_setup_ms = 0.0
+        self.success = False
+
+    @property
+    def total_ms(self) -> float:
+        return round(self.manifest_ms + self.import_ms + self.register_ms + self.after_setup_ms, 3)
+
+    def to_json(self, hidden_fields=None):
+        data = super().to_json(hidden_fields)
+        data['total_ms'] = self.total_ms
+        return data
+
+
 class PluginLoader:
     """插件加载器"""
 
-    def __init__(self, plugin_folder, namespace, mbot: MovieBot):
+    def __init__(self, plugin_folder, namespace, mbot: MovieBot, lazy: bool = True):
         """
         初始化事件加载器
         :param plugin_folder: 插件所在目录
         :param namespace: 插件目录在系统内的模块包路径
         :param mbot: 应用超级对象
+        :param lazy: 是否允许声明了activation的插件延迟激活
         """
         if not plugin_folder:
             return
         self.plugin_folder = plugin_folder
         self.namespace = namespace
         self.mbot = mbot
+        # 最近一次加载每个插件的耗时，按插件名索引
+        self.profiles: Dict[str, PluginLoadProfile] = dict()
+        # 注册扩展点和修改插件列表时串行执行
+        self._register_lock = threading.RLock()
+        self.lazy = lazy
+        # 延迟激活插件注册的占位监听器和占位任务名称，激活后移除
+        self._lazy_listeners: Dict[str, List[EventListener]] = dict()
+        self._lazy_tasks: Dict[str, Set[str]] = dict()
+        self._activate_lock = threading.RLock()
+        self.watcher: Optional[PluginWatcher] = None
+        self.installer = PluginInstaller(plugin_folder)
+        # 已经订阅变化的插件配置，插件配置被修改时调用插件的config_changed
+        self._watched_config = None
+        self._config_unsubscribe = None
 
     @staticmethod
     def get_manifest(plugin_path) -> PluginManifest:
@@ -62,25 +119,112 @@ class PluginLoader:
             meta = json.load(file)
         return PluginManifest(meta, plugin_meta_filepath)
 
-    def load(self) -> List[PluginMeta]:
+    def _read_manifest(self, plugin_path: str) -> Tuple[str, Optional[PluginManifest], PluginLoadProfile]:
+        profile = PluginLoadProfile(os.path.split(plugin_path)[-1], plugin_path)
+        start = time.perf_counter()
+        manifest = None
+        try:
+            manifest = self.get_manifest(plugin_path)
+        except Exception as e:
+            _LOGGER.error(f'读取插件描述文件失败：{plugin_path}', exc_info=True)
+        profile.manifest_ms = _elapsed_ms(start)
+        if manifest:
+            profile.name = manifest.name
+            profile.title = manifest.title
+        return plugin_path, manifest, profile
+
+    @staticmethod
+    def _load_waves(manifests: List[Tuple[str, PluginManifest, PluginLoadProfile]]) \
+            -> List[List[Tuple[str, PluginManifest, PluginLoadProfile]]]:
+        """
+        按插件描述文件中的dependencies划分加载批次，依赖的插件总是在更早的批次中加载；
+        dependencies中不是插件名的依赖项不参与排序，依赖关系有环的插件放到最后一批按目录顺序加载
+        """
+        by_name = {m.name: (path, m, profile) for path, m, profile in manifests}
+        deps = {}
+        for path, m, profile in manifests:
+            deps[m.name] = {d for d in (m.dependencies or {}) if d in by_name and d != m.name}
+        waves = []
+        loaded = set()
+        remaining = [m.name for _, m, _ in manifests]
+        while remaining:
+            wave = [name for name in remaining if deps[name] <= loaded]
+            if not wave:
+                _LOGGER.warning(f'插件之间的依赖关系有环，按目录顺序加载：{",".join(remaining)}')
+                wave = remaining
+            waves.append([by_name[name] for name in wave])
+            loaded.update(wave)
+            remaining = [name for name in remaining if name not in loaded]
+        for i, wave in enumerate(waves):
+            for _, _, profile in wave:
+                profile.wave = i
+        return waves
+
+    def load(self, parallel: bool = True, max_workers: int = DEFAULT_LOAD_WORKERS) -> List[PluginMeta]:
         """
         加载目录下所有插件
+        :param parallel: 是否并行加载；为False时仍按依赖顺序逐个加载
+        :param max_workers: 并行加载的线程数
         :return:
         """
         if not os.path.exists(self.plugin_folder):
             _LOGGER.error(f'插件目录不存在：{self.plugin_folder}')
             return
-        plugins: List[PluginMeta] = []
-        for p in os.listdir(self.plugin_folder):
+        self._watch_config()
+        start = time.perf_counter()
+        paths = []
+        for p in sorted(os.listdir(self.plugin_folder)):
             plugin_path = os.path.join(self.plugin_folder, p)
             if os.path.isfile(plugin_path) or p in SKIP_FOLDER:
                 continue
-            plugin = self.setup(plugin_path)
-            if not plugin:
-                continue
-            plugins.append(plugin)
+            paths.append(plugin_path)
+        workers = max(1, min(max_workers or 1, len(paths))) if parallel else 1
+        plugins: List[PluginMeta] = []
+        self.profiles = dict()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='PluginLoader') as executor:
+            manifests = []
+            for plugin_path, manifest, profile in executor.map(self._read_manifest, paths):
+                self.profiles[profile.name] = profile
+                if not manifest:
+                    _LOGGER.error(f'加载插件时没有发现插件描述文件: {plugin_path}/manifest.json')
+                    continue
+                manifests.append((plugin_path, manifest, profile))
+            for wave in self._load_waves(manifests):
+                # 同一批插件之间没有依赖关系，可以同时导入；下一批等这一批全部完成后再开始
+                for plugin in executor.map(lambda x: self._setup(*x), wave):
+                    if plugin:
+                        plugins.append(plugin)
+        slowest = sorted(self.profiles.values(), key=lambda x: x.total_ms, reverse=True)[:SLOWEST_PLUGINS_IN_LOG]
+        _LOGGER.info(f'{len(plugins)}个插件加载完成，耗时{_elapsed_ms(start)}毫秒，最慢的插件：' +
+                     '，'.join(f'{x.title or x.name}({x.total_ms}ms)' for x in slowest))
         return plugins
 
+    def _watch_config(self):
+        plugins_config = self.mbot.config.plugins_config
+        if plugins_config is None or plugins_config is self._watched_config:
+            return
+        if self._config_unsubscribe:
+            self._config_unsubscribe()
+        self._watched_config = plugins_config
+        self._config_unsubscribe = plugins_config.subscribe('', self._on_config_changed)
+
+    def _on_config_changed(self, snapshot: ConfigSnapshot, changed: List[str]):
+        """插件配置发生变化时，把插件最新的配置交给插件的config_changed"""
+        for plugin_name in dict.fromkeys(p.split('.', 1)[0] for p in changed):
+            plugin: PluginMeta = self.mbot.plugins.get(plugin_name)
+            if not plugin or not plugin._config_changed:
+                continue
+            config = snapshot.root.get(plugin_name)
+            config = config.to_dict() if isinstance(config, ConfigNode) else (config or {})
+            try:
+                plugin._config_changed(config)
+            except Exception as e:
+                _LOGGER.error(f'插件{plugin.manifest.title}处理配置变化失败', exc_info=True)
+
+    def get_load_profiles(self) -> List[PluginLoadProfile]:
+        """最近一次加载每个插件的耗时，按总耗时从高到低排列"""
+        return sorted(self.profiles.values(), key=lambda x: x.total_ms, reverse=True)
+
     def import_mod(self, name):
         """
         导入模块
@@ -113,11 +257,19 @@ class PluginLoader:
         :param plugin_path: 插件所在目录
         :return:
         """
+        plugin_path, manifest, profile = self._read_manifest(plugin_path)
+        if not manifest:
+            _LOGGER.error(f'加载插件时没有发现插件描述文件: {plugin_path}/manifest.json')
+            return
+        self._watch_config()
+        self.profiles[profile.name] = profile
+        return self._setup(plugin_path, manifest, profile)
+
+    def _setup(self, plugin_path: str, manifest: PluginManifest, profile: PluginLoadProfile) -> PluginMeta:
+        if self.lazy and is_lazy(manifest.activation):
+            return self._setup_lazy(plugin_path, manifest, profile)
         try:
-            manifest = self.get_manifest(plugin_path)
-            if not manifest:
-                _LOGGER.error(f'加载插件时没有发现插件描述文件: {plugin_path}/manifest.json')
-                return
+            start = time.perf_counter()
             local_var.plugin_manifest = manifest
             mod_name = os.path.split(plugin_path)[-1]
             full_mod_name = f'{self.namespace}.{mod_name}'
@@ -128,80 +280,303 @@ class PluginLoader:
             """
             local_var.plugin = plugin
             self.import_mod(full_mod_name)
-            self.mbot.plugins.update({manifest.name: plugin})
-            """
-            经过插件加载后，同线程可见的插件元数据对象内，应该加载了很多扩展点，注册到主程序
-            """
-            if plugin.get_listener():
-                for x in plugin.get_listener():
-                    # 注册插件定义的事件监听器
-                    self.mbot.event_bus.add_listener(x)
-            if plugin.get_task():
-                for x in plugin.get_task():
-                    # 注册插件定义的定时任务
-                    self.mbot.task_manager.add_task(x.task, x.name, x.desc, x.cron_expression, x.jitter, x.minutes,
-                                                    x.seconds, x.run_at_startup, x.run_at_startup_in_thread,
-                                                    manifest.name)
+            profile.import_ms = _elapsed_ms(start)
+            start = time.perf_counter()
+            with self._register_lock:
+                self._register(plugin)
+            profile.register_ms = _elapsed_ms(start)
             if plugin._after_setup:
+                start = time.perf_counter()
                 # 触发插件中标记的after_setup函数
                 plugin._after_setup(plugin, self.mbot.config.plugins_config.get(manifest.name) or {})
+                profile.after_setup_ms = _elapsed_ms(start)
+            profile.success = True
             return plugin
         except Exception as e:
             _LOGGER.error(f'插件加载失败（请尝试删除重新安装）：{plugin_path}', exc_info=True)
 
-    def _download_file(self, url):
-        r = httpx.get(url)
-        if not r:
-            raise RuntimeWarning(f'download error: {url}')
-        filename = os.path.basename(url)
-        filepath = os.path.join(self.plugin_folder, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        with open(filepath, "wb") as f:
-            f.write(r.content)
-            f.flush()
-        return filepath
-
-    def install(self, download_url) -> str:
-        _LOGGER.info(f'开始下载插件：{download_url}')
-        filepath = self._download_file(download_url)
-        return self.install_by_filepath(filepath)
+    def _setup_lazy(self, plugin_path: str, manifest: PluginManifest, profile: PluginLoadProfile) -> PluginMeta:
+        """按描述文件中的activation注册占位的扩展点，不导入插件代码"""
+        try:
+            start = time.perf_counter()
+            plugin_name = manifest.name
+            plugin = PluginMeta(plugin_name, f'{self.namespace}.{os.path.split(plugin_path)[-1]}', manifest,
+                                plugin_path)
+            plugin.lazy = True
+            activation = manifest.activation
+            with self._register_lock:
+                self.mbot.plugins.update({plugin_name: plugin})
+                self.mbot.event_bus.invalidate_context(plugin_name)
+                for stub in self._lazy_listeners.pop(plugin_name, []):
+                    self.mbot.event_bus.remove_listener(stub)
+                if activation.get('events'):
+                    stub = EventListener(self._lazy_event_handler(plugin_name), activation.get('events'))
+                    stub.set_plugin(plugin)
+                    self.mbot.event_bus.add_listener(stub, show_log=False)
+                    self._lazy_listeners[plugin_name] = [stub]
+                for spec in activation.get('commands') or []:
+                    plugin.get_command().append(LazyPluginCommand(self.activate, plugin_name, spec))
+                task_names = set()
+                for spec in activation.get('tasks') or []:
+                    options = {k: spec[k] for k in TASK_OPTIONS if k in spec}
+                    self.mbot.task_manager.add_task(self._lazy_task(plugin_name, spec.get('name')), spec.get('name'),
+                                                    spec.get('desc') or spec.get('name'), plugin_name=plugin_name,
+                                                    **options)
+                    task_names.add(spec.get('name'))
+                self._lazy_tasks[plugin_name] = task_names
+            profile.register_ms = _elapsed_ms(start)
+            profile.success = True
+            _LOGGER.info(f'插件{manifest.title}声明了延迟激活，将在第一次被触发时加载')
+            return plugin
+        except Exception as e:
+            _LOGGER.error(f'插件加载失败（请尝试删除重新安装）：{plugin_path}', exc_info=True)
+
+    def _lazy_event_handler(self, plugin_name: str):
+        def lazy_activation(ctx, event_type, data):
+            if self.activate(plugin_name):
+                # 占位监听器已经被替换，补发触发激活的这一次事件
+                self.mbot.event_bus.publish_to_plugin(plugin_name, event_type, data)
+
+        return lazy_activation
+
+    def _lazy_task(self, plugin_name: str, task_name: str):
+        def lazy_task():
+            plugin = self.activate(plugin_name)
+            if not plugin:
+                return
+            for x in plugin.get_task():
+                if x.name == task_name:
+                    return x.task()
+            _LOGGER.error(f'插件{plugin.manifest.title}激活后没有找到定时任务：{task_name}')
+
+        lazy_task.__name__ = f'lazy_{task_name}'
+        return lazy_task
+
+    def activate(self, plugin_name: str) -> Optional[PluginMeta]:
+        """
+        激活一个延迟激活的插件：导入插件代码，移除占位扩展点并注册真正的扩展点；已经激活的插件直接返回
+        :return: 插件元信息，激活失败时返回None
+        """
+        plugin: PluginMeta = self.mbot.plugins.get(plugin_name)
+        if not plugin or not plugin.lazy or plugin.activated:
+            return plugin
+        with self._activate_lock:
+            if plugin.activated:
+                return plugin
+            start = time.perf_counter()
+            stub_commands = [x for x in plugin.get_command() if isinstance(x, LazyPluginCommand)]
+            plugin._command = [x for x in plugin.get_command() if not isinstance(x, LazyPluginCommand)]
+            prev_plugin = getattr(local_var, 'plugin', None)
+            prev_manifest = getattr(local_var, 'plugin_manifest', None)
+            local_var.plugin_manifest = plugin.manifest
+            local_var.plugin = plugin
+            try:
+                mod = self.import_mod(plugin.module_name)
+            finally:
+                local_var.plugin = prev_plugin
+                local_var.plugin_manifest = prev_manifest
+            if mod is None:
+                plugin._command = stub_commands + plugin._command
+                _LOGGER.error(f'插件{plugin.manifest.title}激活失败，下次触发时重试')
+                return
+            try:
+                with self._register_lock:
+                    for stub in self._lazy_listeners.pop(plugin_name, []):
+                        self.mbot.event_bus.remove_listener(stub)
+                    self._register(plugin, self._lazy_tasks.pop(plugin_name, set()))
+                plugin.activated = True
+                if plugin._after_setup:
+                    plugin._after_setup(plugin, self.mbot.config.plugins_config.get(plugin_name) or {})
+            except Exception as e:
+                _LOGGER.error(f'插件{plugin.manifest.title}激活失败', exc_info=True)
+            _LOGGER.info(f'插件{plugin.manifest.title}已经激活，耗时{_elapsed_ms(start)}毫秒')
+        return plugin
+
+    def _register(self, plugin: PluginMeta, skip_tasks: Optional[Set[str]] = None):
+        """
+        经过插件加载后，同线程可见的插件元数据对象内，应该加载了很多扩展点，注册到主程序
+        :param skip_tasks: 已经用占位任务调度的任务名称，占位任务会转交给插件中的同名任务，不再重复注册
+        """
+        manifest = plugin.manifest
+        self.mbot.plugins.update({manifest.name: plugin})
+        # 同名插件重新加载时，之前缓存的插件上下文已经过期
+        self.mbot.event_bus.invalidate_context(manifest.name)
+        if plugin.get_listener():
+            for x in plugin.get_listener():
+                # 注册插件定义的事件监听器
+                self.mbot.event_bus.add_listener(x)
+        self._register_tasks(plugin, skip_tasks)
+
+    def _register_tasks(self, plugin: PluginMeta, skip_tasks: Optional[Set[str]] = None):
+        if not plugin.get_task():
+            return
+        for x in plugin.get_task():
+            if skip_tasks and x.name in skip_tasks:
+                continue
+            # 注册插件定义的定时任务
+            self.mbot.task_manager.add_task(x.task, x.name, x.desc, x.cron_expression, x.jitter, x.minutes,
+                                            x.seconds, x.run_at_startup, x.run_at_startup_in_thread,
+                                            plugin.manifest.name, max_instances=x.max_instances,
+                                            coalesce=x.coalesce, misfire_grace_time=x.misfire_grace_time,
+                                            pool=x.pool, priority=x.priority, requires=x.requires,
+                                            spread=x.spread, targets=x.targets, adaptive=x.adaptive,
+                                            max_interval=x.max_interval)
+
+    def _remove_tasks(self, plugin_name: str) -> int:
+        """移除插件注册的全部定时任务，包括延迟激活的占位任务"""
+        self._lazy_tasks.pop(plugin_name, None)
+        plugin_tasks = [t for t in self.mbot.task_manager.get_tasks() or [] if t.plugin_name == plugin_name]
+        for t in plugin_tasks:
+            self.mbot.task_manager.remove_task(t)
+        return len(plugin_tasks)
+
+    @staticmethod
+    def _purge_modules(module_name: str) -> Dict[str, ModuleType]:
+        """从sys.modules中移除插件包及其子模块，返回被移除的模块，重新导入失败时用来恢复"""
+        prefix = f'{module_name}.'
+        removed = {k: v for k, v in list(sys.modules.items()) if k == module_name or k.startswith(prefix)}
+        for k in removed:
+            sys.modules.pop(k, None)
+        return removed
+
+    def reload(self, plugin_name: str) -> Optional[PluginMeta]:
+        """
+        重新加载单个插件，不影响其他插件
+        只重新导入这个插件自己的模块，导入成功后在同一把锁内替换监听器、定时任务和功能指令；
+        导入失败时恢复原来的模块，旧插件继续工作
+        :param plugin_name: 插件名
+        :return: 新的插件元信息，重新加载失败时返回None
+        """
+        old: PluginMeta = self.mbot.plugins.get(plugin_name)
+        if not old:
+            raise PluginsErrorException(f'没有找到插件：{plugin_name}')
+        plugin_path, manifest, profile = self._read_manifest(old.plugin_folder)
+        if not manifest:
+            _LOGGER.error(f'重新加载插件时没有发现插件描述文件: {plugin_path}/manifest.json')
+            return
+        if manifest.name != plugin_name:
+            _LOGGER.error(f'插件描述文件中的插件名已经变为{manifest.name}，请卸载后重新安装：{plugin_path}')
+            return
+        with self._activate_lock:
+            if self.lazy and is_lazy(manifest.activation):
+                # 延迟激活的插件只需要重新注册占位扩展点，下次被触发时导入新的代码
+                with self._register_lock:
+                    self._purge_modules(old.module_name)
+                    self.mbot.event_bus.replace_listeners(
+                        self._lazy_listeners.pop(plugin_name, []) + list(old.get_listener() or []), [], plugin_name)
+                    self._remove_tasks(plugin_name)
+                    plugin = self._setup_lazy(plugin_path, manifest, profile)
+                if plugin:
+                    self.profiles[plugin_name] = profile
+                return plugin
+            start = time.perf_counter()
+            plugin = PluginMeta(manifest.name, old.module_name, manifest, plugin_path)
+            prev_plugin = getattr(local_var, 'plugin', None)
+            prev_manifest = getattr(local_var, 'plugin_manifest', None)
+            local_var.plugin_manifest = manifest
+            local_var.plugin = plugin
+            removed = self._purge_modules(old.module_name)
+            importlib.invalidate_caches()
+            try:
+                importlib.import_module(old.module_name)
+            except Exception as e:
+                _LOGGER.error(f'重新加载插件失败，继续使用之前的版本：{manifest.title}', exc_info=True)
+                self._purge_modules(old.module_name)
+                sys.modules.update(removed)
+                return
+            finally:
+                local_var.plugin = prev_plugin
+                local_var.plugin_manifest = prev_manifest
+            profile.import_ms = _elapsed_ms(start)
+            start = time.perf_counter()
+            with self._register_lock:
+                old_listeners = self._lazy_listeners.pop(plugin_name, []) + list(old.get_listener() or [])
+                self.mbot.plugins.update({plugin_name: plugin})
+                self.mbot.event_bus.replace_listeners(old_listeners, plugin.get_listener(), plugin_name)
+                self._remove_tasks(plugin_name)
+                self._register_tasks(plugin)
+            profile.register_ms = _elapsed_ms(start)
+            if plugin._after_setup:
+                start = time.perf_counter()
+                try:
+                    plugin._after_setup(plugin, self.mbot.config.plugins_config.get(plugin_name) or {})
+                except Exception as e:
+                    _LOGGER.error(f'插件{manifest.title}重新加载后执行after_setup失败', exc_info=True)
+                profile.after_setup_ms = _elapsed_ms(start)
+            profile.success = True
+            self.profiles[plugin_name] = profile
+            _LOGGER.info(f'插件{manifest.title}已经重新加载，耗时{profile.total_ms}毫秒')
+        return plugin
+
+    def _resolve_plugin(self, plugin_dir: str) -> Optional[str]:
+        plugin_dir = os.path.abspath(plugin_dir)
+        for name, plugin in list(self.mbot.plugins.items()):
+            if plugin.plugin_folder and os.path.abspath(plugin.plugin_folder) == plugin_dir:
+                return name
+
+    def watch(self, poll_interval: float = DEFAULT_POLL_INTERVAL, debounce: float = DEFAULT_DEBOUNCE,
+              use_inotify: bool = True) -> PluginWatcher:
+        """
+        监控插件目录，已加载插件的文件发生变化后自动重新加载这个插件
+        :param poll_interval: 不支持inotify时轮询的间隔秒数
+        :param debounce: 文件最后一次变化后等待的静默秒数
+        :param use_inotify: 是否优先使用inotify
+        """
+        if self.watcher is None:
+            self.watcher = PluginWatcher(self.plugin_folder, self.reload, self._resolve_plugin, poll_interval,
+                                         debounce, use_inotify)
+            self.watcher.start()
+        return self.watcher
+
+    def stop_watch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def install(self, download_url, sha256: Optional[str] = None) -> str:
+        """
+        下载并安装插件，等待安装完成
+        :param download_url: 安装包下载地址
+        :param sha256: 安装包的sha256，提供时会校验，缓存中已经有这个安装包时不再下载
+        :return: 插件目录
+        """
+        return self.install_async(download_url, sha256).wait()
+
+    def install_async(self, download_url, sha256: Optional[str] = None) -> InstallProgress:
+        """在后台下载并安装插件，立即返回安装进度"""
+        return self.installer.install(download_url, sha256)
 
     def install_by_filepath(self, filepath: str):
-        ex_path = os.path.join(self.plugin_folder, str(round(datetime.datetime.now().timestamp())))
-        ExtractUtils.extract_file(filepath, ex_path)
-        plugin_path = OSUtils.find_file(ex_path, MANIFEST_FILENAME)
-        parent_path = os.path.split(plugin_path)[0]
-        dst = os.path.join(self.plugin_folder, os.path.split(parent_path)[-1])
-        if os.path.exists(dst):
-            shutil.rmtree(dst)
-        shutil.move(parent_path, dst)
-        shutil.rmtree(ex_path)
-        os.remove(filepath)
-        _LOGGER.info(f'插件下载完毕，已经解压到：{dst}')
+        return self.installer.install_file(filepath).wait()
+
+    def rollback(self, plugin_name: str, sha256: Optional[str] = None) -> str:
+        """
+        用缓存的安装包把插件恢复到之前安装过的版本，插件已经加载时重新加载
+        :param sha256: 要恢复的安装包，为空时恢复到上一次安装的版本
+        :return: 插件目录
+        """
+        dst = self.installer.rollback(plugin_name, sha256).wait()
+        if plugin_name in self.mbot.plugins:
+            self.reload(plugin_name)
         return dst
 
+    def get_install_progress(self, install_id: Optional[int] = None) -> List[InstallProgress]:
+        return self.installer.get_progress(install_id)
+
     def uninstall(self, plugin_name, delete_config=True):
         if plugin_name not in self.mbot.plugins:
             raise PluginsErrorException('已经没有这个插件，如果卸载未生效请重新启用应用')
         plugin: PluginMeta = self.mbot.plugins.get(plugin_name)
         _LOGGER.info(f'开始卸载插件：{plugin.manifest.title}')
         shutil.rmtree(plugin.plugin_folder)
+        for stub in self._lazy_listeners.pop(plugin_name, []):
+            self.mbot.event_bus.remove_listener(stub)
         if plugin.get_listener():
             for x in plugin.get_listener():
                 self.mbot.event_bus.remove_listener(x)
+            self.mbot.event_bus.invalidate_context(plugin_name)
             _LOGGER.info(f'插件相关监听器已经移除')
-        tasks = self.mbot.task_manager.get_tasks()
-        plugin_tasks = []
-        if tasks:
-            for t in tasks:
-                if not t.plugin_name:
-                    continue
-                if t.plugin_name == plugin:
-                    plugin_tasks.append(t)
-        if plugin_tasks:
-            for t in plugin_tasks:
-                self.mbot.task_manager.remove_task(t)
+        if self._remove_tasks(plugin_name):
             _LOGGER.info(f'插件相关任务已经移除')
         if delete_config and plugin_name in self.mbot.config.plugins_config:
             del self.mbot.config.plugins_config[plugin_name]
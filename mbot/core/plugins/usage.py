@@ -0,0 +1,247 @@
+"""
+插件的资源统计：进入插件代码的每一次执行（事件监听器、功能指令、定时任务）都会归属到所属插件，
+累计调用次数、错误次数、墙钟耗时和CPU耗时；内存分配需要主动开启，开启后按间隔抽样，用tracemalloc记录调用前后的内存变化
+插件之间嵌套调用时，内层插件的耗时只记在内层插件上，外层插件只记自己的部分
+CPU耗时使用执行线程的thread_time，协程监听器和在子进程中执行的代码只能统计墙钟耗时
+"""
+import contextlib
+import functools
+import inspect
+import threading
+import time
+import tracemalloc
+import typing
+from enum import Enum
+from typing import Dict, List, Optional
+
+from mbot.common.serializable import Serializable
+
+"""开启内存统计时默认的抽样间隔，每隔多少次调用记录一次内存变化"""
+DEFAULT_MEMORY_SAMPLE_EVERY = 10
+
+
+class UsageKind(str, Enum):
+    Event = 'event'
+    Command = 'command'
+    Task = 'task'
+
+
+class UsageStats(Serializable):
+    """一类执行的资源统计"""
+
+    def __init__(self, kind: str, calls: int = 0, errors: int = 0, wall_ms: float = 0, cpu_ms: float = 0):
+        self.kind = kind
+        self.calls = calls
+        self.errors = errors
+        self.wall_ms = wall_ms
+        self.cpu_ms = cpu_ms
+
+
+class PluginUsage(Serializable):
+    """单个插件的资源统计"""
+
+    def __init__(self, plugin_name: str):
+        self.plugin_name = plugin_name
+        self.calls = 0
+        self.errors = 0
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+        # 抽样记录内存变化的次数，以及这些调用前后已分配内存的净变化之和
+        self.memory_samples = 0
+        self.memory_net_bytes = 0
+        self.kinds: List[UsageStats] = []
+
+
+class _Counter:
+    __slots__ = ('calls', 'errors', 'wall', 'cpu')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+
+class _Frame:
+    __slots__ = ('plugin_name', 'child_wall', 'child_cpu', 'failed')
+
+    def __init__(self, plugin_name: Optional[str]):
+        self.plugin_name = plugin_name
+        # 调用入口没有抛出异常、但通过返回值表示执行失败时由调用方标记
+        self.failed = False
+        # 嵌套执行的其他插件的耗时，退出时从自己的耗时中扣除
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+
+class PluginUsageTracker:
+    """按插件累计资源使用"""
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[UsageKind, _Counter]] = dict()
+        self._memory: Dict[str, List[int]] = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_sample_every: int = 0
+        self._memory_calls = 0
+        self._started_tracemalloc = False
+
+    def enable_memory(self, sample_every: int = DEFAULT_MEMORY_SAMPLE_EVERY):
+        """
+        开启内存分配统计，会启动tracemalloc，有额外的性能开销
+        tracemalloc统计的是整个进程，同时有其他代码在执行时抽样结果只能作为估算
+        :param sample_every: 每隔多少次调用抽样一次
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.memory_sample_every = max(sample_every or 1, 1)
+
+    def disable_memory(self):
+        self.memory_sample_every = 0
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _stack(self) -> List[_Frame]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _sample_memory(self) -> bool:
+        every = self.memory_sample_every
+        if not every or not tracemalloc.is_tracing():
+            return False
+        with self._lock:
+            self._memory_calls += 1
+            return self._memory_calls % every == 0
+
+    @contextlib.contextmanager
+    def track(self, plugin_name: Optional[str], kind: UsageKind, measure_cpu: bool = True):
+        """
+        统计一次进入插件代码的执行
+        :param plugin_name: 插件名，为空时不统计
+        :param kind: 执行类型
+        :param measure_cpu: 是否统计CPU耗时，协程中执行时线程会切换到其他协程，应该关闭，同时也不参与嵌套扣除
+        :return: 本次执行的记录，设置failed可以把没有抛出异常的执行记为错误
+        """
+        if not plugin_name:
+            yield _Frame(plugin_name)
+            return
+        stack = self._stack() if measure_cpu else None
+        if stack and stack[-1].plugin_name == plugin_name:
+            # 同一个插件内部的嵌套调用已经被外层统计
+            yield _Frame(plugin_name)
+            return
+        frame = _Frame(plugin_name)
+        if stack is not None:
+            stack.append(frame)
+        sample = self._sample_memory()
+        mem_start = tracemalloc.get_traced_memory()[0] if sample else 0
+        cpu_start = time.thread_time() if measure_cpu else 0
+        start = time.perf_counter()
+        success = False
+        try:
+            yield frame
+            success = not frame.failed
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_start if measure_cpu else 0
+            mem = tracemalloc.get_traced_memory()[0] - mem_start if sample and tracemalloc.is_tracing() else None
+            if stack is not None:
+                stack.pop()
+            if stack:
+                stack[-1].child_wall += wall
+                stack[-1].child_cpu += cpu
+            self._add(plugin_name, kind, wall - frame.child_wall, cpu - frame.child_cpu, success, mem)
+
+    def _add(self, plugin_name: str, kind: UsageKind, wall: float, cpu: float, success: bool,
+             mem: Optional[int] = None):
+        with self._lock:
+            kinds = self._counters.get(plugin_name)
+            if kinds is None:
+                kinds = self._counters[plugin_name] = dict()
+            c = kinds.get(kind)
+            if c is None:
+                c = kinds[kind] = _Counter()
+            c.calls += 1
+            if not success:
+                c.errors += 1
+            c.wall += wall
+            c.cpu += cpu
+            if mem is not None:
+                m = self._memory.setdefault(plugin_name, [0, 0])
+                m[0] += 1
+                m[1] += mem
+
+    def wrap(self, plugin_name: Optional[str], kind: UsageKind, func: typing.Callable,
+             is_async: Optional[bool] = None, false_is_error: bool = False) -> typing.Callable:
+        """
+        给调用入口增加资源统计，协程函数只统计墙钟耗时
+        :param is_async: 调用入口是否返回协程，为空时自动判断
+        :param false_is_error: 调用入口自己捕获异常并返回False时，把返回False记为错误
+        """
+        if not plugin_name:
+            return func
+        if is_async is None:
+            is_async = inspect.iscoroutinefunction(func)
+        if is_async:
+            @functools.wraps(func)
+            async def async_tracked(*args, **kwargs):
+                with self.track(plugin_name, kind, measure_cpu=False) as frame:
+                    result = await func(*args, **kwargs)
+                    frame.failed = false_is_error and result is False
+                    return result
+
+            return async_tracked
+
+        @functools.wraps(func)
+        def tracked(*args, **kwargs):
+            with self.track(plugin_name, kind) as frame:
+                result = func(*args, **kwargs)
+                frame.failed = false_is_error and result is False
+                return result
+
+        return tracked
+
+    def get(self, plugin_name: str) -> PluginUsage:
+        """获取一个插件的资源统计，没有执行过时各项为0"""
+        usage = PluginUsage(plugin_name)
+        with self._lock:
+            kinds = dict(self._counters.get(plugin_name) or {})
+            memory = self._memory.get(plugin_name)
+            for kind, c in kinds.items():
+                usage.kinds.append(UsageStats(kind.value, c.calls, c.errors, round(c.wall * 1000, 3),
+                                              round(c.cpu * 1000, 3)))
+                usage.calls += c.calls
+                usage.errors += c.errors
+                usage.wall_ms += c.wall * 1000
+                usage.cpu_ms += c.cpu * 1000
+            if memory:
+                usage.memory_samples, usage.memory_net_bytes = memory
+        usage.wall_ms = round(usage.wall_ms, 3)
+        usage.cpu_ms = round(usage.cpu_ms, 3)
+        return usage
+
+    def get_all(self) -> List[PluginUsage]:
+        """获取全部插件的资源统计，按CPU耗时从高到低排列"""
+        with self._lock:
+            names = list(self._counters.keys())
+        return sorted([self.get(name) for name in names], key=lambda x: (x.cpu_ms, x.wall_ms), reverse=True)
+
+    def reset(self, plugin_name: Optional[str] = None):
+        """
+        清空统计，例如插件更新后重新开始对比
+        :param plugin_name: 插件名，为空时清空全部
+        """
+        with self._lock:
+            if plugin_name:
+                self._counters.pop(plugin_name, None)
+                self._memory.pop(plugin_name, None)
+            else:
+                self._counters.clear()
+                self._memory.clear()
+
+
+usage_tracker = PluginUsageTracker()
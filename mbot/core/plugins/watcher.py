@@ -0,0 +1,248 @@
+"""
+插件目录监控：插件文件变化后自动重新加载这个插件
+Linux下使用inotify监听文件变化，不支持inotify的平台退化为定期比较文件的修改时间和大小；
+文件变化后等待一段静默时间再重新加载，避免复制文件过程中多次触发
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import typing
+from typing import Dict, Optional, Set, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+"""轮询模式下检查文件变化的间隔秒数"""
+DEFAULT_POLL_INTERVAL = 2
+"""文件最后一次变化后等待的静默秒数"""
+DEFAULT_DEBOUNCE = 1
+"""不会触发重新加载的目录和文件后缀，导入插件时生成的缓存文件也在这里"""
+IGNORE_DIRS = ('__pycache__', '.git', '.cache')
+IGNORE_SUFFIXES = ('.pyc', '.pyo', '.swp', '.tmp', '~')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _ignored(name: str) -> bool:
+    return name in IGNORE_DIRS or name.startswith('.') or name.endswith(IGNORE_SUFFIXES)
+
+
+def _load_libc():
+    if not hasattr(os, 'O_NONBLOCK'):
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return
+        return libc
+    except OSError:
+        return
+
+
+class _Inotify:
+    """基于ctypes的inotify封装"""
+
+    def __init__(self, libc):
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._paths: Dict[int, str] = dict()
+
+    def add_watch(self, path: str) -> Optional[int]:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            _LOGGER.warning(f'无法监控插件目录：{path} errno={ctypes.get_errno()}')
+            return
+        self._paths[wd] = path
+        return wd
+
+    def add_tree(self, path: str):
+        self.add_watch(path)
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not _ignored(d)]
+            for d in dirs:
+                self.add_watch(os.path.join(root, d))
+
+    def read(self, timeout: float) -> typing.List[Tuple[str, int, str]]:
+        """读取文件变化，返回(所在目录, 事件掩码, 文件名)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            path = self._paths.get(wd)
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            if path:
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PluginWatcher:
+    """监控插件目录，插件文件变化后调用重新加载"""
+
+    def __init__(self, plugin_folder: str, reload: typing.Callable[[str], typing.Any],
+                 resolve: typing.Callable[[str], Optional[str]], poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 debounce: float = DEFAULT_DEBOUNCE, use_inotify: bool = True):
+        """
+        :param plugin_folder: 插件所在目录
+        :param reload: 重新加载插件的函数，参数为插件名
+        :param resolve: 根据插件文件夹路径找到插件名，不是已加载的插件时返回None
+        :param poll_interval: 轮询模式下的检查间隔
+        :param debounce: 文件最后一次变化后等待的静默秒数
+        :param use_inotify: 是否优先使用inotify
+        """
+        self.plugin_folder = os.path.abspath(plugin_folder)
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._reload = reload
+        self._resolve = resolve
+        self._libc = _load_libc() if use_inotify else None
+        self._inotify: Optional[_Inotify] = None
+        self._pending: Dict[str, float] = dict()
+        self._snapshot: Dict[str, Dict[str, Tuple[float, int]]] = dict()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self._libc is not None:
+            try:
+                self._inotify = _Inotify(self._libc)
+                self._inotify.add_tree(self.plugin_folder)
+            except OSError as e:
+                _LOGGER.warning(f'inotify不可用，插件目录改为轮询监控：{e}')
+                self._inotify = None
+        if self._inotify is None:
+            self._snapshot = self._scan_all()
+        self._thread = threading.Thread(target=self._loop, name='PluginWatcher', daemon=True)
+        self._thread.start()
+        _LOGGER.info(f'开始监控插件目录：{self.plugin_folder}，模式：{self.mode}')
+
+    def stop(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _plugin_dir(self, path: str) -> Optional[str]:
+        """把插件目录下的任意路径归到所属的插件文件夹"""
+        rel = os.path.relpath(path, self.plugin_folder)
+        if rel.startswith('..') or rel == '.':
+            return
+        return os.path.join(self.plugin_folder, rel.split(os.sep)[0])
+
+    def _mark(self, plugin_dir: Optional[str]):
+        if not plugin_dir:
+            return
+        self._pending[plugin_dir] = time.monotonic()
+
+    def _loop(self):
+        while not self._closed.is_set():
+            try:
+                if self._inotify is not None:
+                    self._read_inotify()
+                else:
+                    self._closed.wait(self.poll_interval)
+                    self._poll()
+                self._flush()
+            except Exception as e:
+                _LOGGER.error('插件目录监控出错', exc_info=True)
+                self._closed.wait(self.poll_interval)
+
+    def _read_inotify(self):
+        timeout = self.debounce if self._pending else self.poll_interval
+        for path, mask, name in self._inotify.read(timeout):
+            if name and _ignored(name):
+                continue
+            full_path = os.path.join(path, name) if name else path
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._inotify.add_tree(full_path)
+            if path == self.plugin_folder and not (mask & IN_ISDIR):
+                # 插件根目录下的文件不属于任何插件
+                continue
+            self._mark(self._plugin_dir(full_path))
+
+    def _scan(self, plugin_dir: str) -> Dict[str, Tuple[float, int]]:
+        result = dict()
+        for root, dirs, files in os.walk(plugin_dir):
+            dirs[:] = [d for d in dirs if not _ignored(d)]
+            for f in files:
+                if _ignored(f):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result[path] = (st.st_mtime, st.st_size)
+        return result
+
+    def _scan_all(self) -> Dict[str, Dict[str, Tuple[float, int]]]:
+        result = dict()
+        if not os.path.exists(self.plugin_folder):
+            return result
+        for name in os.listdir(self.plugin_folder):
+            path = os.path.join(self.plugin_folder, name)
+            if os.path.isdir(path) and not _ignored(name):
+                result[path] = self._scan(path)
+        return result
+
+    def _poll(self):
+        snapshot = self._scan_all()
+        for plugin_dir in set(snapshot) | set(self._snapshot):
+            if snapshot.get(plugin_dir) != self._snapshot.get(plugin_dir):
+                self._mark(plugin_dir)
+        self._snapshot = snapshot
+
+    def _flush(self):
+        now = time.monotonic()
+        ready: Set[str] = {d for d, t in self._pending.items() if now - t >= self.debounce}
+        for plugin_dir in ready:
+            self._pending.pop(plugin_dir, None)
+            plugin_name = self._resolve(plugin_dir)
+            if not plugin_name or not os.path.exists(plugin_dir):
+                continue
+            _LOGGER.info(f'插件文件发生变化，重新加载插件：{plugin_name}')
+            try:
+                self._reload(plugin_name)
+            except Exception as e:
+                _LOGGER.error(f'重新加载插件失败：{plugin_name}', exc_info=True)
@@ -2,22 +2,48 @@
 系统内所有在主进程调度的任务管理，使用apscheduler调度；
 想要扩展系统定时调度的任务，就实现Task接口，并利用Tasks.register类装饰器函数，把任务注册进系统，启动时会自动加载
 """
+import collections
 import datetime
 import logging
+import math
+import socket
 import threading
+import time
+import traceback
 import typing
+import zlib
 from abc import ABCMeta, abstractmethod
 from enum import Enum
 from typing import List, Dict
 
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES, JobEvent
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from flask_apscheduler import APScheduler
 
+from mbot.common.serializable import Serializable
 from mbot.core import MovieBot
+from mbot.core.plugins.usage import usage_tracker, UsageKind
+from mbot.core.taskpool import TaskPool, PoolKind, ConcurrencyBudget, TaskPoolStats, RateBudget, POOL_DEFAULT, \
+    POOL_IO, POOL_CPU, PLUGIN_POOL_PREFIX, DEFAULT_PLUGIN_POOL_SIZE, DEFAULT_TASK_BUDGET, PRIORITY_CORE, PRIORITY_PLUGIN
 
 _LOGGER = logging.getLogger(__name__)
 
+"""每个任务默认保留的运行记录数量"""
+DEFAULT_HISTORY_SIZE = 100
+"""任务默认允许同时运行的实例数，上一次运行没有结束时跳过本次触发"""
+DEFAULT_MAX_INSTANCES = 1
+"""同时执行的启动任务数量上限"""
+DEFAULT_STARTUP_PARALLELISM = 4
+"""自适应调度时，任务没有发现新内容后运行间隔的放大倍数"""
+ADAPTIVE_BACKOFF_FACTOR = 2
+"""自适应调度未设置最大间隔时，最大间隔为原始间隔的倍数"""
+ADAPTIVE_MAX_MULTIPLIER = 8
+"""等待web服务开始监听的最长秒数，超时后仍然执行启动任务"""
+WEB_READY_TIMEOUT = 60
+"""检测web服务是否开始监听的间隔秒数"""
+WEB_READY_POLL_INTERVAL = 0.2
+
 """以下两个函数是解析cron表达式的工具函数"""
 
 
@@ -71,16 +97,25 @@ def evaluate(expression):
     return year, month, day, week, day_of_week, hour, minute, second;
 
 
-def get_trigger(expression):
-    # type: (str) -> CronTrigger
+def get_trigger(expression, second=None):
+    # type: (str, typing.Optional[int]) -> CronTrigger
     """
     Evaluates a CronTrigger obj from cron expression
     :param expression: String representing the crons five first fields, e.g : '* * * * *'
+    :param second: 在第几秒触发，为空时在整分触发
     :return: A CronTrigger
     """
     vals = expression.split()
     vals = [(None if w == '?' else w) for w in vals]
-    return CronTrigger(minute=vals[0], hour=vals[1], day=vals[2], month=vals[3], day_of_week=vals[4])
+    return CronTrigger(second=second, minute=vals[0], hour=vals[1], day=vals[2], month=vals[3], day_of_week=vals[4])
+
+
+def spread_offset(name: str, period: float) -> int:
+    """按任务名计算一个稳定的相位偏移秒数，相同周期的任务分散在整个周期内，重启后偏移不变"""
+    period = int(period)
+    if period <= 1:
+        return 0
+    return zlib.crc32(name.encode('utf-8')) % period
 
 
 class TaskStatus(int, Enum):
@@ -102,11 +137,54 @@ class Task(metaclass=ABCMeta):
         pass
 
 
+class TaskRun(Serializable):
+    """任务的一次运行记录"""
+
+    def __init__(self, start_time: datetime.datetime, end_time: datetime.datetime, duration_ms: float, success: bool,
+                 error: typing.Optional[str] = None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.duration_ms = duration_ms
+        self.success = success
+        # 运行失败时的异常堆栈
+        self.error = error
+
+
+class TaskStats(Serializable):
+    """任务的运行统计"""
+
+    def __init__(self, name: str, desc: str, plugin_name: typing.Optional[str], runs: int, failures: int,
+                 running: int, missed: int, skipped: int, mean_ms: typing.Optional[float],
+                 p95_ms: typing.Optional[float], max_ms: typing.Optional[float], last_run: typing.Optional[TaskRun],
+                 interval: typing.Optional[float] = None):
+        self.name = name
+        self.desc = desc
+        self.plugin_name = plugin_name
+        self.runs = runs
+        self.failures = failures
+        # 正在运行的实例数
+        self.running = running
+        # 错过触发时间且超过宽限时间、没有执行的次数
+        self.missed = missed
+        # 上一次运行还没结束、达到同时运行上限而跳过的次数
+        self.skipped = skipped
+        # 全部运行的平均耗时
+        self.mean_ms = mean_ms
+        # 最近运行记录中的p95耗时
+        self.p95_ms = p95_ms
+        self.max_ms = max_ms
+        self.last_run = last_run
+        # 间隔任务当前的运行间隔秒数，自适应调度时可能大于声明的间隔
+        self.interval = interval
+
+
 class TaskMeta:
-    """描述任务的元数据模型"""
+    """描述任务的元数据模型，同时记录任务的运行历史"""
 
     def __init__(self, task: typing.Callable, name, desc, cron_expression=None, jitter=None, minutes=None, seconds=None,
-                 plugin_name=None):
+                 plugin_name=None, max_instances=DEFAULT_MAX_INSTANCES, coalesce=True, misfire_grace_time=None,
+                 history_size=DEFAULT_HISTORY_SIZE, pool=POOL_DEFAULT, priority=PRIORITY_CORE, spread=False,
+                 targets=None, adaptive=False, max_interval=None):
         self.task: typing.Callable = task
         self.name = name
         self.desc = desc
@@ -115,6 +193,225 @@ class TaskMeta:
         self.minutes = minutes
         self.seconds = seconds
         self.plugin_name = plugin_name
+        self.max_instances = max_instances
+        self.coalesce = coalesce
+        self.misfire_grace_time = misfire_grace_time
+        # 运行任务的执行池名称
+        self.pool = pool
+        # 申请全局并发预算时的优先级，数值越小越优先
+        self.priority = priority
+        # 由任务管理器绑定的执行池和全局并发预算
+        self.executor_pool: typing.Optional[TaskPool] = None
+        self.budget: typing.Optional[ConcurrencyBudget] = None
+        # 是否把相同周期的任务分散到周期内的不同时刻
+        self.spread = spread
+        # 任务会访问的目标，每次运行前从这些目标的速率预算中各取一个令牌
+        self.targets: typing.List[str] = list(targets or [])
+        # 运行结果为False（没有发现新内容）时是否逐步放大运行间隔
+        self.adaptive = adaptive
+        # 声明的运行间隔秒数，cron任务为空
+        self.interval: typing.Optional[float] = None if cron_expression else (minutes or 0) * 60 + (seconds or 0)
+        self.current_interval: typing.Optional[float] = self.interval
+        self.max_interval: typing.Optional[float] = max_interval
+        # 由任务管理器绑定的速率限制和运行结果回调
+        self.rate_limiter: typing.Optional[typing.Callable[..., typing.Any]] = None
+        self.on_result: typing.Optional[typing.Callable[["TaskMeta", typing.Any], typing.Any]] = None
+        # 最近的运行记录，超过数量后丢弃最早的记录
+        self.history: typing.Deque[TaskRun] = collections.deque(maxlen=history_size or DEFAULT_HISTORY_SIZE)
+        self.runs = 0
+        self.failures = 0
+        self.running = 0
+        self.missed = 0
+        self.skipped = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def _invoke(self):
+        with usage_tracker.track(self.plugin_name, UsageKind.Task):
+            if self.executor_pool is not None:
+                return self.executor_pool.run(self.task)
+            return self.task()
+
+    def __call__(self):
+        """取得目标的速率令牌和全局并发预算后执行任务，并记录运行结果，异常会继续抛出给调度器"""
+        if self.targets and self.rate_limiter is not None:
+            self.rate_limiter(*self.targets)
+        if self.budget is not None:
+            with self.budget.slot(self.priority):
+                result = self._record()
+        else:
+            result = self._record()
+        if self.on_result is not None:
+            try:
+                self.on_result(self, result)
+            except Exception as e:
+                _LOGGER.error(f'处理任务运行结果失败：{self.desc}', exc_info=True)
+        return result
+
+    def _record(self):
+        with self._lock:
+            self.running += 1
+        start_time = datetime.datetime.now()
+        start = time.perf_counter()
+        error = None
+        try:
+            return self._invoke()
+        except Exception as e:
+            error = traceback.format_exc()
+            raise
+        finally:
+            duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            run = TaskRun(start_time, datetime.datetime.now(), duration_ms, error is None, error)
+            with self._lock:
+                self.running -= 1
+                self.runs += 1
+                if error is not None:
+                    self.failures += 1
+                self.total_ms += duration_ms
+                self.max_ms = max(self.max_ms, duration_ms)
+                self.history.append(run)
+
+    def get_history(self) -> List[TaskRun]:
+        with self._lock:
+            return list(self.history)
+
+    def stats(self) -> TaskStats:
+        with self._lock:
+            durations = sorted(r.duration_ms for r in self.history)
+            last_run = self.history[-1] if self.history else None
+            runs = self.runs
+            mean_ms = round(self.total_ms / runs, 3) if runs else None
+            p95_ms = durations[max(math.ceil(len(durations) * 0.95) - 1, 0)] if durations else None
+            return TaskStats(self.name, self.desc, self.plugin_name, runs, self.failures, self.running, self.missed,
+                             self.skipped, mean_ms, p95_ms, self.max_ms if runs else None, last_run,
+                             self.current_interval)
+
+
+class StartupTaskState(str, Enum):
+    Pending = 'pending'
+    Running = 'running'
+    Success = 'success'
+    Failed = 'failed'
+    # 依赖的任务失败或者依赖关系有环，没有执行
+    Skipped = 'skipped'
+
+
+class StartupOrchestrator:
+    """
+    启动任务编排：收集系统和插件声明的启动任务，按声明的依赖关系构建依赖图，
+    在应用启动完成后于后台执行，没有依赖关系的任务在有限的并发数内同时执行
+    """
+
+    def __init__(self, parallelism: int = DEFAULT_STARTUP_PARALLELISM):
+        """
+        :param parallelism: 同时执行的启动任务数量上限
+        """
+        self.parallelism = parallelism if parallelism and parallelism > 0 else DEFAULT_STARTUP_PARALLELISM
+        self._pending: Dict[str, TaskMeta] = dict()
+        self._requires: Dict[str, typing.List[str]] = dict()
+        self._states: Dict[str, StartupTaskState] = dict()
+        self._running = 0
+        self._started = False
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._finished.set()
+
+    def add(self, meta: TaskMeta, requires: typing.Optional[typing.List[str]] = None):
+        """
+        加入一个启动任务；编排已经开始时（例如启动后安装的插件），依赖满足后立即执行
+        :param requires: 需要先执行完成的启动任务名称
+        """
+        with self._lock:
+            self._pending[meta.name] = meta
+            self._requires[meta.name] = list(requires or [])
+            self._states[meta.name] = StartupTaskState.Pending
+            self._finished.clear()
+            if not self._started:
+                return
+        self._schedule()
+
+    def start(self):
+        with self._lock:
+            self._started = True
+        self._schedule()
+
+    def _dependency_state(self, name: str) -> typing.Optional[bool]:
+        """
+        :return: 依赖已经全部成功返回True，有依赖失败返回False，还需要等待返回None
+        """
+        for dep in self._requires.get(name, []):
+            state = self._states.get(dep)
+            if state is None:
+                # 不是启动任务的依赖视为已经满足
+                continue
+            if state == StartupTaskState.Success:
+                continue
+            if state in (StartupTaskState.Failed, StartupTaskState.Skipped):
+                return False
+            return None
+        return True
+
+    def _schedule(self):
+        """把依赖已经满足的任务交给各自的执行池，直到达到并发上限"""
+        ready = []
+        with self._lock:
+            if not self._started:
+                return
+            changed = True
+            while changed:
+                changed = False
+                for name in sorted(self._pending, key=lambda x: self._pending[x].priority):
+                    dep = self._dependency_state(name)
+                    if dep is False:
+                        _LOGGER.warning(f'启动任务依赖的任务没有执行成功，跳过执行：{self._pending[name].desc}')
+                        self._pending.pop(name)
+                        self._states[name] = StartupTaskState.Skipped
+                        changed = True
+                        break
+                    if dep and self._running < self.parallelism:
+                        ready.append(self._pending.pop(name))
+                        self._states[name] = StartupTaskState.Running
+                        self._running += 1
+                        changed = True
+                        break
+            if not ready and self._running == 0 and self._pending:
+                # 没有正在执行的任务，剩下的任务互相等待，说明依赖关系有环
+                for name, meta in self._pending.items():
+                    _LOGGER.error(f'启动任务的依赖关系有环，跳过执行：{meta.desc} 依赖：{self._requires.get(name)}')
+                    self._states[name] = StartupTaskState.Skipped
+                self._pending.clear()
+            if not self._pending and self._running == 0:
+                self._finished.set()
+        for meta in ready:
+            try:
+                meta.executor_pool.submit(self._run, meta)
+            except Exception as e:
+                _LOGGER.error(f'启动任务提交执行失败：{meta.desc}', exc_info=True)
+                self._done(meta, False)
+
+    def _run(self, meta: TaskMeta):
+        success = True
+        try:
+            meta()
+        except Exception as e:
+            success = False
+            _LOGGER.error(f'启动时运行任务失败：{meta.desc}', exc_info=True)
+        self._done(meta, success)
+
+    def _done(self, meta: TaskMeta, success: bool):
+        with self._lock:
+            self._running -= 1
+            self._states[meta.name] = StartupTaskState.Success if success else StartupTaskState.Failed
+        self._schedule()
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """等待已经加入的启动任务全部结束，返回是否在超时前结束"""
+        return self._finished.wait(timeout)
+
+    def get_states(self) -> Dict[str, StartupTaskState]:
+        with self._lock:
+            return dict(self._states)
 
 
 class _TaskManager:
@@ -124,6 +421,121 @@ class _TaskManager:
         self.mbot = mbot
         self._scheduler = APScheduler(BackgroundScheduler(timezone="Asia/Shanghai"))
         self._tasks: Dict[str, TaskMeta] = dict()
+        self._scheduler.add_listener(self._on_job_event, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+        # 所有执行池共享的并发预算
+        self.budget = ConcurrencyBudget(DEFAULT_TASK_BUDGET)
+        self._pools: Dict[str, TaskPool] = dict()
+        self._pools_lock = threading.Lock()
+        self.add_pool(POOL_DEFAULT, PoolKind.Thread, 10)
+        self.add_pool(POOL_IO, PoolKind.Thread, 8)
+        self.add_pool(POOL_CPU, PoolKind.Process)
+        # 启动任务编排，调度器启动后在后台执行
+        self.startup = StartupOrchestrator()
+        # 按目标划分的速率预算
+        self._rate_budgets: Dict[str, RateBudget] = dict()
+
+    def add_pool(self, name: str, kind: typing.Union[PoolKind, str] = PoolKind.Thread,
+                 max_workers: typing.Optional[int] = None) -> TaskPool:
+        """
+        新增一个命名的执行池，已经存在时直接返回
+        :param name: 执行池名称，任务注册时用这个名称声明执行池
+        :param kind: thread或者process，process类型的任务函数需要可以被pickle
+        :param max_workers: 执行池的最大并发数，为空时使用CPU核数
+        """
+        with self._pools_lock:
+            pool = self._pools.get(name)
+            if pool is not None:
+                return pool
+            pool = TaskPool(name, kind, max_workers)
+            self._scheduler.scheduler.add_executor(pool.scheduler_executor(), name)
+            self._pools[name] = pool
+            return pool
+
+    def _remove_pool(self, name: str):
+        with self._pools_lock:
+            pool = self._pools.pop(name, None)
+            if pool is None:
+                return
+            self._scheduler.scheduler.remove_executor(name, shutdown=False)
+        pool.shutdown(wait=False)
+
+    def set_budget(self, limit: typing.Optional[int]):
+        """
+        设置所有执行池同时运行的任务总数上限
+        :param limit: 为空或者不大于0时不限制
+        """
+        self.budget.set_limit(limit)
+
+    def set_rate_limit(self, target: str, calls: typing.Optional[int], period: float = 60, burst: int = 1):
+        """
+        设置访问一个目标的速率预算，例如每分钟最多访问Emby 10次
+        :param target: 目标名称，任务注册时通过targets声明
+        :param calls: 每个周期允许的次数，为空时取消限制
+        :param period: 周期秒数
+        :param burst: 允许瞬间连续访问的次数
+        """
+        if not calls:
+            self._rate_budgets.pop(target, None)
+            return
+        self._rate_budgets[target] = RateBudget(target, calls, period, burst)
+
+    def acquire_rate(self, *targets: str) -> float:
+        """
+        从目标的速率预算中各取一个令牌，令牌不足时阻塞等待；没有设置速率预算的目标不限制。
+        任务内部逐次访问目标时也可以调用这个方法
+        :return: 总共等待的秒数
+        """
+        waited = 0
+        for target in targets:
+            budget = self._rate_budgets.get(target)
+            if budget is not None:
+                waited += budget.acquire()
+        return waited
+
+    @staticmethod
+    def _spread_start_date(name: str, interval: float) -> datetime.datetime:
+        """按墙上时间对齐相位，多个实例或者重启后，同周期的任务仍然错开"""
+        now = time.time()
+        start = now - now % interval + spread_offset(name, interval)
+        if start <= now:
+            start += interval
+        return datetime.datetime.fromtimestamp(start)
+
+    def _on_task_result(self, meta: TaskMeta, result):
+        """自适应调度：任务返回False表示没有发现新内容，放大运行间隔；其他结果恢复声明的间隔"""
+        if not meta.adaptive or not meta.interval:
+            return
+        if result is False:
+            max_interval = meta.max_interval or meta.interval * ADAPTIVE_MAX_MULTIPLIER
+            interval = min(meta.current_interval * ADAPTIVE_BACKOFF_FACTOR, max_interval)
+        else:
+            interval = meta.interval
+        if interval == meta.current_interval:
+            return
+        meta.current_interval = interval
+        if not self._scheduler.get_job(meta.name):
+            return
+        trigger_options = dict()
+        if meta.spread:
+            # 调整间隔后仍然保持按任务名错开的相位
+            trigger_options['start_date'] = self._spread_start_date(meta.name, interval)
+        self._scheduler.scheduler.reschedule_job(meta.name, trigger='interval', seconds=interval, jitter=meta.jitter,
+                                                 **trigger_options)
+        _LOGGER.info(f'任务{meta.desc}的运行间隔调整为{interval}秒')
+
+    def get_pool_stats(self) -> List[TaskPoolStats]:
+        return [pool.stats() for pool in list(self._pools.values())]
+
+    def _on_job_event(self, event: JobEvent):
+        meta = self._tasks.get(event.job_id)
+        if not meta:
+            return
+        if event.code == EVENT_JOB_MISSED:
+            meta.missed += 1
+            _LOGGER.warning(f'任务错过了执行时间：{meta.desc} 计划时间：{event.scheduled_run_time}')
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            meta.skipped += 1
+            _LOGGER.warning(f'任务上一次运行还没有结束，跳过本次执行：{meta.desc} 同时运行上限：{meta.max_instances}')
 
     def init_app(self, mbot: MovieBot):
         self.mbot = mbot
@@ -131,7 +543,30 @@ class _TaskManager:
     def add_task(self, task: typing.Union[Task, typing.Callable], name, desc, cron_expression=None, jitter=None,
                  minutes=None, seconds=None,
                  run_at_startup=False,
-                 run_at_startup_in_thread=False, plugin_name=None):
+                 run_at_startup_in_thread=False, plugin_name=None, max_instances=DEFAULT_MAX_INSTANCES,
+                 coalesce=True, misfire_grace_time=None, history_size=DEFAULT_HISTORY_SIZE,
+                 pool: typing.Optional[str] = None, priority: typing.Optional[int] = None,
+                 requires: typing.Optional[typing.List[str]] = None, spread: bool = False,
+                 targets: typing.Optional[typing.List[str]] = None, adaptive: bool = False,
+                 max_interval: typing.Optional[float] = None):
+        """
+        新增一个定时任务
+        :param jitter: 每次触发随机延后的最大秒数
+        :param run_at_startup: 是否在启动时执行一次，启动任务由启动编排在调度器启动后于后台执行，不会阻塞注册和启动
+        :param run_at_startup_in_thread: 已废弃，启动任务总是由启动编排在任务的执行池中执行，传入时只记录一条警告
+        :param max_instances: 同时运行的实例上限，上一次运行没有结束、达到上限时跳过本次触发
+        :param coalesce: 错过多次触发时（例如任务运行太久）是否合并成一次执行
+        :param misfire_grace_time: 错过触发时间后仍然允许执行的秒数，为空时不限制
+        :param history_size: 保留的运行记录数量
+        :param pool: 执行池名称，如default、io、cpu或者通过add_pool新增的执行池；
+        为空时系统任务使用default，插件任务使用插件独占的执行池
+        :param priority: 全局并发预算不足时的排队优先级，数值越小越优先，为空时系统任务优先于插件任务
+        :param requires: 启动时需要先执行完成的其他启动任务名称
+        :param spread: 是否按任务名把触发时刻稳定地分散开：间隔任务在周期内错开相位，cron任务在分钟内错开秒数
+        :param targets: 任务会访问的目标，每次运行前先从这些目标的速率预算中各取一个令牌，见set_rate_limit
+        :param adaptive: 间隔任务返回False（没有发现新内容）时逐步放大运行间隔，返回其他结果时恢复
+        :param max_interval: 自适应调度的最大间隔秒数，为空时为声明间隔的8倍
+        """
         if name in self._tasks:
             return
         if not cron_expression and not minutes and not seconds:
@@ -139,45 +574,70 @@ class _TaskManager:
             return
         if isinstance(task, Task):
             task = task.run
+        if not pool:
+            pool = f'{PLUGIN_POOL_PREFIX}{plugin_name}' if plugin_name else POOL_DEFAULT
+        if pool not in self._pools:
+            if not pool.startswith(PLUGIN_POOL_PREFIX):
+                _LOGGER.error(f'任务声明的执行池不存在: {name}({desc}) 执行池: {pool}')
+                return
+            self.add_pool(pool, PoolKind.Thread, DEFAULT_PLUGIN_POOL_SIZE)
+        if priority is None:
+            priority = PRIORITY_PLUGIN if plugin_name else PRIORITY_CORE
+        meta = TaskMeta(task, name, desc, cron_expression, jitter, minutes, seconds, plugin_name, max_instances,
+                        coalesce, misfire_grace_time, history_size, pool, priority, spread, targets, adaptive,
+                        max_interval)
+        meta.executor_pool = self._pools[pool]
+        meta.budget = self.budget
+        meta.rate_limiter = self.acquire_rate
+        meta.on_result = self._on_task_result
         if self._scheduler.get_job(name):
             self._scheduler.remove_job(name)
+        if run_at_startup_in_thread:
+            _LOGGER.warning(f'任务{desc}使用了已废弃的参数run_at_startup_in_thread，启动任务总是在执行池中后台执行')
         if run_at_startup:
-            if run_at_startup_in_thread:
-                t = threading.Thread(target=task)
-                t.start()
-            else:
-                task()
+            self.startup.add(meta, requires)
+        job_options = {
+            'executor': pool,
+            'max_instances': max_instances or DEFAULT_MAX_INSTANCES,
+            'coalesce': coalesce,
+            'misfire_grace_time': misfire_grace_time
+        }
         if cron_expression:
             self._scheduler.add_job(
                 name,
-                task,
-                trigger=get_trigger(cron_expression),
+                meta,
+                trigger=get_trigger(cron_expression, spread_offset(name, 60) if spread else None),
                 start_date=datetime.datetime.now(),
-                jitter=jitter if jitter is None else 0
+                jitter=jitter,
+                **job_options
             )
             if plugin_name:
                 _LOGGER.info(f'来自插件{plugin_name}新增任务: {desc} 运行周期: {cron_expression}')
             else:
                 _LOGGER.info(f'新增任务: {desc} 运行周期: {cron_expression}')
         else:
+            if spread:
+                job_options['start_date'] = self._spread_start_date(name, meta.interval)
             self._scheduler.add_job(
                 name,
-                task,
+                meta,
                 trigger='interval',
                 minutes=minutes if minutes else 0,
                 seconds=seconds if seconds else 0,
-                jitter=jitter if jitter is None else 0
+                jitter=jitter,
+                **job_options
             )
             if plugin_name:
                 _LOGGER.info(
                     f'来自插件{plugin_name}的新增任务: {desc} 运行间隔{minutes if minutes else 0}分{seconds if seconds else 0}秒')
             else:
                 _LOGGER.info(f'新增任务: {desc} 运行间隔{minutes if minutes else 0}分{seconds if seconds else 0}秒')
-        self._tasks.update(
-            {name: TaskMeta(task, name, desc, cron_expression, jitter, minutes, seconds, plugin_name)})
+        self._tasks.update({name: meta})
 
     def register(self, name, desc, cron_expression=None, jitter=None, minutes=None, seconds=None, run_at_startup=False,
-                 run_at_startup_in_thread=False):
+                 run_at_startup_in_thread=False, max_instances=DEFAULT_MAX_INSTANCES, coalesce=True,
+                 misfire_grace_time=None, pool=None, priority=None, requires=None, spread=False, targets=None,
+                 adaptive=False, max_interval=None):
         """
         装饰器函数。注册一个新任务
         :param name: 任务名称，英文，重复会跳过
@@ -186,6 +646,16 @@ class _TaskManager:
         :param jitter: 每次执行任务的偏移秒数
         :param minutes: 任务执行间隔分钟，不提供cron_expression时才会使用这个值
         :param seconds: 任务执行间隔秒，同上
+        :param max_instances: 同时运行的实例上限，达到上限时跳过本次触发
+        :param coalesce: 错过多次触发时是否合并成一次执行
+        :param misfire_grace_time: 错过触发时间后仍然允许执行的秒数
+        :param pool: 执行池名称，如default、io、cpu
+        :param priority: 全局并发预算不足时的排队优先级，数值越小越优先
+        :param requires: 启动时需要先执行完成的其他启动任务名称
+        :param spread: 是否按任务名把触发时刻稳定地分散开
+        :param targets: 任务会访问的目标，运行前先取得这些目标的速率令牌
+        :param adaptive: 任务返回False时逐步放大运行间隔
+        :param max_interval: 自适应调度的最大间隔秒数
         :return:
         """
 
@@ -194,7 +664,10 @@ class _TaskManager:
                 return cls
             task = cls()
             self.add_task(task, name, desc, cron_expression, jitter, minutes, seconds, run_at_startup,
-                          run_at_startup_in_thread)
+                          run_at_startup_in_thread, max_instances=max_instances, coalesce=coalesce,
+                          misfire_grace_time=misfire_grace_time, pool=pool, priority=priority,
+                          requires=requires, spread=spread, targets=targets, adaptive=adaptive,
+                          max_interval=max_interval)
             return cls
 
         return decorator
@@ -202,16 +675,66 @@ class _TaskManager:
     def get_tasks(self) -> List[TaskMeta]:
         return list(self._tasks.values())
 
+    def get_task_stats(self, name: typing.Optional[str] = None) -> List[TaskStats]:
+        """
+        获取任务的运行统计
+        :param name: 任务名称，为空时返回全部任务
+        """
+        if name:
+            meta = self._tasks.get(name)
+            return [meta.stats()] if meta else []
+        return [meta.stats() for meta in list(self._tasks.values())]
+
+    def get_task_history(self, name: str) -> List[TaskRun]:
+        """获取任务最近的运行记录，按时间从早到晚排列"""
+        meta = self._tasks.get(name)
+        if not meta:
+            return []
+        return meta.get_history()
+
     def remove_task(self, meta: TaskMeta):
         if not meta:
             return
         self._scheduler.remove_job(meta.name)
         del self._tasks[meta.name]
+        # 插件的任务全部移除后，回收插件独占的执行池
+        if meta.pool.startswith(PLUGIN_POOL_PREFIX) and not any(t.pool == meta.pool for t in self._tasks.values()):
+            self._remove_pool(meta.pool)
 
-    def start(self, webapp=None):
+    def start(self, webapp=None, web_address: typing.Optional[typing.Tuple[str, int]] = None):
+        """
+        启动任务调度，启动任务在web服务开始监听后于后台执行
+        :param webapp: flask应用
+        :param web_address: web服务监听的(host, port)，检测到可以连接后执行启动任务；
+        为空时由web服务启动完成后调用web_ready，没有传入webapp时立即执行
+        """
         if webapp:
             self._scheduler.init_app(webapp)
         self._scheduler.start()
+        if web_address:
+            threading.Thread(target=self._wait_web_ready, args=(web_address,), name='startup-wait-web',
+                             daemon=True).start()
+        elif not webapp:
+            self.web_ready()
+
+    def web_ready(self):
+        """web服务已经开始监听，开始执行启动任务，重复调用没有影响"""
+        self.startup.start()
+
+    def _wait_web_ready(self, web_address: typing.Tuple[str, int]):
+        host, port = web_address
+        if not host or host in ('0.0.0.0', '::'):
+            host = 'localhost'
+        deadline = time.monotonic() + WEB_READY_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection((host, port), timeout=WEB_READY_POLL_INTERVAL):
+                    break
+            except OSError:
+                time.sleep(WEB_READY_POLL_INTERVAL)
+        else:
+            _LOGGER.warning(f'等待web服务{host}:{port}开始监听超时，直接执行启动任务')
+        self.web_ready()
 
 
 """一个任务管理的单例，外部不建议手动初始化"""
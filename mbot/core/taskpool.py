@@ -0,0 +1,218 @@
+"""
+定时任务的执行池：任务按声明的执行池运行，系统任务、IO任务、CPU密集任务以及每个插件的任务互不占用线程；
+所有执行池共享一个全局并发预算，预算用尽时按任务优先级排队，插件的重任务不会饿死系统任务；
+访问同一个外部服务的任务可以共享一个速率预算，避免在同一时刻集中请求
+"""
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import typing
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+
+from apscheduler.executors.pool import BasePoolExecutor
+
+from mbot.common.serializable import Serializable
+
+_LOGGER = logging.getLogger(__name__)
+
+"""系统任务默认使用的执行池"""
+POOL_DEFAULT = 'default'
+"""IO密集任务的执行池"""
+POOL_IO = 'io'
+"""CPU密集任务的执行池，任务函数在子进程中执行，需要可以被pickle"""
+POOL_CPU = 'cpu'
+"""插件任务默认执行池的名称前缀"""
+PLUGIN_POOL_PREFIX = 'plugin:'
+"""插件执行池默认的线程数"""
+DEFAULT_PLUGIN_POOL_SIZE = 2
+"""全局并发预算，所有执行池同时运行的任务总数上限"""
+DEFAULT_TASK_BUDGET = 16
+"""系统任务的默认优先级，数值越小越优先"""
+PRIORITY_CORE = 0
+"""插件任务的默认优先级"""
+PRIORITY_PLUGIN = 100
+
+
+class PoolKind(str, Enum):
+    Thread = 'thread'
+    Process = 'process'
+
+
+class ConcurrencyBudget:
+    """全局并发预算，名额不足时按(优先级, 申请顺序)排队"""
+
+    def __init__(self, limit: typing.Optional[int] = DEFAULT_TASK_BUDGET):
+        """
+        :param limit: 同时运行的任务上限，为空或者不大于0时不限制
+        """
+        self.limit = limit
+        self._active = 0
+        self._waiters: typing.List[tuple] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+    def _available(self) -> bool:
+        return not self.limit or self.limit <= 0 or self._active < self.limit
+
+    def acquire(self, priority: int = PRIORITY_PLUGIN):
+        with self._cond:
+            if not self._waiters and self._available():
+                self._active += 1
+                return
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            self._cond.wait_for(lambda: self._waiters[0] is entry and self._available())
+            heapq.heappop(self._waiters)
+            self._active += 1
+            # 队首变化，唤醒下一个等待者检查是否轮到自己
+            self._cond.notify_all()
+
+    def set_limit(self, limit: typing.Optional[int]):
+        with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority: int = PRIORITY_PLUGIN):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class _SchedulerExecutor(BasePoolExecutor):
+    """把执行池的线程池提供给apscheduler使用"""
+
+    def __init__(self, pool: concurrent.futures.Executor):
+        super().__init__(pool)
+
+    def shutdown(self, wait=True):
+        # 线程池的生命周期由TaskPool管理
+        pass
+
+
+class TaskPoolStats(Serializable):
+    def __init__(self, name: str, kind: PoolKind, max_workers: int, running: int):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.running = running
+
+
+class TaskPool:
+    """
+    一个命名的执行池
+    线程类型的执行池直接在线程中运行任务；进程类型的执行池由线程负责调度和记录，任务函数交给进程池执行
+    """
+
+    def __init__(self, name: str, kind: typing.Union[PoolKind, str] = PoolKind.Thread,
+                 max_workers: typing.Optional[int] = None):
+        self.name = name
+        self.kind = PoolKind(kind)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                              thread_name_prefix=f'Task-{name}')
+        self._process_executor: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def _get_process_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._process_executor is None:
+            with self._lock:
+                if self._process_executor is None:
+                    self._process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._process_executor
+
+    def run(self, func: typing.Callable):
+        """在执行池中运行任务函数，调用方已经处于执行池的线程中"""
+        with self._lock:
+            self._running += 1
+        try:
+            if self.kind == PoolKind.Process:
+                try:
+                    return self._get_process_executor().submit(func).result()
+                except BrokenProcessPool:
+                    with self._lock:
+                        broken, self._process_executor = self._process_executor, None
+                    if broken:
+                        broken.shutdown(wait=False)
+                    raise
+            return func()
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def submit(self, fn: typing.Callable, *args) -> concurrent.futures.Future:
+        return self.executor.submit(fn, *args)
+
+    def scheduler_executor(self) -> BasePoolExecutor:
+        return _SchedulerExecutor(self.executor)
+
+    def stats(self) -> TaskPoolStats:
+        return TaskPoolStats(self.name, self.kind, self.max_workers, self._running)
+
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait)
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=wait)
+
+
+class RateBudget:
+    """
+    访问某个目标（例如Emby、qBittorrent）的速率预算，令牌桶实现；
+    令牌不足时预约下一个令牌并等待，等待的调用按到达顺序依次放行
+    """
+
+    def __init__(self, target: str, calls: int, period: float = 60, burst: int = 1):
+        """
+        :param target: 目标名称
+        :param calls: 每个周期内允许的调用次数
+        :param period: 周期秒数
+        :param burst: 允许瞬间连续调用的次数
+        """
+        self.target = target
+        self.calls = calls
+        self.period = period
+        self.rate = calls / period
+        self.burst = max(burst or 1, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预约一个令牌，返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        """获取一个令牌，令牌不足时阻塞等待，返回等待的秒数"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -5,7 +5,7 @@ import logging
 import os.path
 import time
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import List, Optional
 
 import aria2p
 import bencoder
@@ -16,9 +16,35 @@ from qbittorrentapi import TorrentInfoList
 
 from mbot.common.magnet2torrent import Magnet2Torrent
 from mbot.common.serializable import Serializable
+from mbot.core.cache import cache_key_prefix, cached, l1cache
+from mbot.core.event.models import EventType
 from mbot.core.health import HealthIndicator, Health
 
 
+"""按种子hash查询下载任务的结果缓存，下载进度变化快，只缓存几秒"""
+LOOKUP_CACHE = 'downloadclient_lookup'
+LOOKUP_TTL = 5
+"""下载器中没有这个种子的结果缓存的秒数"""
+LOOKUP_NEGATIVE_TTL = 2
+
+
+def lookup_prefix(torrent_hash) -> str:
+    """一个种子hash的查询缓存键前缀，不是单个hash时返回空字符串，表示清空全部"""
+    return cache_key_prefix('get_by_hash', torrent_hash) if isinstance(torrent_hash, str) and torrent_hash else ''
+
+
+def _torrent_changed(data):
+    if isinstance(data, dict):
+        torrent_hash = data.get('hash') or data.get('torrent_hash')
+    else:
+        torrent_hash = getattr(data, 'hash', None) or getattr(data, 'torrent_hash', None)
+    return lookup_prefix(torrent_hash)
+
+
+l1cache.invalidate_on(EventType.DownloadStart, LOOKUP_CACHE, _torrent_changed)
+l1cache.invalidate_on(EventType.DownloadCompleted, LOOKUP_CACHE, _torrent_changed)
+
+
 class ClientTorrent(Serializable):
     hash: str = None
     name: str = None
@@ -41,6 +67,14 @@ class ClientTorrent(Serializable):
 
 
 class DownloadClient(metaclass=ABCMeta):
+    """查询缓存键中区分下载器的标识，使用下载器地址"""
+    cache_scope: Optional[str] = None
+
+    @staticmethod
+    def invalidate_lookup(torrent_hash):
+        """种子被删除或者状态发生变化后，让查询缓存失效"""
+        l1cache.invalidate(LOOKUP_CACHE, lookup_prefix(torrent_hash))
+
     @abstractmethod
     def download_from_file(self, torrent_filepath: str, savepath: str, category: str = None) -> bool:
         pass
@@ -135,6 +169,7 @@ class QbittorrentClient(DownloadClient):
 
     def __init__(self, url: str, need_login: bool = False, username: str = None, password: str = None,
                  test: bool = False):
+        self.cache_scope = f'qbittorrent:{url}'
         self.need_login = need_login
         self.username = username
         self.password = password
@@ -200,7 +235,9 @@ class QbittorrentClient(DownloadClient):
 
     def delete(self, torrent_hash):
         self.qb.torrents_delete(delete_files=True, torrent_hashes=torrent_hash)
+        self.invalidate_lookup(torrent_hash)
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_by_hash(self, torrent_hash: str) -> ClientTorrent:
         try:
             torrents: TorrentInfoList = self.qb.torrents_info(torrent_hashes=torrent_hash)
@@ -332,7 +369,9 @@ class TransmissionClient(DownloadClient):
 
     def delete(self, torrent_hash):
         self.client.remove_torrent(torrent_hash, True)
+        self.invalidate_lookup(torrent_hash)
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_by_hash(self, torrent_hash: str) -> ClientTorrent:
         try:
             t = self.client.get_torrent(torrent_hash)
@@ -392,6 +431,7 @@ class TransmissionClient(DownloadClient):
             username = str(username)
         if password is not None:
             password = str(password)
+        self.cache_scope = f'transmission:{host}:{port}'
         try:
             self.client = transmission_rpc.Client(host=host, port=port, username=username, password=password)
         except requests.exceptions.ConnectionError as ce:
@@ -408,6 +448,7 @@ class Aria2(DownloadClient):
     client = None
 
     def __init__(self, host, port, secret):
+        self.cache_scope = f'aria2:{host}:{port}'
         self.client = aria2p.API(
             aria2p.Client(
                 host="http://%s" % host,
@@ -493,6 +534,7 @@ class Aria2(DownloadClient):
         else:
             return False
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_by_hash(self, torrent_hash: str) -> ClientTorrent:
         result = list(filter(lambda x: x.info_hash == torrent_hash,
                              self.client.get_downloads()))
@@ -510,6 +552,7 @@ class Aria2(DownloadClient):
         if not result:
             return
         self.client.remove(result, force=True, files=True, clean=True)
+        self.invalidate_lookup(torrent_hash)
 
     def torrents(self) -> List[ClientTorrent]:
         torrents = self.client.get_downloads()
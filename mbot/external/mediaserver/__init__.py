@@ -6,11 +6,13 @@ from cacheout import Cache
 from requests import RequestException
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed, Retrying
 
+from mbot.common.cacheregistry import cache_registry
 from mbot.common.osutils import OSUtils
+from mbot.core.cache import l1cache
 from mbot.exceptions import SettingErrorException
 from mbot.external.mediaserver.embymediaserver import EmbyMediaServer
 from mbot.external.mediaserver.jellyfinmediaserver import JellyfinMediaServer
-from mbot.external.mediaserver.models import MediaServer
+from mbot.external.mediaserver.models import LOOKUP_CACHE, MediaServer
 from mbot.external.mediaserver.plexmediaserver import PlexMediaServer
 
 _LOGGER = logging.getLogger(__name__)
@@ -53,12 +55,21 @@ class MediaServerProxy:
         self.server_config = None
         self.media_server = None
         self._refresh_media_item_cache = Cache(maxsize=50, ttl=3600, default=None)
+        self._refresh_cache_name = cache_registry.register_attr('mediaserver.refresh_media_item', self,
+                                                                '_refresh_media_item_cache')
 
     def init(self, server_type, server_config, lazy_connect=True):
+        old = self.media_server
         self.server_type = str(server_type).lower()
         self.server_config = server_config
-        if not lazy_connect:
-            self.media_server = build_server(self.server_type, self.server_config)
+        # 重新初始化时丢弃旧的服务器实例，延迟连接时在下一次访问时按新配置创建
+        self.media_server = None if lazy_connect else build_server(self.server_type, self.server_config)
+        if old is not None:
+            l1cache.invalidate(LOOKUP_CACHE)
+            try:
+                old.close()
+            except Exception as e:
+                _LOGGER.warning(f'关闭旧的媒体服务器连接失败：{e}')
 
     def refresh_media_server(self, tmdb_id, content_path: str, media_type, metadata=False):
         if not tmdb_id:
@@ -77,7 +88,8 @@ class MediaServerProxy:
                 if media:
                     result.append(item)
         if not result:
-            result = self.search_by_id(tmdb_id)
+            with cache_registry.timed_load(self._refresh_cache_name):
+                result = self.search_by_id(tmdb_id)
         if result:
             self._refresh_media_item_cache.set(tmdb_id, result)
         if not result or media_type == 'movie':
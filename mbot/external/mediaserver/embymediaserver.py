@@ -1,12 +1,15 @@
+import asyncio
 import json
 import logging
 import re
 from itertools import groupby
 from typing import List, Dict, Optional
 
-import requests
-
 from mbot.common.numberutils import NumberUtils
+from mbot.common.asyncutils import run_sync
+from mbot.common.requestutils import AsyncHttpClient, PooledHttpClient
+from mbot.core.cache import cached
+from mbot.external.mediaserver.models import LOOKUP_CACHE, LOOKUP_NEGATIVE_TTL, LOOKUP_TTL
 from mbot.external.mediaserver.models import MediaServer
 from mbot.external.mediaserver.models import ListMediaItem, ListMediaFolder
 from mbot.models.mediamodels import MediaType, MediaItem, AudioStream, SubtitleStream, MediaFolder
@@ -36,10 +39,21 @@ class EmbyMediaServer(MediaServer):
         self.port = args['port']
         self.is_https = args['https']
         self.server = '%s://%s:%s' % ("https" if self.is_https else "http", self.host, self.port)
+        self.cache_scope = f'emby:{self.server}'
+        # 同一个服务器的请求复用长连接，pool_size、timeout、retries可以在媒体服务器配置中调整
+        self.http = PooledHttpClient(self.server, headers=self.headers, pool_size=args.get('pool_size'),
+                                     timeout=args.get('timeout'), retries=args.get('retries'))
+        # 季、集和音视频流的查询使用异步客户端，展开剧集时并发请求，concurrency是同时进行的最大请求数
+        self.async_http = AsyncHttpClient(self.server, headers=self.headers, concurrency=args.get('concurrency'),
+                                          timeout=args.get('timeout'), retries=args.get('retries'))
         if args.get('test'):
             self.test()
         self.admin_id = self._get_admin()
 
+    def close(self):
+        self.http.close()
+        run_sync(self.async_http.aclose())
+
     def __wrapper_params__(self, params):
         if params:
             params['api_key'] = self.api_key
@@ -48,29 +62,99 @@ class EmbyMediaServer(MediaServer):
         return params
 
     def __do_get__(self, api, params=None):
-        return requests.get(f'{self.server}{api}', params=self.__wrapper_params__(params), headers=self.headers)
+        return self.http.get(api, params=self.__wrapper_params__(params))
 
     def __do_post__(self, api, params=None):
-        return requests.post(f'{self.server}{api}', data=self.__wrapper_params__(params), headers=self.headers)
+        return self.http.post(api, data=self.__wrapper_params__(params))
 
-    def get_seasons(self, item_id):
+    async def __async_get__(self, api, params=None):
+        return await self.async_http.get(api, params=self.__wrapper_params__(params))
+
+    async def get_seasons_async(self, item_id):
         if not item_id:
             return []
-        r = self.__do_get__(f'/emby/Shows/{item_id}/Seasons')
+        r = await self.__async_get__(f'/emby/Shows/{item_id}/Seasons')
+        if not r.is_success:
+            return []
         try:
-            json_data = r.json()
-            if json_data.get('Items'):
-                return json_data.get('Items')
-            else:
-                return []
+            return r.json().get('Items') or []
         except Exception as e:
             logging.info('Emby访问失败: %s' % e)
             raise e
 
+    async def get_episodes_from_season_id_async(self, item_id, season_id) -> ListMediaItem:
+        r = await self.__async_get__(f'/emby/Shows/{item_id}/Episodes', {'SeasonId': season_id})
+        if not r.is_success:
+            return []
+        data = r.json()
+        if not data or not data.get('Items'):
+            return []
+        return [self.__trans_to_media__(item) for item in data.get('Items') if
+                item.get('LocationType') != 'Virtual']
+
+    async def get_media_streams_async(self, item_id) -> Optional[MediaItem]:
+        r = await self.__async_get__('/emby/Items', {
+            'Ids': item_id,
+            'Recursive': 'true',
+            'Fields': 'MediaStreams'
+        })
+        if not r.is_success:
+            return
+        data = r.json()
+        if not data or not data.get('Items'):
+            return
+        return self.__trans_to_media__(data.get('Items')[0])
+
+    @staticmethod
+    def _copy_streams(target: MediaItem, source: MediaItem):
+        target.video_codec = source.video_codec
+        target.video_container = source.video_container
+        target.video_resolution = source.video_resolution
+        target.audio_streams = source.audio_streams
+        target.subtitle_streams = source.subtitle_streams
+
+    async def _expand_series_async(self, series: List[MediaItem], season_index=None) -> List[ListMediaItem]:
+        """
+        并发展开剧集的季和集，按季、集、最后一集的音频字幕流三层各发出一批请求
+        :param season_index: 只展开这一季，为空时展开全部季
+        :return: 和series顺序一致的季列表
+        """
+        seasons_list = await asyncio.gather(*[self.get_seasons_async(media.id) for media in series])
+        result: List[ListMediaItem] = []
+        all_seasons: ListMediaItem = []
+        for media, seasons in zip(series, seasons_list):
+            sub_list = []
+            for s in seasons:
+                if season_index and s.get('IndexNumber') != season_index:
+                    # 季度检索
+                    continue
+                sub_list.append(self.__trans_to_media__(s))
+            result.append(sub_list)
+            all_seasons.extend(sub_list)
+        episodes_list = await asyncio.gather(
+            *[self.get_episodes_from_season_id_async(media.id, s.id) for media, sub_list in zip(series, result)
+              for s in sub_list])
+        for media_season, episodes in zip(all_seasons, episodes_list):
+            media_season.sub_items = episodes
+        # 季度音频字幕流抽最后一集的信息
+        with_episodes = [s for s in all_seasons if s.sub_items]
+        streams = await asyncio.gather(*[self.get_media_streams_async(s.sub_items[-1].id) for s in with_episodes])
+        for media_season, ep_media in zip(with_episodes, streams):
+            if ep_media:
+                self._copy_streams(media_season, ep_media)
+        return result
+
+    def get_seasons(self, item_id):
+        """
+        同步接口，阻塞等待共享的后台事件循环返回结果；
+        不能在该事件循环的线程内调用（会抛出RuntimeError），协程中请直接await get_seasons_async
+        """
+        return run_sync(self.get_seasons_async(item_id))
+
     def delete(self, item_id):
         if not item_id:
             return
-        r = requests.delete(f'{self.server}/emby/Items/{item_id}?api_key={self.api_key}', headers=self.headers)
+        r = self.http.delete(f'/emby/Items/{item_id}', params={'api_key': self.api_key})
         return r.status_code == 204
 
     def delete_tv(self, media_id, id_type='tmdb', season_index=None, episodes=None):
@@ -122,6 +206,7 @@ class EmbyMediaServer(MediaServer):
                 # 如果只有一季，把父剧集也删了
                 self.logger.info(f'开始删除Emby中剧集 {i.name}')
                 self.delete(i.id)
+        self.invalidate_lookup(media_id)
 
     def delete_movie(self, media_id, id_type='tmdb'):
         items = self.search_by_id(media_id, id_type)
@@ -131,7 +216,9 @@ class EmbyMediaServer(MediaServer):
         for i in items:
             result = self.delete(i.id)
             self.logger.info(f'删除Emby中的{i.name}{"成功" if result else "失败"}')
+        self.invalidate_lookup(media_id)
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def search_by_id(self, id, id_type: str = 'tmdb', fetch_all: bool = True) -> ListMediaItem:
         r = self.__do_get__('/emby/Items', {
             'AnyProviderIdEquals': f'{id_type}.{id}',
@@ -290,39 +377,17 @@ class EmbyMediaServer(MediaServer):
                                  'Recursive': 'true',
                                  'SearchTerm': query.get('query')})
             data = r.json()
-            for item in data.get('Items'):
-                media = self.__trans_to_media__(item)
-                seasons = self.get_seasons(media.id)
-                sub_list = []
-                for s in seasons:
-                    if query.get('season_index') and s.get('IndexNumber') != query.get('season_index'):
-                        # 季度检索
-                        continue
-                    media_season = self.__trans_to_media__(s)
-                    media_season.sub_items = self.get_episodes_from_season_id(media.id, media_season.id)
-                    if media_season.sub_items:
-                        # 季度音频字幕流抽最后一集的信息
-                        ep_media = self.get_media_streams(media_season.sub_items[-1].id)
-                        if ep_media:
-                            media_season.video_codec = ep_media.video_codec
-                            media_season.video_container = ep_media.video_container
-                            media_season.video_resolution = ep_media.video_resolution
-                            media_season.audio_streams = ep_media.audio_streams
-                            media_season.subtitle_streams = ep_media.subtitle_streams
-                    sub_list.append(media_season)
-                if sub_list:
-                    # 剧集音频字幕流抽最后一季的
-                    ss = sub_list[-1]
-                    media.video_codec = ss.video_codec
-                    media.video_container = ss.video_container
-                    media.video_resolution = ss.video_resolution
-                    media.audio_streams = ss.audio_streams
-                    media.subtitle_streams = ss.subtitle_streams
+            series = [self.__trans_to_media__(item) for item in data.get('Items')]
+            seasons_list = run_sync(self._expand_series_async(series, query.get('season_index')))
+            for media, sub_list in zip(series, seasons_list):
                 if len(sub_list) > 0:
+                    # 剧集音频字幕流抽最后一季的
+                    self._copy_streams(media, sub_list[-1])
                     media.sub_items = sub_list
                     media_list.append(media)
         return media_list
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_episodes_from_tmdbid(self, tmdb_id, season_index, fetch_all=True) -> ListMediaItem:
         result: ListMediaItem = self.search_by_id(tmdb_id)
         if not result:
@@ -340,18 +405,11 @@ class EmbyMediaServer(MediaServer):
         return episodes
 
     def get_episodes_from_season_id(self, item_id, season_id) -> ListMediaItem:
-        r = self.__do_get__('/emby/Shows/%s/Episodes?SeasonId=%s' % (item_id, season_id))
-        if not r:
-            return []
-        data = r.json()
-        if not data or not data.get('Items'):
-            return []
-        media_list = []
-        for item in data.get('Items'):
-            if item.get('LocationType') and item.get('LocationType') == 'Virtual':
-                continue
-            media_list.append(self.__trans_to_media__(item))
-        return media_list
+        """
+        同步接口，阻塞等待共享的后台事件循环返回结果；
+        不能在该事件循环的线程内调用（会抛出RuntimeError），协程中请直接await get_episodes_from_season_id_async
+        """
+        return run_sync(self.get_episodes_from_season_id_async(item_id, season_id))
 
     def get_episodes(self, id, season_index: int) -> ListMediaItem:
         r = self.__do_get__('/emby/Shows/%s/Episodes' % id)
@@ -455,17 +513,11 @@ class EmbyMediaServer(MediaServer):
         self.__do_post__(api)
 
     def get_media_streams(self, item_id) -> MediaItem:
-        r = self.__do_get__('/emby/Items', {
-            'Ids': item_id,
-            'Recursive': 'true',
-            'Fields': 'MediaStreams'
-        })
-        if not r:
-            return
-        data = r.json()
-        if not data or not data.get('Items'):
-            return
-        return self.__trans_to_media__(data.get('Items')[0])
+        """
+        同步接口，阻塞等待共享的后台事件循环返回结果；
+        不能在该事件循环的线程内调用（会抛出RuntimeError），协程中请直接await get_media_streams_async
+        """
+        return run_sync(self.get_media_streams_async(item_id))
 
     def list_all(self, media_type):
         if media_type == 'Movie':
@@ -4,10 +4,12 @@ import re
 import uuid
 from typing import List
 
-import requests
-
 from mbot.common.numberutils import NumberUtils
+from mbot.common.cacheregistry import cache_registry
+from mbot.common.requestutils import PooledHttpClient
 from mbot.constants import APP_VERSION
+from mbot.core.cache import cached
+from mbot.external.mediaserver.models import LOOKUP_CACHE, LOOKUP_NEGATIVE_TTL, LOOKUP_TTL
 from mbot.external.mediaserver.models import MediaServer
 from mbot.external.mediaserver.models import library_cache, ListMediaItem, ListMediaFolder
 from mbot.models.mediamodels import MediaType, AudioStream, SubtitleStream, MediaFolder, MediaItem
@@ -35,13 +37,13 @@ class JellyfinMediaServer(MediaServer):
         }
 
     def __do_get__(self, api, params=None):
-        return requests.get(f'{self.server}{api}', params=params, headers=self.__get_headers__())
+        return self.http.get(api, params=params)
 
     def __do_post__(self, api, params=None):
-        return requests.post(f'{self.server}{api}', data=params, headers=self.__get_headers__())
+        return self.http.post(api, data=params)
 
     def __do_delete__(self, api, params=None):
-        return requests.delete(f'{self.server}{api}', data=params, headers=self.__get_headers__())
+        return self.http.delete(api, data=params)
 
     def __trans_to_media__(self, item):
         media = MediaItem()
@@ -166,6 +168,7 @@ class JellyfinMediaServer(MediaServer):
                 # 如果只有一季，把父剧集也删了
                 self.logger.info(f'开始删除Jellyfin中剧集 {i.name}')
                 self.delete(i.id)
+        self.invalidate_lookup(media_id)
 
     def delete_movie(self, media_id, id_type='tmdb'):
         items = self.search_by_id(media_id, id_type)
@@ -175,26 +178,29 @@ class JellyfinMediaServer(MediaServer):
         for i in items:
             result = self.delete(i.id)
             self.logger.info(f'删除Jellyfin中的{i.name}{"成功" if result else "失败"}')
+        self.invalidate_lookup(media_id)
 
     def __get_all__(self):
         key = 'jellyfin:all'
         if library_cache.get(key):
             return library_cache.get(key)
-        r = self.__do_get__(
-            f'/Users/{self.admin_uid}/Items',
-            params={
-                'IncludeItemTypes': 'Movie,Series',
-                'fields': 'ProviderIds',
-                'Recursive': 'true',
-            }
-        )
-        json_data = r.json()
+        with cache_registry.timed_load('mediaserver.library'):
+            r = self.__do_get__(
+                f'/Users/{self.admin_uid}/Items',
+                params={
+                    'IncludeItemTypes': 'Movie,Series',
+                    'fields': 'ProviderIds',
+                    'Recursive': 'true',
+                }
+            )
+            json_data = r.json()
         items = json_data.get('Items')
         if not items:
             return []
         library_cache.set(key, items)
         return items
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def search_by_id(self, id, id_type: str = 'Tmdb', fetch_all: bool = True) -> ListMediaItem:
         items = self.__get_all__()
         if id_type:
@@ -229,10 +235,17 @@ class JellyfinMediaServer(MediaServer):
         self.port = args['port']
         self.is_https = args.get('https')
         self.server = '%s://%s:%s' % ("https" if self.is_https else "http", self.host, self.port)
+        self.cache_scope = f'jellyfin:{self.server}'
+        # 请求头只在创建连接池时生成一次，pool_size、timeout、retries可以在媒体服务器配置中调整
+        self.http = PooledHttpClient(self.server, headers=self.__get_headers__(), pool_size=args.get('pool_size'),
+                                     timeout=args.get('timeout'), retries=args.get('retries'))
         if args.get('test'):
             self.test()
         self.admin_uid = self.__get_admin__()
 
+    def close(self):
+        self.http.close()
+
     def test(self):
         r = self.__do_get__('/System/Info')
         if not r:
@@ -348,6 +361,7 @@ class JellyfinMediaServer(MediaServer):
         api = f'/Items/{item_id}/Refresh?Recursive=true&MetadataRefreshMode=Default&ImageRefreshMode=Default'
         self.__do_post__(api)
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_episodes_from_tmdbid(self, tmdb_id, season_index: int, fetch_all=True):
         result: ListMediaItem = self.search_by_id(tmdb_id)
         if not result:
@@ -3,7 +3,10 @@ from typing import List, Optional
 
 from cacheout import Cache
 
+from mbot.common.cacheregistry import cache_registry
 from mbot.common.mediaparserutils import MediaParserUtils
+from mbot.core.cache import cache_key_prefix, l1cache
+from mbot.core.event.models import EventType
 from mbot.core.health import HealthIndicator, Health
 from mbot.models.mediamodels import MediaType, MediaItem, MediaFolder
 
@@ -11,9 +14,39 @@ ListMediaItem = List[MediaItem]
 ListMediaFolder = List[MediaFolder]
 
 library_cache = Cache(maxsize=256, ttl=900, default=None)
+cache_registry.register('mediaserver.library', library_cache)
+"""按编号查询影片、剧集的结果缓存，同一影片短时间内被多个任务和插件重复查询"""
+LOOKUP_CACHE = 'mediaserver_lookup'
+LOOKUP_TTL = 60
+"""没有找到影片的结果只缓存很短的时间，入库后很快可以查到"""
+LOOKUP_NEGATIVE_TTL = 10
+
+
+def lookup_prefixes(media_id) -> List[str]:
+    """一个影片编号相关的查询缓存键前缀"""
+    return [cache_key_prefix('search_by_id', media_id), cache_key_prefix('get_episodes_from_tmdbid', media_id)]
+
+
+def _library_changed(data):
+    tmdb_id = data.get('tmdb_id') if isinstance(data, dict) else getattr(data, 'tmdb_id', None)
+    # 不知道具体影片时清空全部查询缓存
+    return lookup_prefixes(tmdb_id) if tmdb_id else ''
+
+
+l1cache.invalidate_on(EventType.EmbyLibraryNew, LOOKUP_CACHE, _library_changed)
+l1cache.invalidate_on(EventType.DownloadCompleted, LOOKUP_CACHE, _library_changed)
 
 
 class MediaServer(metaclass=ABCMeta):
+    """查询缓存键中区分服务器的标识，使用服务器地址，替换实例后不会读到其他服务器的结果"""
+    cache_scope: Optional[str] = None
+
+    @staticmethod
+    def invalidate_lookup(media_id):
+        """影片在媒体库中发生变化后，让相关的查询缓存失效"""
+        for prefix in lookup_prefixes(media_id):
+            l1cache.invalidate(LOOKUP_CACHE, prefix)
+
     @staticmethod
     def parse_query(keyword):
         """
@@ -149,6 +182,10 @@ class MediaServer(metaclass=ABCMeta):
     def reload_cache(self):
         pass
 
+    def close(self):
+        """释放连接等资源，服务器实例被替换时调用"""
+        pass
+
 
 class MediaServerHealthIndicator(HealthIndicator):
     """媒体服务器健康检查点"""
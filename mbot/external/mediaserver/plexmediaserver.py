@@ -9,7 +9,10 @@ import requests
 from plexapi.exceptions import Unauthorized
 from plexapi.server import PlexServer
 
+from mbot.common.cacheregistry import cache_registry
 from mbot.common.numberutils import NumberUtils
+from mbot.core.cache import cached
+from mbot.external.mediaserver.models import LOOKUP_CACHE, LOOKUP_NEGATIVE_TTL, LOOKUP_TTL
 from mbot.external.mediaserver.models import MediaServer, ListMediaItem, ListMediaFolder
 from mbot.models.mediamodels import MediaType, AudioStream, SubtitleStream, MediaFolder, MediaItem
 
@@ -28,6 +31,7 @@ class PlexMediaServer(MediaServer):
         self._lock = threading.Lock()
         try:
             self.server_url = args['url']
+            self.cache_scope = f'plex:{self.server_url}'
             self.plex = PlexServer(args['url'], args['token'])
             """
             外部依赖ID与plex关系的缓存
@@ -36,6 +40,7 @@ class PlexMediaServer(MediaServer):
             'tvdb://332684'
             """
             self._id_mapping_cache: Dict[str, List[int]] = dict()
+            self._id_mapping_cache_name = cache_registry.register_attr('plex.id_mapping', self, '_id_mapping_cache')
             # 是否需要加载新增
             self._load_added: bool = False
             _LOGGER.info('Plex连接正常，欢迎回来：%s' % self.plex._server.friendlyName)
@@ -73,7 +78,8 @@ class PlexMediaServer(MediaServer):
                 if self._id_mapping_cache:
                     return self._id_mapping_cache
             _LOGGER.info('获取Plex全量媒体库ID映射数据，此过程速度较慢')
-            items = self.plex.library.all()
+            with cache_registry.timed_load(self._id_mapping_cache_name):
+                items = self.plex.library.all()
             for item in items:
                 if not hasattr(item, 'guids'):
                     continue
@@ -123,6 +129,7 @@ class PlexMediaServer(MediaServer):
                     _LOGGER.error('删除plex剧集出错：%s' % e)
                     continue
                 break
+        self.invalidate_lookup(media_id)
 
     def delete_movie(self, media_id, id_type='tmdb'):
         items = self._search_by_id(id_type, media_id)
@@ -132,6 +139,7 @@ class PlexMediaServer(MediaServer):
                 break
             except Exception as e:
                 _LOGGER.error('删除plex电影出错：%s' % e)
+        self.invalidate_lookup(media_id)
 
     def _trans_to_media(self, item, fetch_all=True):
         media = MediaItem()
@@ -224,6 +232,7 @@ class PlexMediaServer(MediaServer):
             result.append(item)
         return result
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def search_by_id(self, id_, id_type: str = 'tmdb', fetch_all: bool = True) -> ListMediaItem:
         result = self._search_by_id(id_type, id_)
         data: ListMediaItem = []
@@ -342,6 +351,7 @@ class PlexMediaServer(MediaServer):
         miss_ep.sort()
         return miss_ep
 
+    @cached(LOOKUP_CACHE, ttl=LOOKUP_TTL, negative_ttl=LOOKUP_NEGATIVE_TTL)
     def get_episodes_from_tmdbid(self, tmdb_id, season_index, fetch_all=True) -> ListMediaItem:
         result = self.search_by_id(tmdb_id)
         if not result:
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+
+from mbot.core.cache import CachePolicy, TieredCacheManager
+from mbot.core.event.eventlistener import EventListener
+
+
+def test_tiered_cache_l2_survives_restart(tmp_path):
+    db = os.path.join(tmp_path, 'cache.db')
+    manager = TieredCacheManager()
+    manager.open_l2(db)
+    manager.declare('douban_media', maxsize=2, ttl=60, policy=CachePolicy.LRU)
+    manager['douban_media'].set('m1', {'title': 'a'})
+    manager['douban_media'].set('m2', {'title': 'b'}, ttl=0.01)
+    manager.close_l2()
+    time.sleep(0.02)
+
+    restarted = TieredCacheManager()
+    restarted.open_l2(db)
+    cache = restarted.declare('douban_media', maxsize=2, ttl=60)
+    assert cache.size() == 0
+    assert cache.get('m1') == {'title': 'a'}
+    assert cache.size() == 1
+    assert cache.get('m2') is None
+    restarted.declare('media_image', persistent=False)
+    restarted['media_image'].set('x', 1)
+    assert restarted.l2.count('media_image') == 0
+    restarted.close_l2()
+
+
+def test_tiered_cache_single_flight_and_stale():
+    manager = TieredCacheManager()
+    calls = []
+    gate = threading.Event()
+
+    @manager.namespace('slow', ttl=0.05, stale_ttl=60)
+    def load(key):
+        calls.append(key)
+        gate.wait(1)
+        return f'{key}-{len(calls)}'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(load('k'))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    gate.set()
+    for t in threads:
+        t.join()
+    assert calls == ['k']
+    assert results == ['k-1'] * 5
+
+    time.sleep(0.06)
+    # 过期但仍在宽限期内，先返回旧数据，后台刷新
+    assert load('k') == 'k-1'
+    assert load.cache.get('k') is None or load.cache.get('k') == 'k-2'
+    for _ in range(100):
+        if load.cache.get('k') == 'k-2':
+            break
+        time.sleep(0.01)
+    assert load('k') == 'k-2'
+    assert calls == ['k', 'k']
+
+
+def test_cache_registry_stats_and_purge():
+    from cacheout import Cache
+
+    from mbot.common.cacheregistry import CacheRegistry
+
+    registry = CacheRegistry()
+    plain = Cache(maxsize=1)
+    registry.register('plain', plain)
+    plain.set('a', 'x' * 100)
+    plain.set('b', 'y')
+    plain.get('b')
+    plain.get('a')
+    with registry.timed_load('plain'):
+        pass
+
+    class Owner:
+        def __init__(self):
+            self.mapping = {'tmdb://1': [1, 2]}
+
+    owner = Owner()
+    assert registry.register_attr('owned', owner, 'mapping') == 'owned'
+    other = Owner()
+    assert registry.register_attr('owned', other, 'mapping') == 'owned-2'
+
+    stats = {s.name: s for s in registry.get_stats()}
+    assert stats['plain'].hits == 1 and stats['plain'].misses == 1 and stats['plain'].evictions == 1
+    assert stats['plain'].loads == 1
+    assert stats['owned'].size == 1 and stats['owned'].approx_bytes > 0
+
+    assert registry.purge('owned*') == ['owned', 'owned-2']
+    assert owner.mapping == {}
+    del other
+    assert registry.names() == ['plain', 'owned']
+
+
+def test_tiered_cache_reports_stats():
+    from mbot.common.cacheregistry import cache_registry
+
+    manager = TieredCacheManager('test_tiered')
+    cache = manager.declare('ns', maxsize=10)
+    cache.get('missing')
+    cache.get_or_load('k', lambda: 'v')
+    cache.get('k')
+    stats = cache_registry.get_stats('test_tiered.*')
+    assert [s.name for s in stats] == ['test_tiered.ns']
+    assert (stats[0].hits, stats[0].misses, stats[0].loads, stats[0].size) == (1, 2, 1, 1)
+    assert cache_registry.purge('test_tiered.ns') == ['test_tiered.ns']
+    assert cache.size() == 0
+
+
+def test_cached_negative_results_and_event_invalidation():
+    from mbot.core.cache import cache_key_prefix, cached
+    from mbot.core.event.eventbus import EventBus
+    from mbot.core.event.models import Event, EventType
+
+    manager = TieredCacheManager()
+    calls = []
+
+    class Server:
+        cache_scope = 'emby'
+
+        @cached('lookup', ttl=60, negative_ttl=60, manager=manager)
+        def search_by_id(self, id, id_type='tmdb'):
+            calls.append(id)
+            return [id] if id != 404 else []
+
+        @cached('lookup', ttl=60, manager=manager)
+        def relogin(self, retry=True):
+            calls.append('relogin')
+            # 加载过程中再次调用自身不能被单飞阻塞
+            return self.relogin(False) if retry else 'ok'
+
+    server = Server()
+    assert server.search_by_id(1) == [1]
+    assert server.search_by_id(1, 'tmdb') == [1]
+    assert server.search_by_id(id=1) == [1]
+    assert server.search_by_id(404) == [] and server.search_by_id(404) == []
+    assert calls == [1, 404]
+    # 调用方修改返回的list不影响缓存和其他调用方
+    server.search_by_id(1).append('mutated')
+    assert server.search_by_id(1) == [1] and server.search_by_id(1) is not server.search_by_id(1)
+    assert server.relogin() == 'ok'
+    assert calls.count('relogin') == 2
+
+    bus = EventBus(None)
+    manager.bind_events(bus)
+    manager.invalidate_on(EventType.DownloadCompleted, 'lookup',
+                          lambda data: cache_key_prefix('search_by_id', data['tmdb_id']))
+    seen = []
+    bus.add_listener(EventListener(lambda t, d: seen.append(server.search_by_id(404)), EventType.DownloadCompleted),
+                     show_log=False)
+    bus.publish_event(Event.builder().set_event_type(EventType.DownloadCompleted).set_data({'tmdb_id': 404}).build())
+    # 失效发生在监听器之前，监听器重新查询
+    assert calls == [1, 404, 'relogin', 'relogin', 404]
+    assert seen == [[]]
+    assert server.search_by_id(1) == [1]
+    assert calls[-1] == 404
+
+    Server.search_by_id.invalidate(server, 1)
+    server.search_by_id(1)
+    assert calls[-1] == 1
+    assert manager.invalidate('lookup', 'search_by_id:') == 2
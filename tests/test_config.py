@@ -0,0 +1,165 @@
+import time
+
+import pytest
+import yaml
+
+from mbot.core import MovieBot
+from mbot.core.config import ConfigValues
+from mbot.core.configstore import ConfigStore
+from mbot.core.plugins import PluginManifest, PluginMeta
+from mbot.core.plugins.pluginloader import PluginLoader
+
+
+def test_snapshot_copy_on_write_and_subscriptions():
+    store = ConfigStore({'web': {'host': '::', 'port': 1329}, 'subtitle': {'enable': True, 'langs': ['zh-cn']}})
+    first = store.snapshot
+    assert first.web.port == 1329 and first.get('web.port') == 1329
+    with pytest.raises(AttributeError):
+        first.web.port = 1
+    calls = []
+    store.subscribe('web', lambda snapshot, changed: calls.append(changed))
+    assert store.set('web.port', 8080) == ['web.port']
+    second = store.snapshot
+    assert second.version == 1 and first.web.port == 1329 and second.web.port == 8080
+    # 没有变化的子树直接复用
+    assert second.subtitle is first.subtitle
+    assert store.replace({'web': {'host': '::', 'port': 8080}, 'subtitle': {'enable': False, 'langs': ['zh-cn']}}) \
+           == ['subtitle.enable']
+    assert store.set('web.port', 8080) == []
+    store.delete('web')
+    assert calls == [['web.port'], ['web']]
+    assert store.snapshot.to_dict() == {'subtitle': {'enable': False, 'langs': ['zh-cn']}}
+
+
+def test_config_values_debounced_atomic_save(tmp_path):
+    filepath = tmp_path / 'base_config.yml'
+    config = ConfigValues({'web': {'port': 1329}}, str(filepath))
+    config.save()
+    assert yaml.safe_load(filepath.read_text(encoding='utf-8')) == {'web': {'port': 1329}}
+    config.web['port'] = 1
+    config.save(delay=0.2)
+    config['media_path'] = ['/media']
+    config.save(delay=0.2)
+    assert yaml.safe_load(filepath.read_text(encoding='utf-8'))['web']['port'] == 1329
+    assert config.snapshot().web.port == 1 and config.snapshot().media_path == ('/media',)
+    time.sleep(0.5)
+    assert yaml.safe_load(filepath.read_text(encoding='utf-8')) == {'web': {'port': 1}, 'media_path': ['/media']}
+    assert not (tmp_path / 'base_config.yml.tmp').exists()
+
+
+def test_plugin_config_changed(tmp_path):
+    mbot = MovieBot()
+    mbot.config.plugins_config = ConfigValues({'demo': {'key': 1}, 'other': {'key': 1}})
+    loader = PluginLoader(str(tmp_path), 'plugins', mbot)
+    loader.load()
+    plugin = PluginMeta('demo', 'plugins.demo', PluginManifest({'name': 'demo'}), None)
+    changes = []
+    plugin.config_changed(changes.append)
+    mbot.plugins['demo'] = plugin
+    mbot.config.plugins_config['other'] = {'key': 2}
+    mbot.config.plugins_config['demo'] = {'key': 2}
+    mbot.config.plugins_config.demo['key'] = 3
+    mbot.config.plugins_config.save(delay=0)
+    assert changes == [{'key': 2}, {'key': 3}]
+
+
+def test_site_config_cache(tmp_path, monkeypatch):
+    from mbot.core import config as config_module
+    from mbot.core.config import Config
+
+    site_dir = tmp_path / 'sites'
+    site_dir.mkdir()
+    for i in range(3):
+        (site_dir / f'site{i}.yml').write_text(f'#!DATA cookie=c{i}\nid: site{i}\ndomain: https://site{i}.org\n',
+                                               encoding='utf-8')
+    config = Config()
+    config.config_dir = str(tmp_path)
+    config.load_site_config(str(site_dir))
+    assert sorted(config.sites) == ['site0', 'site1', 'site2']
+    assert config.sites['site1'].get_ext_data('cookie') == 'c1'
+    parsed = []
+    read_site_file = config_module.read_site_file
+    monkeypatch.setattr(config_module, 'read_site_file', lambda f: parsed.append(f) or read_site_file(f))
+    # 新进程启动时直接使用缓存
+    config = Config()
+    config.config_dir = str(tmp_path)
+    config.load_site_config(str(site_dir))
+    assert parsed == [] and config.sites['site2'].domain == 'https://site2.org'
+    config.sites['site0'].set_ext_data('cookie', 'new', update_file=True)
+    (site_dir / 'site2.yml').unlink()
+    (site_dir / 'site3.yml').write_text('id: site3\n', encoding='utf-8')
+    assert sorted(config.refresh_site_config()) == ['site0', 'site2', 'site3']
+    assert sorted(parsed) == [str(site_dir / 'site0.yml'), str(site_dir / 'site3.yml')]
+    assert sorted(config.sites) == ['site0', 'site1', 'site3']
+    assert config.sites['site0'].get_ext_data('cookie') == 'new'
+    assert config.refresh_site_config() == []
+
+
+def test_config_values_save_edits_made_before_first_save(tmp_path):
+    filepath = tmp_path / 'base_config.yml'
+    filepath.write_text(yaml.dump({'web': {'port': 1329}}), encoding='utf-8')
+    config = ConfigValues({'web': {'port': 1329}}, str(filepath))
+    config.web.port = 2000
+    config['new'] = 1
+    config.save()
+    assert yaml.safe_load(filepath.read_text(encoding='utf-8')) == {'web': {'port': 2000}, 'new': 1}
+
+
+def test_config_values_version_tracks_nested_edits():
+    config = ConfigValues({'demo': {'key': 1}})
+    assert config.snapshot().demo.key == 1
+    edits = [lambda: setattr(config, 'foo', 1), lambda: setattr(config.demo, 'key', 2),
+             lambda: config.demo.update({'other': 1}), lambda: config.update({'a': 1}),
+             lambda: config.setdefault('b', 2), lambda: config.pop('a')]
+    for edit in edits:
+        version = config.get_version()
+        edit()
+        assert config.get_version() == version + 1
+    version = config.get_version()
+    config.setdefault('b', 3)
+    config.pop('missing', None)
+    assert config.get_version() == version
+    # 子配置的修改同时发布到上级的快照
+    assert config.snapshot().to_dict() == {'demo': {'key': 2, 'other': 1}, 'foo': 1, 'b': 2}
+
+
+def test_config_values_edit_refreezes_only_changed_branch(monkeypatch):
+    config = ConfigValues({'web': {'port': 1329}, 'subtitle': {'langs': ['zh-cn']}})
+    first = config.snapshot()
+    monkeypatch.setattr(ConfigStore, 'replace', lambda *args: pytest.fail('单个键的修改不应重建整个配置'))
+    config.web.port = 8080
+    second = config.snapshot()
+    assert second.web.port == 8080 and first.web.port == 1329
+    assert second.subtitle is first.subtitle
+
+
+def test_site_config_cache_skips_values_json_cannot_keep(tmp_path):
+    import datetime
+    from mbot.core.config import SiteConfigCache
+
+    cache = SiteConfigCache(str(tmp_path / 'cache.json'))
+    cache.put('a.yml', (1, 2), {'id': 'a'}, {})
+    cache.put('b.yml', (1, 2), {'id': 'b', 'since': datetime.date(2020, 1, 1)}, {})
+    cache.put('c.yml', (1, 2), {'id': 'c', 1: 'int key'}, {})
+    cache.save()
+    cache = SiteConfigCache(str(tmp_path / 'cache.json'))
+    cache.load()
+    assert cache.get('a.yml', (1, 2)) == ({'id': 'a'}, {})
+    assert cache.get('a.yml', (1, 3)) is None
+    assert cache.get('b.yml', (1, 2)) is None and cache.get('c.yml', (1, 2)) is None
+
+
+def test_cache_store_opened_by_movie_bot_not_config(tmp_path):
+    from mbot.core.cache import l1cache
+    from mbot.core.config import Config
+
+    (tmp_path / 'notify_template').mkdir()
+    (tmp_path / 'rule').mkdir()
+    l1cache.close_l2()
+    Config().load_config(str(tmp_path))
+    assert l1cache.l2 is None
+    try:
+        MovieBot().load_config(str(tmp_path))
+        assert l1cache.l2 is not None and (tmp_path / '.cache.db').exists()
+    finally:
+        l1cache.close_l2()
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from mbot.external.mediaserver.embymediaserver import EmbyMediaServer
+
+SEASONS = 20
+DELAY = 0.2
+
+
+def _serve():
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            calls.append(url.path)
+            time.sleep(DELAY)
+            parts = url.path.strip('/').split('/')
+            if 'missing' in parts:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if url.path == '/emby/Users':
+                data = [{'Id': 'admin', 'Policy': {'IsAdministrator': True}}]
+            elif parts[:2] == ['emby', 'Shows'] and parts[3] == 'Seasons':
+                data = {'Items': [{'Id': f's{i}', 'Type': 'Season', 'IndexNumber': i} for i in range(1, SEASONS + 1)]}
+            elif parts[:2] == ['emby', 'Shows'] and parts[3] == 'Episodes':
+                season_id = query['SeasonId']
+                data = {'Items': [{'Id': f'{season_id}e{i}', 'Type': 'Episode', 'IndexNumber': i} for i in (1, 2)] + [
+                    {'Id': f'{season_id}e3', 'Type': 'Episode', 'IndexNumber': 3, 'LocationType': 'Virtual'}]}
+            elif 'Ids' in query:
+                data = {'Items': [{'Id': query['Ids'], 'Type': 'Episode', 'Container': 'mkv', 'MediaStreams': [
+                    {'Type': 'Video', 'Codec': 'hevc', 'Width': 1920, 'Height': 1080}]}]}
+            else:
+                data = {'Items': [{'Id': 'tv1', 'Type': 'Series', 'Name': 'Show'}]}
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, calls
+
+
+def test_search_by_keyword_expands_seasons_concurrently():
+    server, calls = _serve()
+    try:
+        emby = EmbyMediaServer(api_key='key', host='127.0.0.1', port=server.server_port, https=False, test=False,
+                               concurrency=SEASONS * 2)
+        start = time.perf_counter()
+        result = emby.search_by_keyword('Show')
+        elapsed = time.perf_counter() - start
+        assert len(result) == 1
+        seasons = result[0].sub_items
+        assert [s.index for s in seasons] == list(range(1, SEASONS + 1))
+        assert all([e.index for e in s.sub_items] == [1, 2] for s in seasons)
+        assert all(s.video_codec == 'hevc' and s.video_container == 'mkv' for s in seasons)
+        assert result[0].video_resolution == '1920x1080'
+        # 两次搜索加上季、集、音视频流三层，逐个请求需要2 + 1 + 20 * 2次往返
+        assert len(calls) == 1 + 2 + 1 + SEASONS * 2
+        assert elapsed < DELAY * 10
+        # 同步接口和并发展开使用同一套解析
+        assert len(emby.get_seasons('tv1')) == SEASONS
+        assert emby.get_seasons('missing') == []
+        assert [e.id for e in emby.get_episodes_from_season_id('tv1', 's1')] == ['s1e1', 's1e2']
+        assert emby.get_media_streams('s1e2').video_codec == 'hevc'
+    finally:
+        server.shutdown()
+
+
+def test_proxy_reinit_drops_server_and_lookup_cache():
+    from mbot.core.cache import l1cache
+    from mbot.external.mediaserver import MediaServerProxy
+    from mbot.external.mediaserver.models import LOOKUP_CACHE
+
+    server, _ = _serve()
+    config = {'api_key': 'key', 'host': '127.0.0.1', 'port': server.server_port, 'https': False, 'test': False}
+    try:
+        proxy = MediaServerProxy()
+        proxy.init('emby', config, lazy_connect=False)
+        old = proxy.media_server
+        assert old.cache_scope == f'emby:http://127.0.0.1:{server.server_port}'
+        old.get_seasons('tv1')
+        assert old.async_http._client is not None
+        l1cache[LOOKUP_CACHE].set('search_by_id:1:tmdb:True:@old', ['item'])
+        proxy.init('emby', config)
+        assert proxy.media_server is None
+        # 被替换的实例关闭了连接池
+        assert old.async_http._client is None
+        assert l1cache[LOOKUP_CACHE].get('search_by_id:1:tmdb:True:@old') is None
+    finally:
+        server.shutdown()
@@ -0,0 +1,318 @@
+import os
+import threading
+import time
+
+from mbot.core import MovieBot
+from mbot.core.config import ConfigValues
+from mbot.core.event.eventlistener import EventListener
+from mbot.core.event.models import Event, EventType
+from mbot.core.plugins import PluginManifest, PluginMeta
+
+mbot = MovieBot()
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def _event(event_type, data=None):
+    return Event.builder().set_event_type(event_type).set_data(data or {}).build()
+
+
+def test_publish_in_order():
+    calls = []
+    first = EventListener(lambda t, d: calls.append('first'), EventType.DownloadCompleted, 1)
+    last = EventListener(lambda t, d: calls.append('last'), EventType.DownloadCompleted, 200)
+    middle = EventListener(lambda t, d: calls.append('middle'), EventType.DownloadCompleted)
+    mbot.event_bus.add_listener(last, show_log=False)
+    mbot.event_bus.add_listener(first, show_log=False)
+    mbot.event_bus.add_listener(middle, show_log=False)
+    mbot.event_bus.publish_event(_event(EventType.DownloadCompleted))
+    assert calls == ['first', 'middle', 'last']
+    for x in [first, middle, last]:
+        mbot.event_bus.remove_listener(x)
+    assert not mbot.event_bus.get_listeners(EventType.DownloadCompleted)
+
+
+def test_plugin_context_invalidated_on_config_change():
+    mbot.config.plugins_config = ConfigValues({'demo': {'key': 1}})
+    plugin = PluginMeta('demo', 'plugins.demo', PluginManifest({'name': 'demo'}), None)
+    configs = []
+    listener = EventListener(lambda ctx, t, d: configs.append(ctx.config.get('key')), 'demo_event')
+    listener.set_plugin(plugin)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    mbot.event_bus.publish_event(_event('demo_event'))
+    mbot.event_bus.publish_event(_event('demo_event'))
+    mbot.config.plugins_config['demo'] = {'key': 2}
+    mbot.event_bus.publish_event(_event('demo_event'))
+    assert configs == [1, 1, 2]
+    mbot.event_bus.remove_listener(listener)
+
+
+def test_async_listener():
+    calls = []
+
+    @mbot.on_event('async_event')
+    async def on_async(event_type, data):
+        calls.append(data['n'])
+
+    mbot.event_bus.publish_event(_event('async_event', {'n': 1}))
+    assert calls == [1]
+    for n in range(2, 6):
+        mbot.event_bus.publish_event(_event('async_event', {'n': n}), run_in_background=True)
+    _wait_until(lambda: len(calls) == 5)
+    assert sorted(calls) == [1, 2, 3, 4, 5]
+
+
+def test_async_mode_limits_listener_concurrency():
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0, 'done': 0}
+
+    def slow(event_type, data):
+        with lock:
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+        time.sleep(0.02)
+        with lock:
+            state['running'] -= 1
+            state['done'] += 1
+
+    listener = EventListener(slow, 'limited_event', concurrency=2)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    mbot.event_bus.set_async_mode(True)
+    try:
+        for _ in range(6):
+            mbot.event_bus.publish_event(_event('limited_event'), run_in_background=True)
+        _wait_until(lambda: state['done'] == 6)
+    finally:
+        mbot.event_bus.set_async_mode(False)
+        mbot.event_bus.remove_listener(listener)
+    assert state['done'] == 6
+    assert state['max'] <= 2
+
+
+def test_coalesce_queue_keeps_latest_payload():
+    release = threading.Event()
+    seen = []
+
+    def slow(event_type, data):
+        release.wait(5)
+        seen.append(data)
+
+    listener = EventListener(slow, 'progress_event', concurrency=1, queue_size=2, overflow='coalesce',
+                             coalesce_key='tmdb_id')
+    mbot.event_bus.add_listener(listener, show_log=False)
+    try:
+        mbot.event_bus.publish_event(_event('progress_event', {'tmdb_id': 0, 'p': 0}), run_in_background=True)
+        for p in range(1, 4):
+            mbot.event_bus.publish_event(_event('progress_event', {'tmdb_id': 1, 'p': p}), run_in_background=True)
+        mbot.event_bus.publish_event(_event('progress_event', {'tmdb_id': 2, 'p': 9}), run_in_background=True)
+        mbot.event_bus.publish_event(_event('progress_event', {'tmdb_id': 3, 'p': 9}), run_in_background=True)
+        release.set()
+        _wait_until(lambda: len(seen) == 3)
+        stats = [s for s in mbot.event_bus.get_queue_stats() if s.name == listener.name][0]
+    finally:
+        mbot.event_bus.remove_listener(listener)
+    assert seen == [{'tmdb_id': 0, 'p': 0}, {'tmdb_id': 2, 'p': 9}, {'tmdb_id': 3, 'p': 9}]
+    assert stats.coalesced == 2
+    assert stats.dropped == 1
+
+
+def test_full_default_queue_does_not_block_publisher():
+    release = threading.Event()
+
+    listener = EventListener(lambda t, d: release.wait(5), 'full_queue_event', concurrency=1, queue_size=1)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    try:
+        start = time.perf_counter()
+        for n in range(5):
+            mbot.event_bus.publish_event(_event('full_queue_event', {'n': n}), run_in_background=True)
+        elapsed = time.perf_counter() - start
+        stats = [s for s in mbot.event_bus.get_queue_stats() if s.name == listener.name][0]
+    finally:
+        release.set()
+        mbot.event_bus.remove_listener(listener)
+    assert elapsed < 0.5
+    assert stats.policy == 'drop_oldest' and stats.blocked == 0 and stats.dropped >= 3
+
+
+def test_listener_metrics():
+    def failing(event_type, data):
+        if data.get('fail'):
+            raise RuntimeError('fail')
+
+    listener = EventListener(failing, 'metrics_event')
+    mbot.event_bus.add_listener(listener, show_log=False)
+    mbot.event_bus.publish_event(_event('metrics_event'))
+    mbot.event_bus.publish_event(_event('metrics_event', {'fail': True}))
+    mbot.event_bus.remove_listener(listener)
+    metrics = mbot.get_event_metrics('metrics_event')
+    assert len(metrics) == 1
+    assert metrics[0].calls == 2
+    assert metrics[0].errors == 1
+    assert metrics[0].in_flight == 0
+    assert metrics[0].p99_ms is not None
+    text = mbot.get_event_metrics_prometheus()
+    assert 'mbot_event_listener_calls_total{event="metrics_event",' in text
+    assert 'le="+Inf"} 2' in text
+
+
+def test_publish_batch():
+    batches = []
+    singles = []
+    batch_listener = EventListener(lambda t, d: batches.append(list(d)), 'library_new', batch=True, max_batch=3,
+                                   max_wait_ms=50)
+    single_listener = EventListener(lambda t, d: singles.append(d['n']), 'library_new')
+    mbot.event_bus.add_listener(batch_listener, show_log=False)
+    mbot.event_bus.add_listener(single_listener, show_log=False)
+    try:
+        events = [_event('library_new', {'n': n}) for n in range(5)]
+        mbot.event_bus.publish_batch(events)
+        assert batches == [[{'n': 0}, {'n': 1}, {'n': 2}], [{'n': 3}, {'n': 4}]]
+        assert singles == [0, 1, 2, 3, 4]
+        batches.clear()
+        mbot.event_bus.publish_batch(events, run_in_background=True)
+        _wait_until(lambda: sum(len(b) for b in batches) == 5)
+        assert batches[0] == [{'n': 0}, {'n': 1}, {'n': 2}]
+        assert sum(len(b) for b in batches) == 5
+    finally:
+        mbot.event_bus.remove_listener(batch_listener)
+        mbot.event_bus.remove_listener(single_listener)
+
+
+def _isolated_listener(event_type, data):
+    time.sleep(data.get('sleep', 0))
+    if data.get('fail'):
+        raise ValueError('isolated failure')
+    return os.getpid() != data['pid']
+
+
+def test_publish_batch_follows_listener_order():
+    calls = []
+    listeners = [
+        EventListener(lambda t, d: calls.append(('before', d['n'])), 'batch_order', order=1),
+        EventListener(lambda t, d: calls.append(('batch', [x['n'] for x in d])), 'batch_order', order=2, batch=True),
+        EventListener(lambda t, d: calls.append(('after', d['n'])), 'batch_order', order=3),
+    ]
+    for listener in listeners:
+        mbot.event_bus.add_listener(listener, show_log=False)
+    try:
+        mbot.event_bus.publish_batch([_event('batch_order', {'n': n}) for n in range(2)])
+        assert calls == [('before', 0), ('before', 1), ('batch', [0, 1]), ('after', 0), ('after', 1)]
+    finally:
+        for listener in listeners:
+            mbot.event_bus.remove_listener(listener)
+
+
+def test_isolated_listener():
+    listener = EventListener(_isolated_listener, 'isolated_event', isolated=True)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    try:
+        mbot.event_bus.publish_event(_event('isolated_event', {'pid': os.getpid()}))
+        mbot.event_bus.publish_event(_event('isolated_event', {'pid': os.getpid(), 'fail': True}))
+        metrics = mbot.get_event_metrics('isolated_event')
+        assert metrics[0].calls == 2
+        assert metrics[0].errors == 1
+        assert '__core__' in mbot.event_bus.isolated_executor.stats()
+    finally:
+        mbot.event_bus.remove_listener(listener)
+
+
+def test_isolated_health_check_skips_busy_pool(monkeypatch):
+    from mbot.core.event import isolation
+    monkeypatch.setattr(isolation, 'HEALTH_CHECK_TIMEOUT', 0.2)
+    executor = isolation.IsolatedExecutor(health_check_interval=0)
+    try:
+        assert executor.run(None, _isolated_listener, None, 'e', {'pid': os.getpid()}) == (True, None)
+        assert executor.check_health() == {isolation.CORE_POOL: True}
+        result = []
+        worker = threading.Thread(
+            target=lambda: result.append(executor.run(None, _isolated_listener, None, 'e',
+                                                      {'pid': os.getpid(), 'sleep': 1})))
+        worker.start()
+        _wait_until(lambda: executor.stats()[isolation.CORE_POOL]['running'] == 1)
+        # 长时间运行的监听器超过了探测的超时时间，进程池不会被重建
+        assert executor.check_health() == {isolation.CORE_POOL: True}
+        worker.join(5)
+        assert result == [(True, None)]
+        assert executor.stats()[isolation.CORE_POOL]['restarts'] == 0
+        process = next(iter(executor._pools[isolation.CORE_POOL]._processes.values()))
+        process.kill()
+        process.join(5)
+        assert executor.check_health() == {isolation.CORE_POOL: False}
+        assert executor.stats()[isolation.CORE_POOL]['restarts'] == 1
+    finally:
+        executor.shutdown()
+
+
+def test_wildcard_and_predicate_subscription():
+    calls = []
+    wildcard = EventListener(lambda t, d: calls.append(('wildcard', t)), 'EmbyPlay*', order=1)
+    movies = EventListener(lambda t, d: calls.append(('movie', d['name'])), ['EmbyPlay*', 'EmbyPlayStart'], order=2,
+                           when={'item.type': ['Movie', 'Film']})
+    mbot.event_bus.add_listener(wildcard, show_log=False)
+    mbot.event_bus.add_listener(movies, show_log=False)
+    try:
+        mbot.event_bus.publish_event(_event('EmbyPlayStart', {'name': 'a', 'item': {'type': 'Movie'}}))
+        mbot.event_bus.publish_event(_event('EmbyPlayStop', {'name': 'b', 'item': {'type': 'Episode'}}))
+        mbot.event_bus.publish_event(_event('JellyfinPlayStart', {'name': 'c', 'item': {'type': 'Movie'}}))
+        assert calls == [('wildcard', 'EmbyPlayStart'), ('movie', 'a'), ('wildcard', 'EmbyPlayStop')]
+        assert mbot.event_bus.get_listeners('EmbyPlayPause') == (wildcard, movies)
+    finally:
+        mbot.event_bus.remove_listener(wildcard)
+        mbot.event_bus.remove_listener(movies)
+    assert not mbot.event_bus.get_listeners('EmbyPlayStart')
+
+
+def test_plugin_usage_accounting():
+    from mbot.core.plugins.usage import usage_tracker
+    mbot.config.plugins_config = ConfigValues({})
+    heavy = PluginMeta('usage_heavy', 'plugins.usage_heavy', PluginManifest({'name': 'usage_heavy'}), None)
+    light = PluginMeta('usage_light', 'plugins.usage_light', PluginManifest({'name': 'usage_light'}), None)
+
+    @light.command(name='sleep', title='sleep')
+    def sleep_command(ctx):
+        time.sleep(0.05)
+        return True
+
+    def burn(ctx, event_type, data):
+        end = time.thread_time() + 0.05
+        while time.thread_time() < end:
+            pass
+        # 嵌套调用其他插件的功能指令，耗时记在被调用的插件上
+        light.get_command()[0](None)
+
+    listener = EventListener(burn, 'usage_event')
+    listener.set_plugin(heavy)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    mbot.set_plugin_memory_sampling(1)
+    try:
+        mbot.event_bus.publish_event(_event('usage_event'))
+    finally:
+        mbot.set_plugin_memory_sampling(None)
+        mbot.event_bus.remove_listener(listener)
+    usage = heavy.get_usage()
+    assert usage.calls == 1 and usage.kinds[0].kind == 'event'
+    assert usage.cpu_ms >= 45
+    assert usage.wall_ms < 100
+    assert usage.memory_samples == 1
+    nested = light.get_usage()
+    assert nested.calls == 1 and nested.wall_ms >= 45 and nested.cpu_ms < 20
+    assert mbot.get_plugin_usage()[0].plugin_name == 'usage_heavy'
+    usage_tracker.reset('usage_heavy')
+    assert heavy.get_usage().calls == 0
+
+    def fail(ctx, event_type, data):
+        raise ValueError('usage failure')
+
+    listener = EventListener(fail, 'usage_event')
+    listener.set_plugin(heavy)
+    mbot.event_bus.add_listener(listener, show_log=False)
+    try:
+        mbot.event_bus.publish_event(_event('usage_event'))
+    finally:
+        mbot.event_bus.remove_listener(listener)
+    usage = heavy.get_usage()
+    assert usage.calls == 1 and usage.errors == 1
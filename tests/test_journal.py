@@ -0,0 +1,89 @@
+import os
+import time
+
+from mbot.core import MovieBot
+from mbot.core.event.eventlistener import EventListener
+from mbot.core.event.journal import EventJournal
+from mbot.core.event.models import Event
+
+
+def test_unacked_entries_are_recovered(tmp_path):
+    journal = EventJournal(str(tmp_path))
+    assert journal.open() == []
+    first = journal.append('DownloadCompleted', {'tmdb_id': 1}, ['a', 'b'])
+    second = journal.append('DownloadCompleted', {'tmdb_id': 2}, ['a'])
+    journal.ack(first, 'a')
+    journal.ack(second, 'a')
+    journal.close()
+    # 模拟崩溃时写了一半的记录
+    with open(os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0]), 'ab') as f:
+        f.write(b'0000')
+    journal = EventJournal(str(tmp_path))
+    entries = journal.open()
+    assert [(e.id, e.data, e.pending) for e in entries] == [(first, {'tmdb_id': 1}, {'b'})]
+    journal.ack(first, 'b')
+    journal.close()
+    assert EventJournal(str(tmp_path)).open() == []
+
+
+def test_segments_rotate_and_compact(tmp_path):
+    journal = EventJournal(str(tmp_path), segment_size=256, commit_interval_ms=0)
+    journal.open()
+    ids = [journal.append('e', {'n': n}, ['a']) for n in range(20)]
+    for entry_id in ids[:-1]:
+        journal.ack(entry_id, 'a')
+    deadline = time.time() + 5
+    while len(os.listdir(str(tmp_path))) > 2 and time.time() < deadline:
+        journal.append('e', {'n': -1}, [])
+        time.sleep(0.01)
+    journal.close()
+    assert len(os.listdir(str(tmp_path))) <= 2
+    entries = EventJournal(str(tmp_path)).open()
+    assert [e.id for e in entries] == [ids[-1]]
+
+
+def test_acks_kept_while_older_segment_is_pending(tmp_path):
+    # 第一段的事件太多不做迁移，它们的确认记录写在之后的日志段中
+    journal = EventJournal(str(tmp_path), segment_size=256, commit_interval_ms=0, compact_max_entries=0)
+    journal.open()
+    ids = [journal.append('e', {'n': n}, ['a']) for n in range(10)]
+    deadline = time.time() + 5
+    while journal._active_segment < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    for entry_id in ids[1:]:
+        journal.ack(entry_id, 'a')
+    while journal._active_segment < 5 and time.time() < deadline:
+        journal.ack(journal.append('e', {'n': -1}, ['a']), 'a')
+        time.sleep(0.01)
+    journal.close()
+    entries = EventJournal(str(tmp_path)).open()
+    assert [e.id for e in entries] == [ids[0]]
+
+
+def test_event_bus_replays_pending_events(tmp_path):
+    received = []
+
+    def on_download(event_type, data):
+        received.append(data)
+
+    listener = EventListener(on_download, 'DownloadCompleted')
+    journal = EventJournal(str(tmp_path))
+    journal.open()
+    journal.append('DownloadCompleted', {'tmdb_id': 7}, [listener.name, 'removed.listener'])
+    journal.close()
+    mbot = MovieBot()
+    mbot.event_bus.add_listener(listener, show_log=False)
+    mbot.event_bus.enable_journal(str(tmp_path))
+    assert mbot.event_bus.replay_journal() == 1
+    deadline = time.time() + 5
+    while (not received or mbot.event_bus.journal.pending_count()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert received == [{'tmdb_id': 7}]
+    mbot.event_bus.publish_event(
+        Event.builder().set_event_type('DownloadCompleted').set_data({'tmdb_id': 8}).build(), run_in_background=True)
+    deadline = time.time() + 5
+    while (len(received) < 2 or mbot.event_bus.journal.pending_count()) and time.time() < deadline:
+        time.sleep(0.01)
+    mbot.event_bus.close_journal()
+    assert received == [{'tmdb_id': 7}, {'tmdb_id': 8}]
+    assert EventJournal(str(tmp_path)).open() == []
@@ -0,0 +1,45 @@
+import pytest
+
+from mbot.core.params import ArgSchema, ArgType, ArgValidator, parser_to_args
+from mbot.core.plugins import PluginCommand, PluginCommandContext, PluginCommandResponse
+from mbot.exceptions import InvalidParameterException
+
+MODES = [{'name': '全部', 'value': 'all'}, {'name': '新增', 'value': 'new'}]
+
+
+def _command(calls):
+    def sync(ctx: PluginCommandContext, days: int, mode: ArgSchema(ArgType.Enum, '模式', '模式', enum_values=MODES) = 'all'):
+        calls.append((days, mode))
+        if days > 30:
+            raise ValueError('too many days')
+        return PluginCommandResponse(True, f'{days}:{mode}')
+
+    return PluginCommand(sync, 'sync', '同步')
+
+
+def test_compiled_validator_matches_parser():
+    command = _command([])
+    validator = command.validator
+    assert validator is command.validator
+    args = {'days': '7', 'mode': 'new'}
+    assert validator.validate(args) == parser_to_args(args, command.arg_schema)
+    assert validator.validate({'days': 7, 'mode': ['all', 'new']})['mode'] == ['all', 'new']
+    with pytest.raises(InvalidParameterException):
+        validator.validate({'days': 7, 'mode': 'old'})
+    with pytest.raises(InvalidParameterException) as e:
+        validator.validate({'days': 'x'})
+    assert e.value.param_name == 'days'
+    dynamic = ArgValidator({'mode': ArgSchema(ArgType.Enum, '模式', '模式', 'mode', enum_values=lambda: MODES)})
+    assert dynamic.validate({'mode': 'all'})['mode'] == 'all'
+
+
+def test_invoke_batch():
+    calls = []
+    command = _command(calls)
+    results = command.invoke_batch(None, [{'days': '1'}, {'days': '2', 'mode': 'bad'}, {'days': 40}, {'days': 3}])
+    assert [r.success for r in results] == [True, False, False, True]
+    assert results[0].message == '1:all'
+    assert calls == [(1, 'all'), (40, 'all'), (3, 'all')]
+    results = command.invoke_batch(None, [{'days': 50}, {'days': 1}], stop_on_error=True)
+    assert [r.success for r in results] == [False, False]
+    assert calls[-1] == (50, 'all')
@@ -0,0 +1,248 @@
+import datetime
+import json
+import os
+import sys
+import time
+
+from mbot.core import MovieBot
+from mbot.core.config import ConfigValues
+from mbot.core.event.models import Event
+from mbot.core.params import ArgType
+from mbot.core.plugins.pluginloader import PluginLoader
+from mbot.core.task import _TaskManager
+
+PLUGIN_CODE = '''
+import time
+
+from mbot.core.plugins import plugin
+from plugin_load_record import ORDER
+
+time.sleep(0.3)
+ORDER.append('{name}')
+
+
+@plugin.after_setup
+def after_setup(plugin_meta, config):
+    ORDER.append('{name}:after_setup')
+'''
+
+
+def _write_plugin(folder, name, dependencies=None):
+    path = folder / name
+    path.mkdir()
+    (path / 'manifest.json').write_text(json.dumps({'name': name, 'title': name, 'version': '1.0',
+                                                    'dependencies': dependencies or {}}), encoding='utf-8')
+    (path / '__init__.py').write_text(PLUGIN_CODE.format(name=name), encoding='utf-8')
+
+
+def test_parallel_load_follows_dependencies(tmp_path):
+    (tmp_path / 'plugin_load_record.py').write_text('ORDER = []\n', encoding='utf-8')
+    folder = tmp_path / 'parallel_plugins'
+    folder.mkdir()
+    (folder / '__init__.py').write_text('', encoding='utf-8')
+    _write_plugin(folder, 'beta', {'alpha': '>=1.0', 'appVersion': '>=1.0'})
+    _write_plugin(folder, 'alpha')
+    _write_plugin(folder, 'gamma')
+    sys.path.insert(0, str(tmp_path))
+    try:
+        mbot = MovieBot()
+        mbot.config.plugins_config = ConfigValues({})
+        mbot.set_task_manager(_TaskManager(mbot))
+        loader = PluginLoader(str(folder), 'parallel_plugins', mbot)
+        start = time.perf_counter()
+        plugins = loader.load()
+        elapsed = time.perf_counter() - start
+        from plugin_load_record import ORDER
+    finally:
+        sys.path.remove(str(tmp_path))
+    assert sorted(p.name for p in plugins) == ['alpha', 'beta', 'gamma']
+    assert ORDER.index('alpha:after_setup') < ORDER.index('beta')
+    # alpha和gamma没有依赖关系，同一批并行导入
+    assert elapsed < 0.85
+    profiles = {p.name: p for p in loader.get_load_profiles()}
+    assert profiles['alpha'].wave == 0 and profiles['gamma'].wave == 0 and profiles['beta'].wave == 1
+    assert profiles['beta'].import_ms >= 300
+    assert profiles['beta'].success
+    assert profiles['beta'].to_json()['total_ms'] >= profiles['beta'].import_ms
+
+LAZY_PLUGIN_CODE = '''
+from mbot.core.plugins import plugin, PluginCommandResponse
+from plugin_load_record import ORDER
+
+ORDER.append('imported')
+
+
+@plugin.on_event('EmbyPlay*')
+def on_play(ctx, event_type, data):
+    ORDER.append(event_type)
+
+
+@plugin.command(name='sync', title='同步')
+def sync(ctx, days: int):
+    return PluginCommandResponse(True, str(days))
+
+
+@plugin.task('lazy_sync', '同步', minutes=30)
+def lazy_sync():
+    ORDER.append('task')
+    return False
+'''
+
+
+def test_lazy_plugin_activates_on_first_event(tmp_path):
+    (tmp_path / 'plugin_lazy_record.py').write_text('ORDER = []\n', encoding='utf-8')
+    folder = tmp_path / 'lazy_plugins'
+    folder.mkdir()
+    (folder / '__init__.py').write_text('', encoding='utf-8')
+    path = folder / 'lazy'
+    path.mkdir()
+    activation = {'events': ['EmbyPlay*'], 'commands': [{'name': 'sync', 'title': '同步',
+                                                          'args': [{'name': 'days', 'type': 'Int'}]}],
+                  'tasks': [{'name': 'lazy_sync', 'desc': '同步', 'minutes': 30}]}
+    (path / 'manifest.json').write_text(json.dumps({'name': 'lazy', 'title': 'lazy', 'activation': activation}),
+                                        encoding='utf-8')
+    (path / '__init__.py').write_text(LAZY_PLUGIN_CODE.replace('plugin_load_record', 'plugin_lazy_record'),
+                                      encoding='utf-8')
+    sys.path.insert(0, str(tmp_path))
+    try:
+        mbot = MovieBot()
+        mbot.config.plugins_config = ConfigValues({})
+        mbot.set_task_manager(_TaskManager(mbot))
+        loader = PluginLoader(str(folder), 'lazy_plugins', mbot)
+        plugin = loader.load()[0]
+        from plugin_lazy_record import ORDER
+        assert not ORDER and not plugin.activated
+        assert plugin.get_command()[0].arg_schema['days'].arg_type == ArgType.Int
+        mbot.event_bus.publish_event(Event.builder().set_event_type('EmbyPlayStart').set_data({}).build())
+        assert ORDER == ['imported', 'EmbyPlayStart']
+        assert plugin.activated
+        assert [x.listener.func.__name__ for x in mbot.event_bus._get_table('EmbyPlayStop')] == ['on_play']
+        assert plugin.get_command()[0](None, {'days': 3}).message == '3'
+        task = mbot.task_manager.get_tasks()[0]
+        assert task.name == 'lazy_sync' and len(mbot.task_manager.get_tasks()) == 1
+        assert task() is False
+        assert ORDER[-1] == 'task'
+    finally:
+        sys.path.remove(str(tmp_path))
+
+
+RELOAD_PLUGIN_CODE = '''
+from mbot.core.plugins import plugin
+from plugin_reload_record import ORDER
+
+
+@plugin.on_event('{event}')
+def on_event(ctx, event_type, data):
+    ORDER.append('{version}:' + event_type)
+
+
+@plugin.task('{task}', '任务', minutes=30)
+def task():
+    pass
+'''
+
+
+def test_reload_swaps_listeners_and_tasks(tmp_path):
+    (tmp_path / 'plugin_reload_record.py').write_text('ORDER = []\n', encoding='utf-8')
+    folder = tmp_path / 'reload_plugins'
+    folder.mkdir()
+    (folder / '__init__.py').write_text('', encoding='utf-8')
+    path = folder / 'hot'
+    path.mkdir()
+    (path / 'manifest.json').write_text(json.dumps({'name': 'hot', 'title': 'hot'}), encoding='utf-8')
+    code = path / '__init__.py'
+    code.write_text(RELOAD_PLUGIN_CODE.format(event='A', version='v1', task='task_v1'), encoding='utf-8')
+    sys.path.insert(0, str(tmp_path))
+    try:
+        mbot = MovieBot()
+        mbot.config.plugins_config = ConfigValues({})
+        mbot.set_task_manager(_TaskManager(mbot))
+        loader = PluginLoader(str(folder), 'reload_plugins', mbot)
+        old = loader.load()[0]
+        from plugin_reload_record import ORDER
+        code.write_text(RELOAD_PLUGIN_CODE.format(event='B', version='v2', task='task_v2'), encoding='utf-8')
+        plugin = loader.reload('hot')
+        assert plugin is not old and mbot.plugins['hot'] is plugin
+        for t in ('A', 'B'):
+            mbot.event_bus.publish_event(Event.builder().set_event_type(t).set_data({}).build())
+        assert ORDER == ['v2:B']
+        assert [t.name for t in mbot.task_manager.get_tasks()] == ['task_v2']
+        # 导入失败时保留之前的版本
+        code.write_text('raise RuntimeError()', encoding='utf-8')
+        assert loader.reload('hot') is None
+        assert mbot.plugins['hot'] is plugin
+        assert mbot.event_bus.get_listeners('B')[0].func.__name__ == 'on_event'
+        code.write_text(RELOAD_PLUGIN_CODE.format(event='C', version='v3', task='task_v3'), encoding='utf-8')
+        watcher = loader.watch(poll_interval=0.1, debounce=0.1, use_inotify=False)
+        try:
+            # 轮询按修改时间和大小判断变化
+            code.write_text(RELOAD_PLUGIN_CODE.format(event='C', version='v33', task='task_v3'), encoding='utf-8')
+            deadline = time.time() + 5
+            while mbot.plugins['hot'] is plugin and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            loader.stop_watch()
+        assert watcher.mode == 'polling'
+        assert [t.name for t in mbot.task_manager.get_tasks()] == ['task_v3']
+    finally:
+        sys.path.remove(str(tmp_path))
+
+
+def _package(tmp_path, name, version):
+    import zipfile
+    filepath = tmp_path / f'{name}-{version}.zip'
+    with zipfile.ZipFile(filepath, 'w') as z:
+        z.writestr(f'{name}/manifest.json', json.dumps({'name': name, 'title': name, 'version': version}))
+        z.writestr(f'{name}/__init__.py', '')
+    return filepath.read_bytes()
+
+
+def test_installer_resumes_verifies_and_caches(tmp_path):
+    import hashlib
+
+    import httpx
+    import pytest
+
+    from mbot.core.plugins.installer import PluginInstaller, InstallState
+    from mbot.exceptions import PluginsErrorException
+
+    packages = {'/v1.zip': _package(tmp_path, 'demo', '1.0'), '/v2.zip': _package(tmp_path, 'demo', '2.0')}
+    requests = []
+
+    class Interrupted(httpx.SyncByteStream):
+        def __init__(self, content):
+            self.content = content
+
+        def __iter__(self):
+            yield self.content[:100]
+            raise httpx.ReadError('connection reset')
+
+    def handler(request: httpx.Request):
+        content = packages[request.url.path]
+        requests.append(request.headers.get('range'))
+        if len(requests) == 1:
+            return httpx.Response(200, headers={'content-length': str(len(content))}, stream=Interrupted(content))
+        start = int(request.headers['range'][6:-1]) if request.headers.get('range') else 0
+        return httpx.Response(206 if start else 200, content=content[start:])
+
+    folder = tmp_path / 'plugins'
+    folder.mkdir()
+    installer = PluginInstaller(str(folder), transport=httpx.MockTransport(handler))
+    v1 = hashlib.sha256(packages['/v1.zip']).hexdigest()
+    progress = installer.install('http://plugins/v1.zip', v1)
+    assert progress.wait() == str(folder / 'demo')
+    assert requests == [None, 'bytes=100-']
+    assert progress.state == InstallState.Completed and progress.downloaded == len(packages['/v1.zip'])
+    # 已经缓存的安装包不再下载
+    assert installer.install('http://plugins/v1.zip', v1).wait() and len(requests) == 2
+    with pytest.raises(PluginsErrorException):
+        installer.install('http://plugins/v2.zip', '0' * 64).wait()
+    installer.install('http://plugins/v2.zip').wait()
+    assert json.loads((folder / 'demo' / 'manifest.json').read_text())['version'] == '2.0'
+    installer.rollback('demo').wait()
+    assert json.loads((folder / 'demo' / 'manifest.json').read_text())['version'] == '1.0'
+    assert sorted(os.listdir(folder)) == ['.cache', 'demo']
+    # 结束很久的安装记录被清理，进度表不会一直增长
+    assert len(installer.get_progress()) == 5
+    progress.finished_at -= datetime.timedelta(days=1)
+    assert installer.get_progress(progress.install_id) == [] and len(installer.get_progress()) == 4
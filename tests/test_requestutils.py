@@ -0,0 +1,46 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mbot.common.requestutils import PooledHttpClient
+
+
+def _serve(failures):
+    connections = set()
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            connections.add(self.client_address)
+            calls.append(self.path)
+            status = 503 if failures and failures.pop() else 200
+            body = self.headers.get('X-Token', '').encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, connections, calls
+
+
+def test_pooled_http_client_reuses_connections_and_retries():
+    server, connections, calls = _serve([True])
+    client = PooledHttpClient(f'http://127.0.0.1:{server.server_port}', headers={'X-Token': 'abc'},
+                              retries=2, retry_backoff=0)
+    try:
+        # 第一次请求返回503后自动重试
+        r = client.get('/items', params={'a': 1})
+        assert r.status_code == 200 and r.text == 'abc'
+        for _ in range(10):
+            assert client.get('/items').status_code == 200
+        assert len(calls) == 12
+        assert len(connections) == 1
+    finally:
+        client.close()
+        server.shutdown()
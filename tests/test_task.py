@@ -0,0 +1,181 @@
+import importlib
+import sys
+import threading
+import time
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, JobEvent
+
+from mbot.core.task import _TaskManager, StartupTaskState, spread_offset
+from mbot.core.taskpool import ConcurrencyBudget, RateBudget, PRIORITY_PLUGIN, TaskPool, POOL_CPU
+
+
+def test_task_run_history_and_stats():
+    manager = _TaskManager()
+    calls = []
+
+    def task():
+        calls.append(1)
+        if len(calls) == 2:
+            raise ValueError('task failure')
+
+    manager.add_task(task, 'history_task', '测试任务', seconds=3600, run_at_startup=True)
+    meta = manager.get_tasks()[0]
+    assert not calls
+    manager.startup.start()
+    assert manager.startup.wait(5)
+    try:
+        meta()
+    except ValueError:
+        pass
+    history = manager.get_task_history('history_task')
+    assert [r.success for r in history] == [True, False]
+    assert 'task failure' in history[1].error
+    manager._on_job_event(JobEvent(EVENT_JOB_MAX_INSTANCES, 'history_task', 'default'))
+    stats = manager.get_task_stats('history_task')[0]
+    assert stats.runs == 2
+    assert stats.failures == 1
+    assert stats.skipped == 1
+    assert stats.running == 0
+    assert stats.p95_ms is not None
+    assert stats.to_json()['last_run']['success'] is False
+    assert manager._scheduler.get_job('history_task').max_instances == 1
+
+
+def test_budget_prefers_higher_priority():
+    budget = ConcurrencyBudget(1)
+    order = []
+    budget.acquire()
+    threads = [threading.Thread(target=lambda p=p: (budget.acquire(p), order.append(p), budget.release()))
+               for p in (100, 0)]
+    for t in threads:
+        t.start()
+        time.sleep(0.05)
+    assert budget.waiting == 2
+    budget.release()
+    for t in threads:
+        t.join(timeout=5)
+    assert order == [0, 100]
+
+
+def test_plugin_task_pool():
+    manager = _TaskManager()
+    threads = []
+    manager.add_task(lambda: threads.append(threading.current_thread().name), 'plugin_pool_task', '插件任务',
+                     seconds=3600, run_at_startup=True, run_at_startup_in_thread=True, plugin_name='demo')
+    meta = manager.get_tasks()[0]
+    assert meta.pool == 'plugin:demo'
+    assert meta.priority == PRIORITY_PLUGIN
+    assert manager._scheduler.get_job('plugin_pool_task').executor == 'plugin:demo'
+    manager.startup.start()
+    assert manager.startup.wait(5)
+    assert threads[0].startswith('Task-plugin:demo')
+    manager.remove_task(meta)
+    assert 'plugin:demo' not in [s.name for s in manager.get_pool_stats()]
+
+
+def test_startup_tasks_follow_dependencies():
+    manager = _TaskManager()
+    order = []
+    lock = threading.Lock()
+
+    def make(name, fail=False):
+        def task():
+            time.sleep(0.02)
+            with lock:
+                order.append(name)
+            if fail:
+                raise ValueError(name)
+
+        return task
+
+    manager.add_task(make('index'), 'index', '索引', seconds=3600, run_at_startup=True, requires=['db'])
+    manager.add_task(make('db'), 'db', '数据库', seconds=3600, run_at_startup=True)
+    manager.add_task(make('broken', True), 'broken', '失败任务', seconds=3600, run_at_startup=True)
+    manager.add_task(make('after_broken'), 'after_broken', '依赖失败任务', seconds=3600, run_at_startup=True,
+                     requires=['broken'])
+    manager.add_task(make('a'), 'cycle_a', '环A', seconds=3600, run_at_startup=True, requires=['cycle_b'])
+    manager.add_task(make('b'), 'cycle_b', '环B', seconds=3600, run_at_startup=True, requires=['cycle_a'])
+    manager.startup.start()
+    assert manager.startup.wait(5)
+    assert order.index('db') < order.index('index')
+    states = manager.startup.get_states()
+    assert states['index'] == StartupTaskState.Success
+    assert states['broken'] == StartupTaskState.Failed
+    assert states['after_broken'] == StartupTaskState.Skipped
+    assert states['cycle_a'] == StartupTaskState.Skipped
+    assert 'after_broken' not in order
+
+
+def test_spread_rate_limit_and_adaptive_interval():
+    manager = _TaskManager()
+    results = [False, False, True]
+    manager.add_task(lambda: results.pop(0), 'adaptive_task', '自适应任务', seconds=60, spread=True, adaptive=True,
+                     max_interval=200, targets=['emby'])
+    job = manager._scheduler.get_job('adaptive_task')
+    assert job.trigger.start_date.timestamp() % 60 == spread_offset('adaptive_task', 60)
+    manager.set_rate_limit('emby', 600, period=60)
+    meta = manager.get_tasks()[0]
+    meta()
+    assert meta.current_interval == 120
+    # 放大间隔后仍然保持错开的相位
+    job = manager._scheduler.get_job('adaptive_task')
+    assert job.trigger.interval_length == 120
+    assert job.trigger.start_date.timestamp() % 120 == spread_offset('adaptive_task', 120)
+    meta()
+    assert meta.current_interval == 200
+    meta()
+    assert manager.get_task_stats('adaptive_task')[0].interval == 60
+    budget = RateBudget('qbittorrent', 20, period=1)
+    assert budget.acquire() == 0
+    assert 0 < budget.reserve() <= 0.05
+
+
+CPU_PLUGIN = """
+from mbot.core.plugins import PluginManifest, PluginMeta
+
+plugin = PluginMeta('cpuplug', 'cpuplug', PluginManifest({'name': 'cpuplug'}), None)
+
+
+@plugin.task('cpuplug_heavy', 'CPU任务', seconds=3600, pool='cpu')
+def heavy():
+    return sum(range(1000))
+"""
+
+
+def test_plugin_cpu_task_runs_in_process_pool(tmp_path, monkeypatch):
+    (tmp_path / 'cpuplug.py').write_text(CPU_PLUGIN, encoding='utf-8')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = importlib.import_module('cpuplug')
+    pool = TaskPool(POOL_CPU, 'process', 1)
+    try:
+        # 装饰后模块中的名称仍然是原函数，进程池才能按名称pickle
+        assert callable(module.heavy)
+        task = module.plugin._tasks[0].task
+        assert task is module.heavy
+        assert pool.run(task) == 499500
+    finally:
+        pool.shutdown(wait=True)
+        sys.modules.pop('cpuplug', None)
+
+
+def test_startup_tasks_wait_for_web_server():
+    import socket
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    manager = _TaskManager()
+    calls = []
+    manager.add_task(lambda: calls.append(1), 'after_web', '启动任务', seconds=3600, run_at_startup=True)
+    manager.start(web_address=('127.0.0.1', port))
+    try:
+        time.sleep(0.5)
+        assert not calls
+        server = socket.create_server(('127.0.0.1', port))
+        try:
+            assert manager.startup.wait(5)
+            assert calls == [1]
+        finally:
+            server.close()
+    finally:
+        manager._scheduler.shutdown()